@@ -53,6 +53,21 @@ create table way_nodes (
 create index way_nodes_way_id ON way_nodes ( way_id );
 create index way_nodes_node_id ON way_nodes ( node_id );
 
+-- Way geometry, built at load time so readers don't have to join
+-- way_nodes to nodes. geom is WKB (LineString, or Polygon for closed areas).
+
+create table way_geometry (
+    way_id INTEGER PRIMARY KEY REFERENCES ways ( id ),
+    min_lon REAL,
+    min_lat REAL,
+    max_lon REAL,
+    max_lat REAL,
+    geom BLOB
+);
+
+create index way_geometry_lat ON way_geometry ( min_lat, max_lat );
+create index way_geometry_lon ON way_geometry ( min_lon, max_lon );
+
 create table relations (
     id INTEGER PRIMARY KEY,
     timestamp TEXT,
@@ -82,4 +97,10 @@ create table relation_members (
 create index relation_members_relation_id ON relation_members ( relation_id );
 create index relation_members_type ON relation_members ( type, ref );
 
-    
+-- Last osmChange diff applied by osm_update.py
+
+create table replication_state (
+    id INTEGER PRIMARY KEY CHECK ( id = 1 ),
+    sequence INTEGER,
+    timestamp TEXT
+);
@@ -14,16 +14,28 @@
 
 #Import modules
 import sys, os
-import fileinput, bz2
+import json
 import math, time
-import gzip
+from bisect import bisect_left
+from html import unescape
+import multiprocessing
 
-from OSMReader import OSMReader
+from array import array
+
+from osm_reader import OsmReader
+from osm_extsort import ExternalSorter, RunWriter, read_run, coord
+from osm_nodestore import open_node_store
+from osm_multipolygon import assemble_multipolygon, MULTIPOLYGON_TYPES
+from osm_mapping import load_mapping
+from osm_writers import open_writer, SpatialSortWriter, WayBuilder, WRITERS
 
 from optparse import OptionParser, OptionGroup
 
 #---------------------------------------------------------------------------
-# This Python script will load osm xml into a file geodatabase
+# This Python script will load osm xml into a file geodatabase, GeoPackage,
+# newline-delimited GeoJSON or shapefiles (osm_writers.py, -f or by the
+# output extension: .gdb, .gpkg, .geojsonl, .shp). Only the file geodatabase
+# needs arcgisscripting.
 # It works against the compressed *.bz2 file to save space
 # resulting fgdb will contain Nodes where they have useful tags.
 # No segments will be loaded
@@ -32,6 +44,28 @@ from optparse import OptionParser, OptionGroup
 # you should be able to load the complete planet without memory issues
 # you will need aprox 2x the bz2 files space for temporary space
 # also space for output data. 
+#
+# Ways are assembled with an external sort-merge join (step 3):
+#   - way node references (node id, way number, sequence) are sorted by node id
+#   - node coordinates (node id, node number, lon, lat) are sorted by node id
+#   - one streaming merge of the two resolves every reference to a coordinate
+#   - the resolved references are sorted by (way number, sequence) and read
+#     back in step with the way headers to emit the geometries
+# Each sort holds at most one block (-k) of records in memory and spills
+# sorted runs to the work directory, so memory is bounded and every record
+# is written and read a fixed number of times whatever the planet size.
+#
+# Multipolygon and boundary relations are assembled into polygons too
+# (osm_multipolygon.py), in three more sorts after the ways are built:
+#   - member way references (way id, relation number, sequence)
+#   - coordinates of member ways (way id, way number, point, lon, lat)
+#   - joined on way id, then sorted by (relation number, sequence, point)
+#     and read back in step with the relation headers
+#
+# With -L dense or -L sparse, node locations go into a node location store
+# (osm_nodestore.py) instead, and way node references are resolved as they
+# are read - no node sort and no merge join. Needs nodes before ways in the
+# input, which is how planet files are written.
 
 # Command line parameters
 # D:\GNIS_OSM\rhode_island.osm.bz2 D:\GNIS_OSM\RI OSM.gdb 4 D:\GNIS_OSM\Work
@@ -44,8 +78,6 @@ from optparse import OptionParser, OptionGroup
 # -i d:\gnis_osm\dasc-original.osm.gz -o dasc-original.gdb
 
 
-sep = ';'
-sep2 = '#'
 
 parser = OptionParser()
 
@@ -53,14 +85,45 @@ parser.add_option('-i', '--input', dest='filename',
                   help="OSM XML file to read extract from")
 
 parser.add_option('-o', '--output', dest='fgdb_name', 
-                  help="File geodatabase to create from the input file")
+                  help="File geodatabase (or GeoPackage, GeoJSON or shapefile directory) "
+                       "to create from the input file")
+
+parser.add_option('-f', '--format', dest='format', default=None,
+                  choices=sorted(WRITERS),
+                  help="Output format: " + ", ".join(sorted(WRITERS))
+                       + " (default from the output extension, else gpkg)")
+
+parser.add_option('-m', '--mapping', dest='mapping', default=None,
+                  help="JSON tag to column mapping (see osm_mapping.py). Default: the "
+                       "source, attribution, created_by, converted_by and highway columns.",
+                  metavar="FILE")
+
+parser.add_option('-n', '--batch', dest='batch', type='int', default=10000,
+                  help="Features per write batch/transaction.")
+
+parser.add_option('-j', '--workers', dest='workers', type='int',
+                  default=multiprocessing.cpu_count() - 1,
+                  help="Worker processes for building way geometry (0 = none).")
                   
 parser.add_option('-w', '--workdir', dest='workdir', 
                   help="Work directory", default='work')
 
-parser.add_option('-k', '--blocksize', dest='blocksize', 
+parser.add_option('-k', '--blocksize', dest='blocksize', type='int',
                   help="Block size for handling large files.", default=16)
 
+parser.add_option('-L', '--locations', dest='locations', default='sortmerge',
+                  choices=['sortmerge', 'dense', 'sparse'],
+                  help="Resolve way nodes by sort-merge join (default), or through a "
+                       "dense (memory-mapped file) or sparse (in memory) node location store.")
+
+parser.add_option('-S', '--spatial-sort', dest='spatial_sort', action="store_true",
+                  default=False,
+                  help="Write features in Hilbert order of their centroid (external sort "
+                       "before writing), so bbox queries on the output read fewer pages.")
+
+parser.add_option('-z', '--compress', dest='compress', action="store_true", default=False,
+                  help="Compress temp files (fast zlib, per block).")
+
 bbox_group = OptionGroup(parser, "Bounding Box (Decimal Degrees)")
 bbox_group.add_option('-l', '--left', dest='left', type='float', default='-180.0')
 bbox_group.add_option('-r', '--right', dest='right', type='float', default='180.0')
@@ -90,8 +153,8 @@ parser.add_option('-x', '--stats', dest='showstats', action="store_true", defaul
 
 sourcefile = options.filename
 (inPath, inFile) = os.path.split(sourcefile)
-outFGDB = inPath + "\\" + options.fgdb_name
-workDir = inPath + "\\" +  options.workdir
+outFGDB = os.path.join(inPath, options.fgdb_name)
+workDir = os.path.join(inPath, options.workdir)
 blockSize = options.blocksize
 
 bbox_left = options.left
@@ -105,7 +168,7 @@ output_history = options.history
 output_changesets = options.changesets
 resolve = options.resolve
 
-start = time.clock()
+start = time.perf_counter()
 
 from datetime import date
 
@@ -116,22 +179,25 @@ start_date = date(int(year), int(month), int(day))
 end_date = date(int(year), int(month), int(day))
 
 if start_date > end_date:
-    print "End date must be greater than start date\n\n"
+    print("End date must be greater than start date\n\n")
     sys.exit(-1)
 
 # Show stats just does the first pass and gives stats on the data
 show_stats = options.showstats
 
-# Import the arc module as late as possible
-import arcgisscripting
+# This is a script, not a module - workers that re-import it (spawn, on
+# Windows) would run the whole conversion again. Only fork is safe.
+workers = options.workers
+if multiprocessing.get_start_method() != 'fork':
+    workers = 0
 
-# Create the geoprocessor object - use 9.3 version
-gp = arcgisscripting.create(9.3)
+# The geoprocessor, when writing a file geodatabase
+gp = None
 
 # Prints message to stdout and adds to the geoprocessor (in case this is run as a tool)
 # 
 def AddMsgAndPrint(msg, severity=0):
-    print msg
+    print(msg)
 
     # Split the message on \n first, so that if it's multiple lines, 
     #  a GPMessage will be added for each line
@@ -145,49 +211,51 @@ def AddMsgAndPrint(msg, severity=0):
                 gp.AddWarning(string)
             elif severity == 2:
                 gp.AddError(string)
-    except:
+    except AttributeError:
         pass
 
 
+# Deleted versions in history files have no lat/lon and anonymous edits no
+# uid/user, and get_attribute_value() can't tell a missing attribute from
+# a present one - so look at the tag itself.
+def has_attribute(line, name):
+    return (' ' + name + '="') in line
+
 
-# Enable/disable the use of bz2 compression for temp files
-compress_temp_files = False
+# node/way/relation attributes with uid 0 and no user for anonymous edits
+# (uid and user at uid_pos, uid_pos + 1)
+def with_user(fields, line, uid_pos):
+    if has_attribute(line, 'uid'):
+        # The user name is raw XML, like tag keys/values
+        return (fields[:uid_pos + 1] + (unescape(fields[uid_pos + 1]),)
+                + fields[uid_pos + 2:])
+    return fields[:uid_pos] + ('0', '') + fields[uid_pos + 2:]
+
+
+
+# Enable/disable zlib compression of temp file blocks
+compress_temp_files = options.compress
 
 # Enable/disable deleting temp files (for debugging)
 delete_temp_files = False
 
 
 #
-# Tags to convert to fields - I really want to make this an input file
+# Tags to convert to fields, from the mapping file (-m)
 #
-#standard fields to poulate in Tags
-standardFields = set((
-                     'source', 'attribution','created_by','converted_by',
-                     'highway'
-                     
-                     # GNIS-related tags
-                     #'gnis_id', 'gnis_import_uuid','gnis_edited','gnis_reviewed',
-                     #'gnis_created','gnis_feature_id','gnis_feature_type',
-                     #'gnis_Class',
-                     #'gnis_county_id','gnis_County','gnis_county_name','gnis_County_num',
-                     #'gnis_state_id','gnis_ST_alpha','gnis_ST_num'
-
-                     #'highway','junction','cycleway','tracktype','waterway','railway',
-                     #'aeroway','aerialway','power','man_made','leisure',
-                     #'amenity','shop','tourism','historic','landuse',
-                     #'military','natural','route','boundary','sport',
-                     #'abutters','fenced','lit','width','lanes',
-                     #'bridge','tunnel','cutting','embankment','layer',
-                     #'surface','name','int_name','nat_name','reg_name',
-                     #'loc_name','old_name','ref','int_ref','nat_ref',
-                     #'reg_ref','loc_ref','old_ref','ncn_ref','place',
-                     #'place_name','place_numbers','postal_code','is_in','note','class'
-                     ))
-
-                     
+try:
+    mapping = load_mapping(options.mapping)
+except (OSError, ValueError, KeyError) as ErrorDesc:
+    print("Failed to load mapping: " + str(ErrorDesc))
+    sys.exit(-1)
+
 #Tags with these keys will not be loaded, features with *only* these keys will not be loaded
-#ignoreFields = set(('created_by','source','converted_by'))
-ignoreFields = set(('fred','barney'))
+ignoreFields = set(mapping.ignore)
+
+# Compiled once: key -> column lookups and row templates per OSM type
+nodemap = mapping.compile('node')
+waymap = mapping.compile('way')
+relmap = mapping.compile('relation')
 
 class fieldType:
     unknown = -1
@@ -199,19 +267,27 @@ class fieldType:
 #this flag controls whether features with only non standard tags are loaded.
 loadNonstandardTags=True
 
+# Field schema of the output layers. Mapped tags become columns on nodes,
+# ways, area_ways and multipolygons; other tags go to the other_*_tags tables.
+common_fields = [("Version", "LONG", 0), ("Timestamp", "DATE", 0), ("User_ID", "LONG", 0),
+                 ("User", "TEXT", 255), ("Changeset", "LONG", 0)]
+
+node_fields = [("Node_ID", "LONG", 0)] + common_fields + nodemap.fields
+way_fields = [("Way_ID", "LONG", 0)] + common_fields + waymap.fields
+node_tag_fields = [("Node_ID", "LONG", 0), ("Tag_Name", "TEXT", 30), ("Tag_Value", "TEXT", 255)]
+way_tag_fields = [("Way_ID", "LONG", 0), ("Tag_Name", "TEXT", 30), ("Tag_Value", "TEXT", 255)]
+relation_fields = [("Relation_ID", "LONG", 0), ("Type", "TEXT", 30)] + common_fields \
+    + relmap.fields
+
 output = outFGDB
-nodefc = output + "\\nodes"
-#nodetagtab=output+"\osm_node_tags"
-nodeothertag = output + "\other_node_tags"
-wayothertag = output + "\other_way_tags"
-wayfc = output + "\osm_ways"
-finalwayfc = output + "\ways"
-areawayfc = output + "\osm_area_ways"
-finalareawayfc = output + "\\area_ways"
-waytagtab = output + "\osm_way_tags"
-coordsys = 'Coordinate Systems\Geographic Coordinate Systems\World\WGS 1984.prj'
 scratchSpace = workDir
 
+try:
+    os.makedirs(scratchSpace, exist_ok=True)
+except OSError as ErrorDesc:
+    print("Failed to create the work directory: " + str(ErrorDesc))
+    sys.exit(-1)
+
 blocksize = blockSize * 500000
 
 nodecount=0
@@ -224,94 +300,89 @@ ftype = fieldType.unknown
 hasvalidtags=False
 
 #
-# Step 1 of 5: Prepare FGDB
+# Step 1 of 4: Prepare the output
 #
 try:
-    #prepare target featureclasses
-    AddMsgAndPrint("Step 1/5: Preparing target feature Classes")
-    
-    gp.toolbox = "management"
-    if not gp.Exists(output):
-        gp.CreateFileGDB(os.path.split(output)[0], os.path.split(output)[1])
-        
-    if not gp.Exists(nodefc):
-        gp.CreateFeatureclass(output, "nodes", "point", "#", "DISABLED", "DISABLED", coordsys)
-        gp.addfield(nodefc, "Node_ID", "LONG")
-        gp.addfield(nodefc, "Version", "LONG")
-        gp.addfield(nodefc, "Timestamp", "DATE")
-        gp.addfield(nodefc, "User_ID", "LONG")
-        gp.addfield(nodefc, "User", "TEXT","#","#","255")
-        gp.addfield(nodefc, "Changeset", "LONG")
-        for fieldname in standardFields:
-            gp.addfield(nodefc,fieldname,"TEXT","#","#","255")
-        
-    if not gp.Exists(nodeothertag):
-        gp.CreateTable(output, "other_node_tags")
-        gp.addfield(nodeothertag,"Node_ID","LONG")
-        gp.addfield(nodeothertag,"Tag_Name","TEXT","30","#","30")
-        gp.addfield(nodeothertag,"Tag_Value","TEXT","255","#","255")
-        
-    if not gp.Exists(wayfc):
-        gp.CreateFeatureclass(output, "osm_ways", "polyline", "#", "DISABLED", "DISABLED",coordsys)
-        gp.addfield(wayfc, "Way_ID", "LONG")
-        gp.addfield(wayfc, "Version", "LONG")
-        gp.addfield(wayfc, "Timestamp", "DATE")
-        gp.addfield(wayfc, "User_ID", "LONG")
-        gp.addfield(wayfc, "User", "TEXT","#","#","255")
-        gp.addfield(wayfc, "Changeset", "LONG")
-        for fieldname in standardFields:
-            gp.addfield(wayfc,fieldname,"TEXT","#","#","255")
-
-    if not gp.Exists(areawayfc):
-        gp.CreateFeatureclass(output, "osm_area_ways", "polygon", "#", "DISABLED", "DISABLED",coordsys)
-        gp.addfield(areawayfc, "Way_ID", "LONG")
-        gp.addfield(areawayfc, "Version", "LONG")
-        gp.addfield(areawayfc, "Timestamp", "DATE")
-        gp.addfield(areawayfc, "User_ID", "LONG")
-        gp.addfield(areawayfc, "User", "TEXT","#","#","255")
-        gp.addfield(areawayfc, "Changeset", "LONG")
-        for fieldname in standardFields:
-            gp.addfield(areawayfc,fieldname,"TEXT","#","#","255")
-
-    if not gp.Exists(wayothertag):
-        gp.CreateTable(output, "other_way_tags")
-        gp.addfield(wayothertag,"Way_ID","LONG")
-        gp.addfield(wayothertag,"Tag_Name","TEXT","#","#","30")
-        gp.addfield(wayothertag,"Tag_Value","TEXT","#","#","255")
-        
-    if not gp.Exists(waytagtab):
-        gp.CreateTable(output, "osm_way_tags")
-        gp.addfield(waytagtab,"Way_ID","LONG")
-        for fieldname in standardFields:
-            gp.addfield(waytagtab,fieldname,"TEXT","#","#","255")
-            
-    ##if not gp.Exists(nodetagtab):
-    ##    gp.CreateTable(output, "osm_node_tags")
-    ##    gp.addfield(nodetagtab,"Node_ID","LONG")
-    ##    for fieldname in standardFields:
-    ##        gp.addfield(nodetagtab,fieldname,"TEXT","#","#","255")
-            
-except Exception, ErrorDesc:
+    #prepare target layers
+    AddMsgAndPrint("Step 1/4: Preparing target layers")
+
+    writer = open_writer(output, options.format, options.batch)
+    gp = getattr(writer, 'gp', None)
+    if options.spatial_sort:
+        # Encoded features are much bigger than the sorters' id tuples
+        writer = SpatialSortWriter(writer, scratchSpace, max(1, blocksize // 10),
+                                   compress_temp_files)
+
+    writer.create_layer("nodes", "point", node_fields)
+    writer.create_layer("other_node_tags", None, node_tag_fields)
+    writer.create_layer("ways", "polyline", way_fields)
+    writer.create_layer("area_ways", "polygon", way_fields)
+    writer.create_layer("other_way_tags", None, way_tag_fields)
+    writer.create_layer("multipolygons", "multipolygon", relation_fields)
+
+except Exception as ErrorDesc:
     AddMsgAndPrint("Step 1 Failed" + str(ErrorDesc), 1)
-    print gp.GetMessages()
-    del gp
     sys.exit(-1)
 
+# External sorts feeding the step 3 sort-merge join
+#   nodesorter:    (node id, node number, lon, lat)
+#   waynodesorter: (node id, way number, sequence)
+#   resolvedsorter:(way number, sequence, lon, lat)
+# Node/way numbers are the position in the input file, so with history files
+# the latest version of a node wins and every way version is its own way.
+nodesorter = ExternalSorter(scratchSpace, 'nodes', (int, int, coord, coord), blocksize,
+                            compress_temp_files)
+waynodesorter = ExternalSorter(scratchSpace, 'waynodes', (int, int, int), blocksize,
+                               compress_temp_files)
+resolvedsorter = ExternalSorter(scratchSpace, 'resolved', (int, int, coord, coord), blocksize,
+                                compress_temp_files)
+
+# way_id, version, timestamp, uid, changeset, node count, user, mapped columns (JSON)
+wayheader_fields = (int, str, str, str, str, int, str, str)
+
+# Multipolygon relations
+#   membersorter:    (way id, relation number, sequence)
+#   memberwaysorter: (way id, way number, point, lon, lat)
+#   relcoordsorter:  (relation number, sequence, point, lon, lat)
+membersorter = ExternalSorter(scratchSpace, 'members', (int, int, int), blocksize,
+                              compress_temp_files)
+memberwaysorter = ExternalSorter(scratchSpace, 'memberways', (int, int, int, coord, coord),
+                                 blocksize, compress_temp_files)
+relcoordsorter = ExternalSorter(scratchSpace, 'relcoords', (int, int, int, coord, coord),
+                                blocksize, compress_temp_files)
+memberids = array('q')
+
+# relation_id, type, version, timestamp, uid, changeset, way member count, user,
+# mapped columns (JSON)
+relheader_fields = (int, str, str, str, str, str, int, str, str)
+
+if options.locations == 'dense':
+    nodestore = open_node_store(scratchSpace+'/nodes.dense', 'w', 'dense')
+elif options.locations == 'sparse':
+    nodestore = open_node_store(None, 'w', 'sparse')
+else:
+    nodestore = None
+
 #
 # Step 2: Load nodes and tags
 #
+osmFile = None
+wayheaders = None
+relheaders = None
+
 try:
-    AddMsgAndPrint("Step 2/5: Load the nodes and tags")
+    AddMsgAndPrint("Step 2/4: Load the nodes and tags")
 
     # Input can be an uncompressed OSM XML file or bzip2 or gzip compressed
-    osmFile = OSMReader(inFile)
+    osmFile = OsmReader(sourcefile)
 
-    if compress_temp_files:
-        unbuiltsegments=bz2.BZ2File(scratchSpace+'/unbuiltsegments.dat','w')
-        unbuiltways=bz2.BZ2File(scratchSpace+'/unbuiltways.dat','w')
-    else:
-        unbuiltsegments= open(scratchSpace+'/unbuiltsegments.dat','w')
-        unbuiltways= open(scratchSpace+'/unbuiltways.dat','w')
+    # Way headers, one record per way in input order
+    wayheaders = RunWriter(scratchSpace+'/wayheaders.dat', wayheader_fields, compress_temp_files)
+
+    # Multipolygon relation headers, one record per relation in input order
+    relheaders = RunWriter(scratchSpace+'/relheaders.dat', relheader_fields, compress_temp_files)
+    relnum = -1
+    relmembers = []
 
     node = ('ID','x','y','ver','ts','uid','user','changeset')
     way = ('ID','ver','ts','uid','user','changeset')
@@ -321,212 +392,177 @@ try:
 
     ##------------------------------------------------------------------------------
     ##First pass through source file
-    ##sort nodes into blocks
+    ##queue node coordinates and way node references for sorting
     ##seperate ways
-    ##load tagged nodes into fgdb
-    ##load node and way tags into fgdb
+    ##load tagged nodes into the output
+    ##load other node and way tags into the output
+    ##keep mapped way tags with the way headers for step 3
     ##--------------------------------------------------------------------------------
 
-    nodecursor = gp.insertcursor(nodefc)
-    waytagcursor = gp.insertcursor(waytagtab)
-    othernodetagcursor = gp.insertcursor(nodeothertag)
-    otherwaytagcursor = gp.insertcursor(wayothertag)
-    nodepnt = gp.createobject("point")
     ftags=[]
 
     linecount = 0
-    blocknum = 1
-    
-    if compress_temp_files:
-        nodefile=bz2.BZ2File(scratchSpace+'/nodeblock'+str(blocknum)+'.dat','w')
-    else:
-        nodefile=open(scratchSpace+'/nodeblock'+str(blocknum)+'.dat','w')
-        
+    waynum = -1
+    wayseq = 0
+
     while True:
         # Read the next line from the OSM file
-        uline = osmFile.getNextTag()
+        uline = osmFile.get_next_tag()
 
         if uline == '':
             break
         
-        element = osmFile.getElement()
+        element = osmFile.get_element()
         linecount += 1
 
         if linecount % 2000000 == 0:
             AddMsgAndPrint(str(nodecount) +' Vertices   '+str(waycount)+' Ways     ' + str(taggednodecount) +' Tagged Nodes     '+str(nodetagcount)+ ' Node Tags')
 
-        if element=='node':
+        if element in ('node', 'way', 'relation'):
+            # Nothing carries over from the last object, even one skipped
             ftype = fieldType.unknown
             ftags = []
-            node = osmFile.returnNode()
+            hasvalidtags = False
+
+        if element=='node':
+            # Deleted versions in history files have no location; ways use
+            # the last visible version
+            if not has_attribute(uline, 'lat'):
+                continue
+
+            node = with_user(osmFile.return_node(), uline, 5)
+            node_ts = osmFile.get_attribute_value('timestamp')
               
             # Make sure lat/long make sense before continuing
             if (math.fabs(float(node[1])) > 180) or (math.fabs(float(node[2])) > 90):
                 continue
                 
             ftype = fieldType.node
-            
-            if nodecount > blocknum * blocksize:
-                nodefile.close()
-                blocknum += 1
-                if compress_temp_files:
-                    nodefile=bz2.BZ2File(scratchSpace+'/nodeblock'+str(blocknum)+'.dat','w')
-                else:
-                    nodefile=open(scratchSpace+'/nodeblock'+str(blocknum)+'.dat','w')
-
-            sline = str(node[0]) + sep                              # Node ID
-            sline = sline + str(node[1]) + sep                      # Latitude
-            sline = sline + str(node[2]) + sep                      # Longitude
-            sline = sline + str(node[3]) + sep                      # Version
-            sline = sline + str(node[4]) + sep                      # Timestamp
-            sline = sline + str(node[5]) + sep                      # User ID
-            sline = sline + str(node[6]) + sep    # User Name
-            sline = sline + str(node[7]) + '\n'                     # Changeset
-            #print sline
-
-            nodefile.write(sline)
+
+            # Node ID, node number, Longitude, Latitude
+            if nodestore is None:
+                nodesorter.add((int(node[0]), nodecount, float(node[1]), float(node[2])))
+            else:
+                nodestore.set(int(node[0]), float(node[1]), float(node[2]))
             nodecount+=1
 
         elif element=='way':
-            ftags = []
             ftype = fieldType.way
             waycount+=1
-            way = osmFile.returnWay()
+            waynum+=1
+            wayseq = 0
+            way = with_user(osmFile.return_way(), uline, 3)
+            way_ts = osmFile.get_attribute_value('timestamp')
 
-            sline = str(way[0]) + sep                              # Node ID
-            sline = sline + str(way[1]) + sep                      # Version
-            sline = sline + str(way[2]) + sep                      # Timestamp
-            sline = sline + str(way[3]) + sep                      # User ID
-            sline = sline + str(way[4]) + sep                      # User Name
-            sline = sline + str(way[5])                            # Changeset
+            # Deleted ways in history files have no nodes: <way .../>
+            if uline[-2] == '/':
+                wayheaders.add((int(way[0]), way[1], way_ts, way[3], way[5], 0, way[4],
+                                json.dumps(waymap.template)))
 
-            unbuiltways.write('\n' + sline + sep2)
-            
         elif element=='nd':
             # <nd ref="110552334"/>
-            unbuiltways.write(str(osmFile.getAttributeValue('ref')) + sep)
+            nd = int(osmFile.get_attribute_value('ref'))
+            if nodestore is None:
+                waynodesorter.add((nd, waynum, wayseq))
+            else:
+                loc = nodestore.get(nd)
+                if loc is not None:
+                    resolvedsorter.add((waynum, wayseq, loc[0], loc[1]))
+            wayseq += 1
+
+        elif element=='relation':
+            ftype = fieldType.relation
+            relmembers = []
+            rel = with_user(osmFile.return_way(), uline, 3)
+            rel_ts = osmFile.get_attribute_value('timestamp')
+
+        elif element=='member' and ftype == fieldType.relation:
+            # <member type="way" ref="123" role="outer"/>
+            if osmFile.get_attribute_value('type') == 'way':
+                relmembers.append(int(osmFile.get_attribute_value('ref')))
 
         elif element=='tag':
-            (key, value) = osmFile.returnTag()
+            # Raw keys - the mapping decides column names
+            key = unescape(osmFile.get_attribute_value('k'))
+            value = unescape(osmFile.get_attribute_value('v'))
             
             if key in ignoreFields:
                 continue
             
+            #remove tags with blank values too. lots of wierd keys have blank values
             if value == '':
                 continue
 
+            # Tags are mapped to columns once the object is complete
+            ftags.append((key,value))
+            hasvalidtags=True
+
             if ftype == fieldType.node:
-                #tagged node
-                #ignore less useful tags, and if not a standard tag
-                #remove tags with blank values too. lots of wierd keys have blank values
-                
-                if key in standardFields:
-                    ftags.append((key,value))
-                    hasvalidtags=True
-                    nodetagcount+=1
-                elif loadNonstandardTags:
-                    hasvalidtags=True
-                    row = othernodetagcursor.newrow()
-                    row.Node_ID = long(node[0])
-                    row.Tag_Name = str(key)
-                    row.Tag_Value = str(value.encode('utf-8'))
-                    othernodetagcursor.insertrow(row)
-                    nodetagcount += 1
-                    
+                nodetagcount+=1
             elif ftype == fieldType.way:
-
-                if key in standardFields:
-                    key = key.replace(sep,'_')
-
-                    ftags.append((key,value))
-                    hasvalidtags=True
-                    waytagcount+=1
-                elif loadNonstandardTags:
-                    row=otherwaytagcursor.newrow()
-                    row.Way_ID = long(way[0])
-                    row.Tag_Name=str(key)
-                    row.Tag_Value=str(value.encode('utf-8'))
-                    otherwaytagcursor.insertrow(row)
-                    waytagcount+=1
+                waytagcount+=1
                 
         elif element=='/node' and hasvalidtags and ftype == fieldType.node:
             #done with node lets load its shape
-            frow = nodecursor.newrow()
-            frow.setValue("Node_ID", long(node[0]))
-            frow.setValue("Version", node[3])
-            frow.setValue("Timestamp", node[4])
-            frow.setValue("User_ID", long(node[5]))
-            frow.setValue("User", node[6].encode('utf-8'))
-            frow.setValue("Changeset", long(node[7]))
-            
-            # Initialize standard fields to empty
-            for f in standardFields:
-                frow.setValue(f, '')
-                
-            # Fill in standard fields
-            for sTag in ftags:
-                frow.setValue(sTag[0], str(sTag[1]))
-                
-            # Create the geometry
-            nodepnt.x = float(node[1])
-            nodepnt.y = float(node[2])
-            frow.SetValue('shape', nodepnt)
-            
-            nodecursor.insertrow(frow)
+            (tagvalues, others) = nodemap.map(ftags)
+            nodeid = int(node[0])
+            writer.write("nodes", (float(node[1]), float(node[2])),
+                         (nodeid, int(node[3]), node_ts, int(node[5]), node[6], int(node[7]))
+                         + tagvalues)
+
+            #tags without a column
+            if loadNonstandardTags and others:
+                writer.write_rows("other_node_tags", [(nodeid, k, v) for (k, v) in others])
             
             taggednodecount += 1
-            hasvalidtags = False
-            
-        elif element=='/way' and hasvalidtags:
-            #done with way lets load tags in waytags
-            if len(ftags) > 0:
-                                
-                trow=waytagcursor.newrow()
-                trow.SetValue("Way_ID",long(way[0]))
-                
-                for f in standardFields:
-                    trow.setValue(f, '')
-                    
-                for sTag in ftags:
-                    trow.setValue(sTag[0], str(sTag[1].encode('utf-8')))
-                    
-                waytagcursor.insertrow(trow)
-            hasvalidtags=False
+
+        elif element=='/way':
+            #done with way, save its header and mapped tags for step 3
+            (tagvalues, others) = waymap.map(ftags)
+            wayheaders.add((int(way[0]), way[1], way_ts, way[3], way[5], wayseq, way[4],
+                            json.dumps(tagvalues)))
+
+            #tags without a column
+            if loadNonstandardTags and others:
+                wayid = int(way[0])
+                writer.write_rows("other_way_tags", [(wayid, k, v) for (k, v) in others])
+
+        elif element=='/relation' and ftype == fieldType.relation:
+            #done with relation, keep it for step 3 if it's a multipolygon
+            reltype = dict(ftags).get('type', '')
+            if reltype in MULTIPOLYGON_TYPES and relmembers:
+                relnum += 1
+                (tagvalues, _) = relmap.map(ftags)
+                relheaders.add((int(rel[0]), reltype, rel[1], rel_ts, rel[3], rel[5],
+                                len(relmembers), rel[4], json.dumps(tagvalues)))
+                for (seq, ref) in enumerate(relmembers):
+                    membersorter.add((ref, relnum, seq))
+                    memberids.append(ref)
+            ftype = fieldType.unknown
         
         # if element==...
                
     AddMsgAndPrint( str(nodecount) +' Vertices   ' +str(taggednodecount)+'  Nodes    '+str(waycount)+' Ways')
 
-    AddMsgAndPrint( 'Bytes read from OSM file: ' + str(osmFile.getBytesRead()))
+    AddMsgAndPrint( 'Bytes read from OSM file: ' + str(osmFile.get_bytes_read()))
 
     #Close files that were written to.
-    nodefile.close() 
-    #unbuiltsegments.close()
-    unbuiltways.close()   
+    wayheaders.close()
+    relheaders.close()
 
     del osmFile
 
-    # Clean up GP objects
-    del nodepnt
-    del waytagcursor
-    del othernodetagcursor
-    del otherwaytagcursor
-    del nodecursor
-
-except Exception, ErrorDesc:
-    AddMsgAndPrint("dd : " + str(ErrorDesc), 2)
-    print gp.GetMessages()
-    nodefile.close()
-    unbuiltways.close()
+    # Member way ids, for picking member ways out in step 3
+    memberids = array('q', sorted(set(memberids)))
+
+except Exception as ErrorDesc:
+    AddMsgAndPrint("Step 2 Failed : " + str(ErrorDesc), 2)
+    if wayheaders is not None:
+        wayheaders.close()
+    if relheaders is not None:
+        relheaders.close()
     del osmFile
-    
-    del nodepnt
-    del waytagcursor
-    del othernodetagcursor
-    del otherwaytagcursor
-    del nodecursor
 
-    del gp
     sys.exit(-2)
 
 
@@ -534,199 +570,193 @@ except Exception, ErrorDesc:
 # Step 3: Process Ways
 #
 try:
-    AddMsgAndPrint("Step 3/5: Assembling Ways from nodes")
-    nodes={}
-    waycursor=gp.insertcursor(wayfc)
-    areawaycursor=gp.insertcursor(areawayfc)
-    completedways = 0
-    wayshape = gp.createobject("Array")
-    waypartpnts = gp.createobject("Array")
-    waypart = gp.createobject("Array")
-    apnt = gp.createobject("point")
-    counter=0
-
-    for fs in range(1,blocknum+1):
-        if compress_temp_files:
-            nodefile=bz2.BZ2File(scratchSpace+'/nodeblock'+str(fs)+'.dat','r')
-        else:
-            nodefile=open(scratchSpace+'/nodeblock'+str(fs)+'.dat','r')
-            
-        AddMsgAndPrint('Loading Block ' +str(fs))
-
-        #add nodes to a dictionary
-        for node in nodefile:
-            snode = node.rstrip('\n').split(sep)
-            # 0 - Node_ID, 1 = long, 2 = lat
-            nodes[snode[0]] = (snode[1], snode[2])
-            
-        nodefile.close()
-        
-        AddMsgAndPrint('Searching Block ' +str(fs))
-        if compress_temp_files:
-            unbuiltways=bz2.BZ2File(scratchSpace+'/unbuiltways.dat','r')
-            stillunbuiltways=bz2.BZ2File(scratchSpace+'/stillunbuiltways.dat','w')
-        else:
-            unbuiltways=open(scratchSpace+'/unbuiltways.dat','r')
-            stillunbuiltways=open(scratchSpace+'/stillunbuiltways.dat','w')
-            
-        for way in unbuiltways:
-            wayitems = way.rstrip('\n').rstrip(sep).split(sep2)
-            
-            if len(wayitems) != 2:
-                continue
-
-            subway = wayitems[0] + sep2
-            wayfields = wayitems[0].split(sep)
-            waynodes = wayitems[1].split(sep)
-            wayid = wayfields[0]
-            
-            isAllComplete=True
-            
-            for nd in waynodes:
-                # Is this node already turned into lat/long pair?
-                if nd.count(' ') > 0:
-                    subway = subway + nd + sep
-                    
-                # Is this node in our node list? Get the lat/long for the node
-                elif nodes.has_key(nd):
-                    subway = subway + (nodes[nd])[0] + ' ' + (nodes[nd])[1] + sep
-                    
-                # Node is not in the list, need to save it for "stillunbuiltways"
-                else:
-                    isAllComplete=False
-                    subway = subway + nd + sep
-
-            # We've tracked down all the nodes, now we can build the way/polyline
-            if isAllComplete:
-                row=waycursor.newrow()
-                row.SetValue("way_id",wayfields[0])
-                row.setValue("Version", wayfields[1])
-                row.setValue("Timestamp", wayfields[2])
-                row.setValue("User_ID", long(wayfields[3]))
-                row.setValue("User", wayfields[4].encode('utf-8'))
-                row.setValue("Changeset", long(wayfields[5]))
-
-                waypartpnts.RemoveAll()
-
-                finalnodes = subway.split(sep2)[1].split(sep)
-                
-                # Build the way geometry
-                for waypoints in finalnodes:
-                    partcoords=waypoints.split(' ')
-                    
-                    if len(partcoords) == 2:
-                        apnt.x = partcoords[0]
-                        apnt.y = partcoords[1]
-                        waypartpnts.add(apnt)           
-                        
-                wayshape.add(waypartpnts)
-                row.setValue("shape",wayshape)
-                
-                waycursor.insertrow(row)
-                
-                if wayshape.count == 1: #Is it an Area as well?
-                    waypart=wayshape.GetObject(0)
-                    sp = waypart.getobject(0)
-                    ep = waypart.getobject(waypart.count-1)
-                    if sp.x==ep.x and sp.y==ep.y:
-                        arow=areawaycursor.newrow()
-                        arow.SetValue("way_id",wayfields[0])
-                        arow.setValue("Version", wayfields[1])
-                        arow.setValue("Timestamp", wayfields[2])
-                        arow.setValue("User_ID", long(wayfields[3]))
-                        arow.setValue("User", wayfields[4])
-                        arow.setValue("Changeset", long(wayfields[5]))
-                        arow.SetValue("shape",waypart)
-                        areawaycursor.insertrow(arow)
-                        waypart.RemoveAll()
-                        
-                wayshape.RemoveAll()
-                waypartpnts.RemoveAll()
-                completedways +=1
-            else:
-                stillunbuiltways.write(subway + '\n')
-            
-        # for way in unbuiltways:
- 
-        AddMsgAndPrint("Loaded Ways=" + str(completedways))
-        nodes.clear()
-    
-        unbuiltways.close()
-        stillunbuiltways.close()
-        os.remove(scratchSpace+'/unbuiltways.dat')
-        os.rename(scratchSpace+'/stillunbuiltways.dat',scratchSpace+'/unbuiltways.dat')
-
-    # for fs in range(1,blocknum+1):
-
-    del apnt
-    del waypart
-    del waypartpnts
-    del wayshape
-    del areawaycursor
-    del waycursor
-
-    
-except Exception, ErrorDesc:
-    AddMsgAndPrint("Step 3 Failed", 2)
-    print gp.GetMessages()
+    AddMsgAndPrint("Step 3/4: Assembling Ways from nodes")
+
+    #
+    # 3a: Merge join way node references against node coordinates, both
+    #     sorted by node id. With duplicate node ids (history) the last one
+    #     in input order wins, which is the last one in sort order too.
+    #
+    #     Already done in step 2 when using a node location store.
+    #
+    if nodestore is None:
+        AddMsgAndPrint("Resolving " + str(waynodesorter.count) + " way node references")
+
+        nodestream = nodesorter.sorted()
+        curnode = next(nodestream, None)
+        nextnode = next(nodestream, None)
+
+        for (nd, waynum, seq) in waynodesorter.sorted():
+            while curnode is not None and (curnode[0] < nd or
+                                           (nextnode is not None and nextnode[0] == curnode[0])):
+                curnode = nextnode
+                nextnode = next(nodestream, None)
+
+            if curnode is not None and curnode[0] == nd:
+                resolvedsorter.add((waynum, seq, curnode[2], curnode[3]))
+
+        nodesorter.cleanup()
+        waynodesorter.cleanup()
+    else:
+        nodestore.close()
+        if options.locations == 'dense' and delete_temp_files:
+            os.remove(scratchSpace+'/nodes.dense')
+
+    #
+    # 3b: Read the resolved coordinates back in (way number, sequence) order,
+    #     in step with the way headers, and build the ways.
+    #
+    AddMsgAndPrint("Building ways")
+
+    # Geometry is encoded by the worker pool in batches, written here in order
+    waybuilder = WayBuilder(writer, "ways", "area_ways", workers, options.batch)
+    unbuiltways = 0
+
+    resolved = resolvedsorter.sorted()
+    pending = next(resolved, None)
+
+    for (waynum, wayfields) in enumerate(read_run(scratchSpace+'/wayheaders.dat',
+                                                  wayheader_fields)):
+        nodecount_way = wayfields[5]
+
+        coords = array('d')
+        while pending is not None and pending[0] == waynum:
+            coords.append(pending[2])
+            coords.append(pending[3])
+            pending = next(resolved, None)
+
+        # Only build ways where we tracked down all the nodes
+        if len(coords) != 2 * nodecount_way or nodecount_way < 2:
+            unbuiltways += 1
+            continue
+
+        values = ((wayfields[0], int(wayfields[1]), wayfields[2], int(wayfields[3]),
+                   wayfields[6], int(wayfields[4])) + tuple(json.loads(wayfields[7])))
+
+        # Areas (closed ways) are found by the builder too
+        waybuilder.add(values, coords)
+
+        # Keep the coordinates of multipolygon member ways
+        pos = bisect_left(memberids, wayfields[0])
+        if pos < len(memberids) and memberids[pos] == wayfields[0]:
+            for i in range(0, len(coords), 2):
+                memberwaysorter.add((wayfields[0], waynum, i, coords[i], coords[i + 1]))
+
+        if (waynum + 1) % 500000 == 0:
+            AddMsgAndPrint("Queued Ways=" + str(waynum + 1 - unbuiltways))
+
+    # for waynum, wayfields in wayheaders:
+
+    waybuilder.close()
+
+    AddMsgAndPrint("Loaded Ways=" + str(waybuilder.ways) + "  Areas=" + str(waybuilder.areas)
+                   + "  Incomplete Ways=" + str(unbuiltways))
+
+    resolvedsorter.cleanup()
+    if delete_temp_files:
+        os.remove(scratchSpace+'/wayheaders.dat')
+
+    #
+    # 3c: Join member references against member way coordinates on way id.
+    #     With duplicate way ids (history) the last one in input order wins.
+    #
+    AddMsgAndPrint("Resolving " + str(membersorter.count) + " multipolygon members")
+
+    memberways = memberwaysorter.sorted()
+    pending = next(memberways, None)
+
+    member_coords = []
+    member_way = None
+    for (ref, relnum, seq) in membersorter.sorted():
+        if ref != member_way:
+            member_way = ref
+            member_coords = []
+            while pending is not None and pending[0] < ref:
+                pending = next(memberways, None)
+            while pending is not None and pending[0] == ref:
+                if member_coords and pending[1] != member_coords[0][0]:
+                    member_coords = []
+                member_coords.append((pending[1], pending[2], pending[3], pending[4]))
+                pending = next(memberways, None)
+
+        for (_, point, lon, lat) in member_coords:
+            relcoordsorter.add((relnum, seq, point, lon, lat))
+
+    membersorter.cleanup()
+    memberwaysorter.cleanup()
+
+    #
+    # 3d: Assemble the relations, reading their member coordinates back in
+    #     (relation number, sequence) order in step with the headers.
+    #
+    AddMsgAndPrint("Building multipolygons")
+
+    completedrels = 0
+    unbuiltrels = 0
+
+    relcoords = relcoordsorter.sorted()
+    pending = next(relcoords, None)
+
+    for (relnum, relfields) in enumerate(read_run(scratchSpace+'/relheaders.dat',
+                                                  relheader_fields)):
+        members = {}
+        while pending is not None and pending[0] == relnum:
+            members.setdefault(pending[1], array('d')).extend((pending[3], pending[4]))
+            pending = next(relcoords, None)
+
+        # Only build relations where we tracked down all the member ways
+        polygons = []
+        if len(members) == relfields[6]:
+            polygons = assemble_multipolygon([members[seq] for seq in sorted(members)])
+
+        if not polygons:
+            unbuiltrels += 1
+            continue
+
+        writer.write("multipolygons", polygons,
+                     (relfields[0], relfields[1], int(relfields[2]), relfields[3],
+                      int(relfields[4]), relfields[7], int(relfields[5]))
+                     + tuple(json.loads(relfields[8])))
+        completedrels += 1
+
+    AddMsgAndPrint("Loaded Multipolygons=" + str(completedrels)
+                   + "  Incomplete Multipolygons=" + str(unbuiltrels))
+
+    relcoordsorter.cleanup()
+    if delete_temp_files:
+        os.remove(scratchSpace+'/relheaders.dat')
+
+except Exception as ErrorDesc:
+    AddMsgAndPrint("Step 3 Failed : " + str(ErrorDesc), 2)
     
     # Cleanup on Error
-    del apnt
-    del waypart
-    del waypartpnts
-    del wayshape
-    del areawaycursor
-    del waycursor
-    
-    nodefile.close
-    unbuiltways.close
-    
+    nodesorter.cleanup()
+    waynodesorter.cleanup()
+    resolvedsorter.cleanup()
+    membersorter.cleanup()
+    memberwaysorter.cleanup()
+    relcoordsorter.cleanup()
     
-    del gp
     sys.exit(-3)
 
 #
-# Step 4: Build indeces and import into FGDB
+# Step 4: Build indexes and close the output
 #
 try:
-    AddMsgAndPrint("Step 4/5: Building Indexes")
+    AddMsgAndPrint("Step 4/4: Building Indexes")
 
-    gp.addspatialindex(nodefc,0.5)
-    gp.AddIndex(waytagtab,"Way_ID","Way_Idx","UNIQUE","#")
-    gp.AddIndex(nodeothertag,"Node_ID","Node_Idx","NON_UNIQUE","#")
-    gp.AddIndex(wayothertag,"Way_ID","Way_Idx","NON_UNIQUE","#")
+    writer.create_index("nodes", "Node_ID")
+    writer.create_index("ways", "Way_ID")
+    writer.create_index("area_ways", "Way_ID")
+    writer.create_index("other_node_tags", "Node_ID")
+    writer.create_index("other_way_tags", "Way_ID")
+    writer.create_index("multipolygons", "Relation_ID")
 
-except Exception, ErrorDesc:
+    writer.close()
+
+except Exception as ErrorDesc:
     AddMsgAndPrint("Step 4 Failed : " + str(ErrorDesc), 2)
-    print gp.GetMessages()
-    del gp
     sys.exit(-4)
 
-#
-# Step 5: Join attributes
-#
-try:
-    AddMsgAndPrint("Step 5/5: Joining attributes to way features")
-    gp.MakeFeatureLayer_management(wayfc, "tempway", "", "", "Shape_Length Shape_Length VISIBLE;Way_ID Way_ID VISIBLE")
-    gp.AddJoin_management("tempway", "Way_ID", waytagtab, "Way_ID", "KEEP_ALL")
-    gp.CopyFeatures_management("tempway", finalwayfc, "", "0.05", "0.5", "5.0")
-    gp.delete_management("tempway")
-    gp.delete_management(wayfc)
-
-    AddMsgAndPrint("Joining attributes to area features")
-    gp.MakeFeatureLayer_management(areawayfc, "temparea", "", "", "Shape_Length Shape_Length VISIBLE;Way_ID Way_ID VISIBLE")
-    gp.AddJoin_management("temparea", "Way_ID", waytagtab, "Way_ID", "KEEP_ALL")
-    gp.CopyFeatures_management("temparea", finalareawayfc, "", "0.05", "0.5", "5.0")
-    gp.delete_management("temparea")
-    gp.delete_management(areawayfc)
-    gp.delete_management(waytagtab)
-
-except Exception, ErrorDesc:
-    AddMsgAndPrint("Step 5 Failed : " + str(ErrorDesc), 2)
-    print gp.GetMessages()
-    del gp
-    sys.exit(-5)
-
 AddMsgAndPrint("Conversion Completed")    
 AddMsgAndPrint(str(nodecount) +' Nodes    '+str(waycount)+' Ways')
-del gp
@@ -1,408 +1,807 @@
 # ---------------------------------------------------------------------------
 # osm2sqlite.py
 #
-# First pass based on osm_fpextract.py
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=W0511 # Fixme
+# pylint: disable=R0902
+# pylint: disable=R0903
+# pylint: disable=R0912 # Too many branches
+# pylint: disable=R0914 # Too many locals
+# pylint: disable=R0915 # Too many statements
 #
-# Extracts a BBOX footprint and timeframe from a full planet file. Like
-# Frederick Ramm's history-extract.pl except that it works against the
-# compressed .bz2, compressed .gz, or OSM XML. And It doesn't care about
-# end-of-lines.
+# Loads an OSM XML file (.osm, .bz2 or .gz) into the sqlite3 schema in
+# create_database.sql. Like osm_fpextract.py it can limit the load to a
+# BBOX footprint and timeframe, and it doesn't care about end-of-lines.
 #
-# Writes to an sqlite3 database
+# One pass. Planet files are sorted nodes, ways, relations so:
+#   Nodes
+#     - Keep nodes in BBOX, timeframe
+#     - Remember where each kept node is (node location store, -L - see
+#       osm_nodestore.py)
+#   Ways
+#     - Keep ways having at least one kept node
+#     - Build the way's LineString/Polygon from the node lookup and write it
+#       as WKB, with its bbox, to way_geometry
+#   Relations
+#     - Keep relations having at least one kept node or way member
 #
-# Uses multiple passes to get everything. Ways and relations are resolved fully
-# but, for obvious reasons if you think about it, changesets are not. That is,
-# you don't get everything in every changeset.
+# Way geometry encoding runs in a pool of worker processes (-j). The main
+# process resolves node locations and inserts; the workers turn coordinate
+# arrays into WKB. Readers get a way's geometry from way_geometry with a
+# single primary key lookup instead of joining way_nodes to nodes.
 #
-# Pass 1:
-#   Scan through all nodes,
-#     - Make a list of nodes in BBOX, timeframe
-#     - Note changesets for each node
-#   Scan through all ways
-#     - Make a list of ways having at least one node in list
-#     - Note changesets for each way
-#   Scan through all relations
-#     - Make a list of relations having at least one node or way in lists
-#     - Note changesets for each relation
+# With -N the output is split across N shard databases (name.shardNN.sqlite),
+# partitioned by id range or by spatial tile. The input is parsed once, in
+# this process, which also keeps the one node location store; the rows
+# (and way coordinates) of every object go to the process writing its
+# shard, which inserts them and builds the way geometry. OsmQuery's
+# ShardedQuery reads the shards back as one.
 #
-# Pass 2:
-#   Copy listed changesets to new file
-#   Copy listed nodes to new file
-#   Copy listed ways to new file
-#   Copy listed relations to new file
-#
-# Of course, all tags for each object are also copied.
-#
-# Since this is designed to work with historical data, it tends to grab more
-# than it needs. Specifically, old, deleted nodes will cause ways and relations
-# to be included (etc.). It does not thoroughly resolve relations because that
-# could get out of hand. And as mentioned, it doesn't even try to resolve
-# changesets.
+# With history files, later versions of an object replace earlier ones
+# and deleted versions remove the object, so the database ends up holding
+# the state of the data at the end of the timeframe.
 #
+# The input can also be an osm_chunker.py manifest (-i full-planet-manifest.json):
+# only the chunks that overlap the bbox and timeframe are read, so of a
+# time bucketed (osm_chunker.py -t) history only the buckets in the
+# timeframe are opened.
 #
 # ---------------------------------------------------------------------------
 #   Name:       osm2sqlite.py
-#   Version:    1.0
+#   Version:    2.0
 #   Authored    By: Erica Wolf
 #   Copyright:  Public Domain.
 # ---------------------------------------------------------------------------
 
 # Command line parameters - these help be do test runs in PythonWin.
 #
-# D:\GNIS_OSM\rhode_island.osm.bz2 -72 -71 42 41
-# D:\GNIS_OSM\djibouti.osm.bz2 42.7 42.8 11.6 11.5
-# D:\GNIS_OSM\full-planet-110115-1800.osm.bz2 -72 -71 42 41
-#
-# Hawaii - just Oahu
-# -i hawaii.osm.bz2 -l -158.29 -r -157.661 -t 21.73 -b 21.2 -e 2009-01-01
-# -i test.osm -l -158.29 -r -157.661 -t 21.73 -b 21.2 -e 2009-01-01
+# -i hawaii.osm.bz2 -o hawaii.sqlite -l -158.29 -r -157.661 -t 21.73 -b 21.2 -e 2009-01-01
+# -i test.osm -o test.sqlite -x
+# -i planet.osm.bz2 -o planet.sqlite -N 8 -p tile
 
 # Import modules
 from optparse import OptionParser, OptionGroup
-from osm_reader import OsmReaderReader
 from datetime import date
+import multiprocessing
+import os
+import sqlite3
 import sys
 import time
 
+from osm_chunker import ManifestReader
+from osm_reader import OsmReader, ObjTypes
+from osm_geometry import build_way_geometry, hilbert_key, is_area
+from osm_nodestore import open_node_store
 
-class objTypes:
-    (nul, node, way, relation, changeset, eof) = range(0, 6)
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_database.sql')
 
+MEMBER_TYPES = {ObjTypes.node: 'node', ObjTypes.way: 'way', ObjTypes.relation: 'relation'}
 
-parser = OptionParser()
+# Object type -> its entry in the load counts
+TYPE_COUNTS = {ObjTypes.node: 'nodes', ObjTypes.way: 'ways', ObjTypes.relation: 'relations'}
 
-parser.add_option('-i', '--input', dest='filename',
-                  help="OSM XML file to read extract from", metavar="FILE")
 
-bbox_group = OptionGroup(parser, "Bounding Box (Decimal Degrees)")
-bbox_group.add_option('-l', '--left', dest='left',
-                      type='float', default='-180.0')
-bbox_group.add_option('-r', '--right', dest='right',
-                      type='float', default='180.0')
-bbox_group.add_option('-t', '--top', dest='top',
-                      type='float', default='90.0')
-bbox_group.add_option('-b', '--bottom', dest='bottom',
-                      type='float', default='-90.0')
+# ---------------------------------------------------------------------------
+# Open (and create if needed) the database
+# ---------------------------------------------------------------------------
+def open_database(dbname):
+    conn = sqlite3.connect(dbname)
 
-parser.add_option_group(bbox_group)
+    cur = conn.execute("select name from sqlite_master where type='table' and name='nodes'")
+    if cur.fetchone() is None:
+        with open(SCHEMA_FILE, encoding='utf-8') as f:
+            conn.executescript(f.read())
 
-tframe_group = OptionGroup(parser, "Time Frame (YYYY-MM-DD)")
-tframe_group.add_option('-s', '--start', dest='start', default='2000-01-01')
-tframe_group.add_option('-e', '--end', dest='end', default='2100-01-01')
-parser.add_option_group(tframe_group)
+    return conn
 
-parser.add_option('-H', '--history', dest='history', action="store_true", default=False,
-                  help="Output all versions, not just current version.")
 
-parser.add_option('-c', '--changesets', dest='changesets', action="store_true", default=False,
-                  help="Output changesets.")
+# ---------------------------------------------------------------------------
+# Bulk load settings - the file is being written from scratch, so
+# durability during the load doesn't matter.
+# ---------------------------------------------------------------------------
+def set_bulk_pragmas(conn):
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    conn.execute("PRAGMA temp_store = MEMORY")
 
-parser.add_option('-R', '--resolve', dest='resolve', action="store_false", default=True,
-                  help="DO NOT resolve ways and relations that extend past bbox (default is to resolve).")
 
-parser.add_option('-x', '--stats', dest='showstats', action="store_true", default=False,
-                  help="Show processing/debugging statistics.")
+# ---------------------------------------------------------------------------
+# GeometryBuilder
+#
+# Queues (way_id, coords, area) items and turns them into way_geometry rows
+# in a process pool, one batch in flight while the next is filling up.
+# With workers == 0 the geometry is built inline.
+# ---------------------------------------------------------------------------
+class GeometryBuilder:
+    def __init__(self, conn, workers, batch_size):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.batch = []
+        self.job = None
+        self.count = 0
+        self.workers = workers
+
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers)
+        else:
+            self.pool = None
 
+    def add(self, way_id, coords, area):
+        self.batch.append((way_id, coords, area))
 
-(options, args) = parser.parse_args(args=None, values=None)
+        if len(self.batch) >= self.batch_size:
+            self.submit()
 
-inFile = options.filename
-bbox_left = options.left
-bbox_right = options.right
-bbox_top = options.top
-bbox_bottom = options.bottom
-start_date = options.start
-end_date = options.end
+    def submit(self):
+        batch = self.batch
+        self.batch = []
 
-output_history = options.history
-output_changesets = options.changesets
-resolve = options.resolve
+        if self.pool is None:
+            self.write(map(build_way_geometry, batch))
+            return
 
-start = time.clock()
+        chunk = max(1, len(batch) // (4 * self.workers))
+        job = self.pool.map_async(build_way_geometry, batch, chunk)
 
+        # Keep one batch in flight: write the previous one while this one builds
+        self.wait()
+        self.job = job
 
-(year, month, day) = start_date.split('-')
-start_date = date(int(year), int(month), int(day))
+    def wait(self):
+        if self.job is not None:
+            self.write(self.job.get())
+            self.job = None
 
-(year, month, day) = end_date.split('-')
-end_date = date(int(year), int(month), int(day))
+    def write(self, rows):
+        rows = [row for row in rows if row is not None]
+        self.conn.executemany("insert or replace into way_geometry "
+                              "(way_id, min_lon, min_lat, max_lon, max_lat, geom) "
+                              "values (?, ?, ?, ?, ?, ?)", rows)
+        self.count += len(rows)
 
-if start_date > end_date:
-    print("End date must be greater than start date\n\n")
-    sys.exit(-1)
+    def flush(self):
+        if self.batch:
+            self.submit()
+        self.wait()
 
-# Show stats just does the first pass and gives stats on the data
-show_stats = options.showstats
+    def close(self):
+        self.flush()
 
-node_list = set()
-way_list = set()
-relation_list = set()
-changeset_list = set()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
-node_ver_dict = {}
-way_ver_list = []
-rel_ver_list = []
 
-relation_ways = set()
-relation_nodes = set()
+# ---------------------------------------------------------------------------
+# Remove an object and everything hanging off of it
+# ---------------------------------------------------------------------------
+def delete_object(conn, obj_type, obj_id):
+    if obj_type == ObjTypes.node:
+        conn.execute("delete from node_tags where node_id = ?", (obj_id,))
+        conn.execute("delete from nodes where id = ?", (obj_id,))
+    elif obj_type == ObjTypes.way:
+        conn.execute("delete from way_tags where way_id = ?", (obj_id,))
+        conn.execute("delete from way_nodes where way_id = ?", (obj_id,))
+        conn.execute("delete from way_geometry where way_id = ?", (obj_id,))
+        conn.execute("delete from ways where id = ?", (obj_id,))
+    elif obj_type == ObjTypes.relation:
+        conn.execute("delete from relation_tags where relation_id = ?", (obj_id,))
+        conn.execute("delete from relation_members where relation_id = ?", (obj_id,))
+        conn.execute("delete from relations where id = ?", (obj_id,))
+
 
+# ---------------------------------------------------------------------------
+# Row batches
 #
-# Processing flags
+# load() collects the rows of batch_size objects per table and hands them
+# to a TableWriter (one database) or a ShardRouter (-N shard databases),
+# which have the same interface:
 #
+#   rows = out.rows(shard)          # table -> list of rows
+#   out.add_geometry(shard, way_id, coords, area)
+#   out.flush()                     # insert what's collected
+#   out.delete(obj_type, obj_id)    # older version of a history object
+#   out.close()                     # -> way geometries built, per shard
+# ---------------------------------------------------------------------------
+INSERT_SQL = {
+    'nodes': "insert or replace into nodes (id, timestamp, user, lat, lon) "
+             "values (?, ?, ?, ?, ?)",
+    'node_tags': "insert or ignore into node_tags (node_id, key, value) values (?, ?, ?)",
+    'ways': "insert or replace into ways (id, timestamp, user) values (?, ?, ?)",
+    'way_tags': "insert or ignore into way_tags (way_id, key, value) values (?, ?, ?)",
+    'way_nodes': "insert or ignore into way_nodes (way_id, local_order, node_id) "
+                 "values (?, ?, ?)",
+    'relations': "insert or replace into relations (id, timestamp, user) values (?, ?, ?)",
+    'relation_tags': "insert or ignore into relation_tags (relation_id, key, value) "
+                     "values (?, ?, ?)",
+    'relation_members': "insert into relation_members "
+                        "(relation_id, type, ref, role, local_order) values (?, ?, ?, ?, ?)",
+}
+
+
+def new_rows():
+    return {table: [] for table in INSERT_SQL}
+
+
+class TableWriter:
+    shards = 1
+    partition = 'id'
+    bounds = None
+
+    def __init__(self, conn, workers, batch_size):
+        self.conn = conn
+        self.pending = new_rows()
+        self.geometry = GeometryBuilder(conn, workers, batch_size)
+
+    def rows(self, _shard):
+        return self.pending
+
+    def add_geometry(self, _shard, way_id, coords, area):
+        self.geometry.add(way_id, coords, area)
+
+    def insert(self, rows):
+        for (table, table_rows) in rows.items():
+            self.conn.executemany(INSERT_SQL[table], table_rows)
+
+    def flush(self):
+        self.insert(self.pending)
+        self.pending = new_rows()
+
+    def delete(self, obj_type, obj_id):
+        self.flush()
+        if obj_type == ObjTypes.way:
+            self.geometry.flush()
+            # The older version's geometry is no longer built
+            self.geometry.count -= self.conn.execute(
+                "select count(*) from way_geometry where way_id = ?", (obj_id,)).fetchone()[0]
+        delete_object(self.conn, obj_type, obj_id)
+
+    def close(self):
+        self.flush()
+        self.geometry.close()
+        self.conn.commit()
+        return [self.geometry.count]
 
-# Enable/disable the use of bz2 compression for temp files
-useBZ2_temp_files = False
 
-# Enable/disable deleting temp files (for debugging)
-delete_temp_files = False
+# ---------------------------------------------------------------------------
+# Sharding
+#
+# id:   objects are dealt out in blocks of SHARD_ID_BLOCK ids, round robin,
+#       so every shard gets a share of every id range.
+# tile: a 2^SHARD_TILE_ORDER grid is laid over the load's bbox (the world
+#       without one) and its cells are numbered in Hilbert order; runs of
+#       SHARD_TILE_RUN consecutive cells (8x8 blocks, ~0.04 degrees over the
+#       world) are dealt out round robin. Nodes go to the shard of their
+#       cell, ways go with their first node. Even a city sized extract
+#       covers enough blocks to come out balanced - give its bbox
+#       (-l -r -t -b) and the blocks get smaller with it.
+#
+# Relations are split by id in both modes.
+# ---------------------------------------------------------------------------
+SHARD_ID_BLOCK = 1 << 16
+SHARD_TILE_ORDER = 16
+SHARD_TILE_RUN = 64
 
-min_node_id = 100000000
-max_node_id = 0
-min_way_node_id = 100000000
-max_way_node_id = 0
+WORLD = (-180.0, -90.0, 180.0, 90.0)
 
-obj_count = 0
 
+def shard_of_id(obj_id, shards):
+    return (obj_id // SHARD_ID_BLOCK) % shards
 
-#
-# Step 1: Scan input file, build lists
-#
-try:
-    # Input is maybe a very big file
-    inputfile = OsmReader(inFile)
 
-except:
-    print("Failed to initialize OsmReader")
-    exit(-1)
+def shard_of_location(lon, lat, shards, bounds=WORLD):
+    # lon/lat within bounds, stretched over the world grid hilbert_key uses
+    (left, bottom, right, top) = bounds
+    lon = (lon - left) / (right - left) * 360.0 - 180.0
+    lat = (lat - bottom) / (top - bottom) * 180.0 - 90.0
+    return (hilbert_key(lon, lat, SHARD_TILE_ORDER) // SHARD_TILE_RUN) % shards
 
-if show_stats:
-    print("Step 1: List nodes in BBOX")
 
-try:
-    # for uline in inputfile:
-    while True:
+def shard_name(dbname, index):
+    (root, ext) = os.path.splitext(dbname)
+    return "%s.shard%02d%s" % (root, index, ext or '.sqlite')
 
-        # Read one OSM XML object without depending on line breaks
-        # (so this works with history files)
-        inputfile.get_nextobject()
 
-        if inputfile.obj_type == ObjTypes.eof:
-            break
+def write_shard_info(conn, index, shards, partition, bounds=WORLD):
+    conn.execute("drop table if exists shard_info")
+    conn.execute("create table shard_info ("
+                 "shard INTEGER, shards INTEGER, partition TEXT, "
+                 "id_block INTEGER, tile_order INTEGER, tile_run INTEGER, "
+                 "min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL)")
+    conn.execute("insert into shard_info values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (index, shards, partition, SHARD_ID_BLOCK, SHARD_TILE_ORDER,
+                  SHARD_TILE_RUN) + tuple(bounds))
 
-        obj_count += 1
 
-        if (show_stats):
-            if (obj_count % 250000) == 0:
-                print("Processed " + str(obj_count) + " objects.")
+# ---------------------------------------------------------------------------
+# Shard writer process: applies the batches load() routes to one shard, in
+# order, and puts (shard, way geometries built, error) on results when the
+# None at the end comes. After an error it keeps taking batches (and
+# dropping them) so load() never blocks on a full queue.
+# ---------------------------------------------------------------------------
+SHARD_QUEUE = 4
 
-        # Is the node within the timestamp?
-        if (inputfile.objTimestamp < start_date or inputfile.objTimestamp > end_date):
-            continue
 
-        #
-        # Node
-        #
-        if inputfile.obj_type == ObjTypes.node:
-            if inputfile.obj_id > max_node_id:
-                max_node_id = inputfile.obj_id
+def shard_writer(dbname, shard, batch_size, jobs, results):
+    error = None
+    out = None
+    try:
+        conn = open_database(dbname)
+        set_bulk_pragmas(conn)
+        write_shard_info(conn, *shard)
+        out = TableWriter(conn, 0, batch_size)
+    except sqlite3.Error as Err:
+        error = "%s: %s" % (dbname, Err)
 
-            if inputfile.obj_id < min_node_id:
-                min_node_id = inputfile.obj_id
+    while True:
+        ops = jobs.get()
+        if ops is None:
+            break
+        if error is not None:
+            continue
 
-            # Is the node in the BBOX?
-            if inputfile.obj_lat < bbox_bottom or inputfile.obj_lat > bbox_top:
-                continue
+        try:
+            for op in ops:
+                if op[0] == 'rows':
+                    out.insert(op[1])
+                    for (way_id, coords, area) in op[2]:
+                        out.geometry.add(way_id, coords, area)
+                else:
+                    out.delete(op[1], op[2])
+        except sqlite3.Error as Err:
+            error = "%s: %s" % (dbname, Err)
 
-                # Is the node in the BBOX?
-            if inputfile.obj_long < bbox_left or inputfile.obj_long > bbox_right:
-                continue
+    count = 0
+    if error is None:
+        count = out.close()[0]
+        out.conn.close()
+    results.put((shard[0], count, error))
 
-            node_list.add(inputfile.obj_id)
 
-            changeset_list.add(inputfile.obj_changeset)
+# ---------------------------------------------------------------------------
+# ShardRouter - a TableWriter for N shard databases
+#
+# Rows are collected per shard and sent to the shard's writer process as a
+# list of operations, ('rows', rows, geometry) and ('delete', type, id), so
+# a history object's deletes happen in order with its rows. Deletes go to
+# every shard: an older version may have been written to another one (a
+# node that moved to another tile).
+# ---------------------------------------------------------------------------
+class ShardRouter:
+    def __init__(self, names, partition, batch_size, bounds=WORLD):
+        self.shards = len(names)
+        self.partition = partition
+        self.bounds = bounds
+        self.batch_size = batch_size
+        self.pending = [new_rows() for _ in names]
+        self.geometry = [[] for _ in names]
+        self.ops = [[] for _ in names]
+        self.results = multiprocessing.Queue()
+        self.queues = []
+        self.procs = []
+
+        for (index, name) in enumerate(names):
+            jobs = multiprocessing.Queue(SHARD_QUEUE)
+            proc = multiprocessing.Process(target=shard_writer,
+                                           args=(name, (index, self.shards, partition, bounds),
+                                                 batch_size, jobs, self.results),
+                                           daemon=True)
+            proc.start()
+            self.queues.append(jobs)
+            self.procs.append(proc)
+
+    def rows(self, shard):
+        return self.pending[shard]
+
+    def add_geometry(self, shard, way_id, coords, area):
+        self.geometry[shard].append((way_id, coords, area))
+
+    def queue_rows(self):
+        for shard in range(self.shards):
+            if self.geometry[shard] or any(self.pending[shard].values()):
+                self.ops[shard].append(('rows', self.pending[shard], self.geometry[shard]))
+                self.pending[shard] = new_rows()
+                self.geometry[shard] = []
+
+    def send(self):
+        for (jobs, ops) in zip(self.queues, self.ops):
+            if ops:
+                jobs.put(ops)
+        self.ops = [[] for _ in self.queues]
+
+    def flush(self):
+        self.queue_rows()
+        self.send()
+
+    def delete(self, obj_type, obj_id):
+        self.queue_rows()
+        for ops in self.ops:
+            ops.append(('delete', obj_type, obj_id))
+        if len(self.ops[0]) >= self.batch_size:
+            self.send()
+
+    def close(self):
+        self.flush()
+        for jobs in self.queues:
+            jobs.put(None)
+
+        counts = [0] * self.shards
+        errors = []
+        for _ in self.procs:
+            (shard, count, error) = self.results.get()
+            counts[shard] = count
+            if error is not None:
+                errors.append(error)
+        for proc in self.procs:
+            proc.join()
+
+        if errors:
+            raise sqlite3.Error("; ".join(errors))
+        return counts
 
-            # Save the highest version number
-            if not output_history:
-                node_ver_dict[inputfile.objID] = inputfile.objVersion
 
-        # Way
-        elif inputfile.obj_type == ObjTypes.way:
+# ---------------------------------------------------------------------------
+# Load an OSM file into N shard databases
+#
+# The input is parsed once, here, with one node location store (so way
+# geometry can use nodes owned by other shards), and every object's rows go
+# to the process writing its shard. PBF input is decoded in workers
+# processes; XML is parsed in this process, which is then what limits the
+# load however many shards there are. Returns the list of shard file names
+# and a list of per-shard counts.
+# ---------------------------------------------------------------------------
+def load_shards(in_file, dbname, shards, partition='id',
+                bbox=(-180.0, -90.0, 180.0, 90.0),
+                timeframe=(date(2000, 1, 1), date(2100, 1, 1)), batch_size=10000,
+                locations='sparse', show_stats=False, keep_nodes=False, workers=0):
+    names = [shard_name(dbname, i) for i in range(shards)]
 
-            # Does the way contain a node we are keeping?
-            for node_id in inputfile.obj_way_nodes:
-                if node_id in node_list:
-                    way_list.add(inputfile.obj_id)
+    node_store = open_location_store(dbname, locations)
+    out = ShardRouter(names, partition, batch_size, bbox)
+    try:
+        counts = load_objects(in_file, out, bbox, timeframe, batch_size, show_stats,
+                              node_store, workers)
+    finally:
+        close_location_store(dbname, locations, node_store, keep_nodes)
 
-                    changeset_list.add(inputfile.obj_changeset)
+    return (names, counts['shards'])
 
-                    # This adds nodes not in BBOX but part of way that intersects it
-                    # This really slows things down!
-                    # if resolve:
-                    #    node_list.update(inputfile.objWay_nodes)
 
-                    break
+# ---------------------------------------------------------------------------
+# Node location store for a load (see osm_nodestore.py)
+#
+# sparse - sorted arrays in memory, for extracts
+# dense  - memory-mapped file (dbname.nodes) indexed by node id, for planets;
+#          removed after the load unless keep is set
+# ---------------------------------------------------------------------------
+def open_location_store(dbname, locations):
+    if locations == 'dense':
+        return open_node_store(dbname + '.nodes', 'w', 'dense')
+    return open_node_store(None, 'w', 'sparse')
 
-        # Relation
-        elif inputfile.objType == objTypes.relation:
-            if not resolve:
-                continue
 
-            relation_list.add(inputfile.objID)
-            changeset_list.add(inputfile.objChangeset)
-            node_list.update(relation_nodes)
-            way_list.update(relation_ways)
+def close_location_store(dbname, locations, node_store, keep=False):
+    node_store.close()
+    if locations == 'dense' and not keep:
+        os.remove(dbname + '.nodes')
 
-    # while True:
 
-    if show_stats:
-        print('Bytes read from OSM file: ' + str(inputfile.getBytesRead()))
-        print('Objects processed: ' + str(obj_count))
+# ---------------------------------------------------------------------------
+# Load an OSM file (or the chunks of an osm_chunker.py manifest) into the
+# database
+#
+# bbox is (left, bottom, right, top), timeframe is (start_date, end_date).
+# node_store is where kept node locations go (in memory if not given).
+# Returns a dict of counts.
+# ---------------------------------------------------------------------------
+def load(in_file, conn, bbox=(-180.0, -90.0, 180.0, 90.0),
+         timeframe=(date(2000, 1, 1), date(2100, 1, 1)),
+         workers=0, batch_size=10000, show_stats=False, node_store=None):
+    set_bulk_pragmas(conn)
+    out = TableWriter(conn, workers, batch_size)
+    return load_objects(in_file, out, bbox, timeframe, batch_size, show_stats, node_store)
 
-        print("Changeset list count: " + str(len(changeset_list)))
-        print("Node list count: " + str(len(node_list)))
-        print("Way list count: " + str(len(way_list)))
-        print("Relation list count: " + str(len(relation_list)))
 
-    del inputfile
+# ---------------------------------------------------------------------------
+# The load itself, writing through out (a TableWriter or ShardRouter).
+# counts['shards'] has the nodes/ways/relations/geometries of every shard.
+# ---------------------------------------------------------------------------
+def load_objects(in_file, out, bbox, timeframe, batch_size, show_stats, node_store=None,
+                 workers=0):
+    (bbox_left, bbox_bottom, bbox_right, bbox_top) = bbox
+    (start_date, end_date) = timeframe
 
-except Exception, ErrorDesc:
-    print("Step 1 Failed : " + str(ErrorDesc)))
-    print("Line " + str(inputfile.line_count) + ":" + inputfile.getTag())
-    print("Bytes read: " + str(inputfile.getBytesRead()))
-    finish= time.clock()
-    print("Extract incomplete in " + str(finish - start) + " seconds.")
-    sys.exit(-2)
+    filter_bbox = bbox != (-180.0, -90.0, 180.0, 90.0)
 
-line_count= 0
+    shards = out.shards
+    partition = out.partition
 
-try:
-    # Input is maybe a very big file
-    inputfile= OSMReader(inFile)
+    # Node location lookup: where is every kept node
+    if node_store is None:
+        node_store = open_node_store(None, 'w', 'sparse')
 
-    # OSM XML Header stuff - made up as usual
-    print('<?xml version="1.0" encoding="UTF-8"?>')
-    # "2011-02-16T01:11:04Z"  "%Y-%m-%dT%H:%M:%SZ"
-    timestamp= time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    print('<osm version="0.6" generator="OSM_Extract.py" timestamp="' + timestamp + '">')
-    print('<!-- copyright="OpenStreetMap and contributors" attribution="http://www.openstreetmap.org/copyright/" license="http://creativecommons.org/licenses/by/2.0/" -->')
-    print('  <bound box="' + str(bbox_left) + ',' + str(bbox_bottom) + ',' + str(bbox_right) + \
-          ',' + str(bbox_top) + '> origin="http://www.openstreetmap.org/api/0.6" />')
+    # Only needed to decide which relations to keep when filtering by bbox
+    way_ids = set()
 
-    keep= False
+    counts = {'objects': 0, 'nodes': 0, 'ways': 0, 'relations': 0, 'geometries': 0}
+    shard_counts = [{'nodes': 0, 'ways': 0, 'relations': 0} for _ in range(shards)]
 
-    line_count= 0
+    last_type = ObjTypes.nul
+    last_id = -1
+    # Shard the last object was written to, None if it wasn't
+    last_owner = None
+    pending = 0
 
-    while True:
-        # Read one XML tag without depending on line breaks
-        # (so this works with history files)
-        line= inputfile.getNextTag()
+    start = time.perf_counter()
 
-        line_count += 1
+    if in_file.lower().endswith('.json'):
+        inputfile = ManifestReader(in_file, bbox if filter_bbox else None,
+                                   start_date.isoformat(), end_date.isoformat())
+    else:
+        inputfile = OsmReader(in_file, workers=workers)
 
-        if line == '':
-            break
+    for obj in inputfile.objects():
+        counts['objects'] += 1
 
-        if line[1] == '/':
-            element = line[1:line.find('>', 1)] # FIXME!
-        else:
-            element = line[1:line.find(' ', 1)]
+        if show_stats and (counts['objects'] % 250000) == 0:
+            print("Processed " + str(counts['objects']) + " objects.")
 
-        #
-        # Node
-        #
-        if element == 'node':
-            keep= False
-
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            node_id= int(line[s:e])
-
-            if node_id in node_list:
-                # Save the highest version number
-                if not output_history:
-                    s = line.find('version="', 4) + 9
-                    e = line.find('"', s)
-                    ver= int(line[s:e])
-                    if node_ver_dict[node_id] == ver:
-                        print("  " + line.encode("utf-8", "ignore"))
-                        if not line[-2] == '/':
-                            keep= True
-                else:
-                    print("  " + line.encode("utf-8", "ignore"))
-                    if not line[-2] == '/':
-                        keep= True
+        if obj.type == ObjTypes.changeset:
+            continue
 
+        # Is the object within the timeframe?
+        if obj.timestamp < start_date or obj.timestamp > end_date:
+            continue
 
-        #
-        # Way
-        #
-        elif element == 'way':
-            keep= False
+        # A newer version of the object we just loaded (history files):
+        # drop what the older version wrote before writing this one.
+        if obj.type == last_type and obj.id == last_id:
+            out.delete(obj.type, obj.id)
+            if obj.type == ObjTypes.node:
+                node_store.delete(obj.id)
 
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            way_id= int(line[s:e])
+            # and don't count it
+            if last_owner is not None:
+                counts[TYPE_COUNTS[obj.type]] -= 1
+                shard_counts[last_owner][TYPE_COUNTS[obj.type]] -= 1
 
-            if way_id in way_list:
-                print("  " + line.encode("utf-8", "ignore"))
-                keep= True
+        last_type = obj.type
+        last_id = obj.id
+        last_owner = None
+
+        if not obj.visible:
+            continue
 
         #
-        # Relation
+        # Node
         #
-        elif element == 'relation':
-            keep= False
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            rel_id= int(line[s:e])
+        if obj.type == ObjTypes.node:
+            # Is the node in the BBOX?
+            if obj.lat < bbox_bottom or obj.lat > bbox_top:
+                continue
 
-            if rel_id in relation_list:
-                print("  " + line.encode("utf-8", "ignore"))
-                keep= True
+            if obj.lon < bbox_left or obj.lon > bbox_right:
+                continue
 
-        #
-        # Changeset
-        #
-        elif element == 'changeset':
-            keep= False
+            node_store.set(obj.id, obj.lon, obj.lat)
+
+            owner = 0
+            if shards > 1:
+                if partition == 'tile':
+                    owner = shard_of_location(obj.lon, obj.lat, shards, out.bounds)
+                else:
+                    owner = shard_of_id(obj.id, shards)
 
-            s= line.find('id="', 5) + 4
-            e= line.find('"', s)
-            cs_id= int(line[s:e])
+            rows = out.rows(owner)
+            rows['nodes'].append((obj.id, obj.iso_timestamp, obj.user, obj.lat, obj.lon))
+            for (key, value) in obj.tags:
+                rows['node_tags'].append((obj.id, key, value))
 
-            if output_changesets and cs_id in changeset_list:
-                print("    " + line.encode("utf-8", "ignore"))
-                keep= True
+            counts['nodes'] += 1
+            shard_counts[owner]['nodes'] += 1
+            last_owner = owner
 
+        #
+        # Way
+        #
+        elif obj.type == ObjTypes.way:
+            coords = node_store.coords(obj.nodes)
 
-        elif element == 'tag' or element == 'nd' or element == 'member':
-            if keep:
-                print("    " + line.encode("utf-8", "ignore"))
+            # Does the way contain a node we are keeping?
+            if not coords:
+                continue
 
-        elif element == '/node' or element == '/way' or element == '/relation' or element == '/changeset':
-            if keep:
-                print("  " + line.encode("utf-8", "ignore"))
+            if filter_bbox:
+                way_ids.add(obj.id)
 
-            keep= False
+            # Ways go with their first node in tile mode
+            owner = 0
+            if shards > 1:
+                if partition == 'tile':
+                    owner = shard_of_location(coords[0], coords[1], shards, out.bounds)
+                else:
+                    owner = shard_of_id(obj.id, shards)
 
-        else:
-            if keep:
-                print("  " + line.encode("utf-8", "ignore"))
+            rows = out.rows(owner)
+            rows['ways'].append((obj.id, obj.iso_timestamp, obj.user))
+            for (key, value) in obj.tags:
+                rows['way_tags'].append((obj.id, key, value))
+            for (order, node_id) in enumerate(obj.nodes):
+                rows['way_nodes'].append((obj.id, order, node_id))
 
-    # While True:
+            # A way cut by the bbox is no longer closed, so it can't be an area
+            area = len(coords) == 2 * len(obj.nodes) and is_area(obj.nodes, obj.tags)
+            out.add_geometry(owner, obj.id, coords, area)
 
-    print('</osm>\n')
+            counts['ways'] += 1
+            shard_counts[owner]['ways'] += 1
+            last_owner = owner
 
-except Exception, ErrorDesc:
-    print("Step 2 Failed : " + str(ErrorDesc))
-    print("Line " + str(inputfile.line_count) + ":" + \
-          inputfile.getTag().encode("utf-8", "ignore"))
-    print("Bytes read: " + str(inputfile.getBytesRead()))
-    finish= time.clock()
-    print("Extract incomplete in " + str(finish - start) + " seconds.")
-    sys.exit(-2)
+        #
+        # Relation
+        #
+        elif obj.type == ObjTypes.relation:
+            if filter_bbox:
+                for (memtype, ref, _) in obj.members:
+                    if memtype == ObjTypes.node and ref in node_store:
+                        break
+                    if memtype == ObjTypes.way and ref in way_ids:
+                        break
+                else:
+                    continue
 
-finish= time.clock()
-if show_stats:
-    print("Extract complete in " + str(finish - start) + " seconds.")
+            owner = shard_of_id(obj.id, shards) if shards > 1 else 0
 
+            rows = out.rows(owner)
+            rows['relations'].append((obj.id, obj.iso_timestamp, obj.user))
+            for (key, value) in obj.tags:
+                rows['relation_tags'].append((obj.id, key, value))
+            for (order, (memtype, ref, role)) in enumerate(obj.members):
+                rows['relation_members'].append((obj.id, MEMBER_TYPES[memtype], ref, role,
+                                                 order))
+
+            counts['relations'] += 1
+            shard_counts[owner]['relations'] += 1
+            last_owner = owner
+
+        pending += 1
+        if pending >= batch_size:
+            out.flush()
+            pending = 0
+
+    geometries = out.close()
+    for (shard_count, count) in zip(shard_counts, geometries):
+        shard_count['geometries'] = count
+
+    counts['geometries'] = sum(geometries)
+    counts['shards'] = shard_counts
+    counts['bytes'] = inputfile.get_bytes_read()
+    counts['seconds'] = time.perf_counter() - start
+
+    return counts
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-i', '--input', dest='filename',
+                      help="OSM file (XML, .bz2, .gz, .pbf) or osm_chunker.py manifest to load",
+                      metavar="FILE")
+
+    parser.add_option('-o', '--output', dest='dbname',
+                      help="SQLite3 DB to write to", metavar="FILE")
+
+    bbox_group = OptionGroup(parser, "Bounding Box (Decimal Degrees)")
+    bbox_group.add_option('-l', '--left', dest='left',
+                          type='float', default='-180.0')
+    bbox_group.add_option('-r', '--right', dest='right',
+                          type='float', default='180.0')
+    bbox_group.add_option('-t', '--top', dest='top',
+                          type='float', default='90.0')
+    bbox_group.add_option('-b', '--bottom', dest='bottom',
+                          type='float', default='-90.0')
+
+    parser.add_option_group(bbox_group)
+
+    tframe_group = OptionGroup(parser, "Time Frame (YYYY-MM-DD)")
+    tframe_group.add_option('-s', '--start', dest='start', default='2000-01-01')
+    tframe_group.add_option('-e', '--end', dest='end', default='2100-01-01')
+    parser.add_option_group(tframe_group)
+
+    parser.add_option('-j', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count() - 1,
+                      help="Worker processes for building way geometry, or with -N for "
+                           "decoding PBF input (0 = none).")
+
+    parser.add_option('-N', '--shards', dest='shards', type='int', default=1,
+                      help="Write N shard databases, each written by its own process.")
+
+    parser.add_option('-p', '--partition', dest='partition', default='id',
+                      choices=['id', 'tile'],
+                      help="Shard by id range (id) or by spatial tile (tile).")
+
+    parser.add_option('-L', '--locations', dest='locations', default='sparse',
+                      choices=['sparse', 'dense'],
+                      help="Node location store: sparse (in memory, extracts) or "
+                           "dense (memory-mapped DB.nodes file, planets).")
+
+    parser.add_option('-K', '--keep-nodes', dest='keep_nodes', action="store_true",
+                      default=False,
+                      help="Keep the dense DB.nodes file for other tools to use.")
+
+    parser.add_option('-n', '--batch', dest='batch', type='int', default=10000,
+                      help="Objects per insert batch.")
+
+    parser.add_option('-x', '--stats', dest='showstats', action="store_true", default=False,
+                      help="Show processing/debugging statistics.")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    if options.filename is None or options.dbname is None:
+        parser.print_help()
+        sys.exit(-1)
+
+    (year, month, day) = options.start.split('-')
+    start_date = date(int(year), int(month), int(day))
+
+    (year, month, day) = options.end.split('-')
+    end_date = date(int(year), int(month), int(day))
+
+    if start_date > end_date:
+        print("End date must be greater than start date\n\n")
+        sys.exit(-1)
+
+    if options.shards > 1:
+        start = time.perf_counter()
+        try:
+            (names, shard_counts) = load_shards(options.filename, options.dbname,
+                                                options.shards, options.partition,
+                                                (options.left, options.bottom,
+                                                 options.right, options.top),
+                                                (start_date, end_date), options.batch,
+                                                options.locations, options.showstats,
+                                                options.keep_nodes, max(0, options.workers))
+        except sqlite3.Error as Err:
+            print("Failed to write shards: " + str(Err))
+            sys.exit(-1)
+        if options.showstats:
+            for (name, counts) in zip(names, shard_counts):
+                print("%s: %d nodes, %d ways (%d geometries), %d relations"
+                      % (name, counts['nodes'], counts['ways'], counts['geometries'],
+                         counts['relations']))
+            print("Load complete in " + str(time.perf_counter() - start) + " seconds.")
+        return
+
+    try:
+        conn = open_database(options.dbname)
+    except sqlite3.Error as Err:
+        print("Failed to open " + options.dbname + ": " + str(Err))
+        sys.exit(-1)
+
+    node_store = open_location_store(options.dbname, options.locations)
+
+    counts = load(options.filename, conn,
+                  (options.left, options.bottom, options.right, options.top),
+                  (start_date, end_date),
+                  max(0, options.workers), options.batch, options.showstats,
+                  node_store)
+
+    close_location_store(options.dbname, options.locations, node_store, options.keep_nodes)
+    conn.close()
+
+    if options.showstats:
+        print('Bytes read from OSM file: ' + str(counts['bytes']))
+        print('Objects processed: ' + str(counts['objects']))
+        print("Nodes loaded: " + str(counts['nodes']))
+        print("Ways loaded: " + str(counts['ways']))
+        print("Way geometries built: " + str(counts['geometries']))
+        print("Relations loaded: " + str(counts['relations']))
+        print("Load complete in " + str(counts['seconds']) + " seconds.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,593 @@
+# ---------------------------------------------------------------------------
+# osm_bench.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+#
+# Benchmarks for the tools in this directory. Not part of any pipeline -
+# just numbers to make decisions with.
+#
+#   osm_bench.py query -d hawaii.sqlite [-n 200] [-j 4]
+#       Latency of typical OsmQuery calls (id lookup, bbox, tag filter,
+#       time window), single threaded and with -j threads sharing the pool.
+#
+#   osm_bench.py export -d hawaii.sqlite
+#       Objects/sec exporting the whole database with osm_export.py versus
+#       reading the exported .osm back with OsmReader.
+#
+#   osm_bench.py multipolygon
+#       osm_multipolygon.py assembly time for synthetic boundary relations
+#       of 10^3 to 10^6 points - an outer ring cut into shuffled, partly
+#       reversed member ways, with islands and holes.
+#
+#   osm_bench.py hilbert [-n 200]
+#       bbox query I/O on a GeoPackage of random points written in input
+#       order versus Hilbert order (osm_writers.SpatialSortWriter,
+#       osm2fgdb.py -S): bytes read per query (/proc/self/io, Linux) and
+#       latency, with a small SQLite page cache so the pages come from the file.
+#
+#   osm_bench.py gzseek [-i planet.osm.gz] [-n 200]
+#       osm_gzindex.py checkpoint index size and build time against the
+#       latency of reading 4KB at a random uncompressed offset, for spans
+#       of 256KB to 16MB, and gzip's own seek (decompress from the start)
+#       for comparison. Without -i it makes a 64MB synthetic history file.
+#
+#   osm_bench.py pbf -i hawaii.osm.pbf -x hawaii.osm [-j 4]
+#       Objects/sec reading the same data as XML and as PBF through
+#       OsmReader.objects(): PBF decoded in this process and over -j
+#       processes. The object counts should match. With only -x, the PBF
+#       is written from the XML first (osm_pbf.PbfWriter, -j processes),
+#       and that is timed too.
+#
+#   osm_bench.py codecs [-x extract.osm]
+#       The same extract compressed with every codec osm_codecs.py has
+#       (bz2, gz, xz; zst, lz4 where installed): size, compression time,
+#       and decompression MB/s reading 64KB, 1MB and 8MB at a time, next
+#       to each codec's tuned read size and OsmReader's parse rate with
+#       it. -x can be compressed. Without it, a 32MB synthetic history file.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_bench.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+import gzip
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from osm_reader import ObjTypes, OsmReader
+
+
+# ---------------------------------------------------------------------------
+# Report helpers
+# ---------------------------------------------------------------------------
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def print_latency(name, times, rows):
+    ms = [t * 1000.0 for t in times]
+    print("%-24s n=%-5d p50=%8.3fms  p95=%8.3fms  max=%8.3fms  rows/query=%.1f"
+          % (name, len(ms), percentile(ms, 50), percentile(ms, 95), max(ms),
+             float(rows) / max(1, len(ms))))
+
+
+# ---------------------------------------------------------------------------
+# query: OsmQuery latency
+# ---------------------------------------------------------------------------
+def bench_query(options):
+    from osm_query import OsmQuery
+
+    conn = sqlite3.connect(options.dbname)
+    (min_lat, max_lat, min_lon, max_lon) = conn.execute(
+        "select min(lat), max(lat), min(lon), max(lon) from nodes").fetchone()
+    node_ids = [r[0] for r in conn.execute("select id from nodes order by random() limit 1000")]
+    way_ids = [r[0] for r in conn.execute("select id from ways order by random() limit 1000")]
+    keys = [r[0] for r in conn.execute(
+        "select key from node_tags group by key order by count(*) desc limit 5")]
+    conn.close()
+
+    if not node_ids:
+        print("No nodes in " + options.dbname)
+        return
+
+    # Boxes about 1% of the data extent on a side
+    dlat = (max_lat - min_lat) / 100.0
+    dlon = (max_lon - min_lon) / 100.0
+
+    def random_bbox():
+        lat = random.uniform(min_lat, max_lat - dlat)
+        lon = random.uniform(min_lon, max_lon - dlon)
+        return (lon, lat, lon + dlon, lat + dlat)
+
+    q = OsmQuery(options.dbname, pool_size=max(1, options.threads))
+
+    queries = [
+        ('node by id', lambda: [q.node(random.choice(node_ids))]),
+        ('way by id', lambda: [q.way(random.choice(way_ids))] if way_ids else []),
+        ('way geometry', lambda: [q.way_geometry(random.choice(way_ids))] if way_ids else []),
+        ('nodes in bbox', lambda: list(q.nodes_in_bbox(random_bbox()))),
+        ('ways in bbox', lambda: list(q.ways_in_bbox(random_bbox()))),
+        ('nodes by key', lambda: list(q.by_tag(ObjTypes.node, random.choice(keys)))
+         if keys else []),
+        ('nodes in time window', lambda: list(q.in_time_window(ObjTypes.node,
+                                                               '2010-01-01', '2010-02-01'))),
+    ]
+
+    print("Single thread")
+    for (name, fn) in queries:
+        times = []
+        rows = 0
+        for _ in range(options.count):
+            t = time.perf_counter()
+            rows += len(fn())
+            times.append(time.perf_counter() - t)
+        print_latency(name, times, rows)
+
+    if options.threads > 1:
+        print("%d threads" % options.threads)
+        with ThreadPoolExecutor(options.threads) as executor:
+            for (name, fn) in queries:
+                def timed(_, fn=fn):
+                    t = time.perf_counter()
+                    n = len(fn())
+                    return (time.perf_counter() - t, n)
+
+                results = list(executor.map(timed, range(options.count)))
+                print_latency(name, [r[0] for r in results], sum(r[1] for r in results))
+
+    q.close()
+
+
+# ---------------------------------------------------------------------------
+# export: osm_export.py throughput vs reading the same .osm
+# ---------------------------------------------------------------------------
+def bench_export(options):
+    from osm_export import export
+
+    (fd, tmpname) = tempfile.mkstemp(suffix='.osm')
+    os.close(fd)
+
+    try:
+        conn = sqlite3.connect(options.dbname)
+        t = time.perf_counter()
+        with open(tmpname, 'w', encoding='utf-8', buffering=1 << 20) as out:
+            counts = export(conn, out)
+        export_seconds = time.perf_counter() - t
+        conn.close()
+
+        total = counts['nodes'] + counts['ways'] + counts['relations']
+
+        t = time.perf_counter()
+        reader = OsmReader(tmpname)
+        read = sum(1 for _ in reader.objects())
+        read_seconds = time.perf_counter() - t
+
+        mb = os.path.getsize(tmpname) / 1048576.0
+        print("%-10s %10d objects %8.2fs %10.0f objects/sec %8.1f MB/s"
+              % ('export', total, export_seconds, total / export_seconds, mb / export_seconds))
+        print("%-10s %10d objects %8.2fs %10.0f objects/sec %8.1f MB/s"
+              % ('read', read, read_seconds, read / read_seconds, mb / read_seconds))
+    finally:
+        os.remove(tmpname)
+
+
+# ---------------------------------------------------------------------------
+# multipolygon: ring assembly for big boundary relations
+# ---------------------------------------------------------------------------
+def circle_ways(cx, cy, radius, npoints, way_length):
+    ring = []
+    for i in range(npoints):
+        a = 2.0 * math.pi * i / npoints
+        ring.append((cx + radius * math.cos(a), cy + radius * math.sin(a)))
+    ring.append(ring[0])
+
+    ways = []
+    for start in range(0, npoints, way_length):
+        points = ring[start:start + way_length + 1]
+        if random.random() < 0.5:
+            points.reverse()
+        ways.append(array('d', [c for p in points for c in p]))
+    return ways
+
+
+def bench_multipolygon(options):
+    from osm_multipolygon import assemble_multipolygon
+
+    random.seed(1)
+    print("%10s %8s %8s %10s %12s" % ('points', 'ways', 'polygons', 'seconds', 'points/sec'))
+
+    for npoints in (1000, 10000, 100000, 1000000):
+        # An outer boundary, 10 holes in it and 10 islands in the holes,
+        # all in ways of about 200 points
+        ways = circle_ways(0.0, 0.0, 10.0, npoints, 200)
+        for i in range(10):
+            a = 2.0 * math.pi * i / 10
+            (x, y) = (5.0 * math.cos(a), 5.0 * math.sin(a))
+            ways.extend(circle_ways(x, y, 1.0, max(8, npoints // 100), 200))
+            ways.extend(circle_ways(x, y, 0.5, max(8, npoints // 200), 200))
+        random.shuffle(ways)
+        total = sum(len(w) // 2 for w in ways)
+
+        # Best of -n runs, at most 5 - the big ones take seconds each
+        times = []
+        for _ in range(max(1, min(options.count, 5))):
+            t = time.perf_counter()
+            polygons = assemble_multipolygon(ways)
+            times.append(time.perf_counter() - t)
+
+        best = min(times)
+        print("%10d %8d %8d %10.4f %12.0f" % (total, len(ways), len(polygons), best, total / best))
+
+
+# ---------------------------------------------------------------------------
+# hilbert: bbox query I/O, input order vs Hilbert order
+# ---------------------------------------------------------------------------
+def read_bytes():
+    # Bytes this process has read through read()/pread(), page cache or not
+    try:
+        with open('/proc/self/io', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def write_points_gpkg(path, points, spatial_sort, workdir):
+    from osm_geometry import parse_wkb
+    from osm_writers import GpkgWriter, SpatialSortWriter
+
+    writer = GpkgWriter(path)
+    if spatial_sort:
+        writer = SpatialSortWriter(writer, workdir)
+    writer.create_layer('points', 'point', [('Node_ID', 'LONG', 0), ('Name', 'TEXT', 100)])
+    for (n, point) in enumerate(points):
+        writer.write('points', point, (n, 'node %d ' % n + 'x' * 80))
+    writer.close()
+
+    # GeoPackage style rtree over the points (point blobs are an 8 byte
+    # header, no envelope, then WKB)
+    conn = sqlite3.connect(path)
+    conn.execute("create virtual table rtree_points_geom using rtree(id, minx, maxx, miny, maxy)")
+    rows = []
+    for (fid, geom) in conn.execute("select fid, geom from points"):
+        (x, y) = parse_wkb(geom[8:])[1]
+        rows.append((fid, x, x, y, y))
+    conn.executemany("insert into rtree_points_geom values (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def bench_hilbert(options):
+    random.seed(1)
+    npoints = 200000
+
+    # Clustered like real data: towns of points around random centres
+    points = []
+    while len(points) < npoints:
+        (cx, cy) = (random.uniform(-170.0, 170.0), random.uniform(-80.0, 80.0))
+        for _ in range(random.randint(10, 1000)):
+            points.append((cx + random.gauss(0.0, 1.0), cy + random.gauss(0.0, 1.0)))
+    points = points[:npoints]
+    random.shuffle(points)
+
+    # 5 degree boxes around random points, the same boxes for both files
+    boxes = []
+    for _ in range(options.count):
+        (x, y) = random.choice(points)
+        boxes.append((x - 2.5, y - 2.5, x + 2.5, y + 2.5))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        print("%-10s %10s %12s %14s %10s %10s" % ('order', 'file MB', 'rows/query',
+                                                  'KB read/query', 'p50', 'p95'))
+        for (name, spatial_sort) in (('input', False), ('hilbert', True)):
+            path = os.path.join(workdir, name + '.gpkg')
+            write_points_gpkg(path, points, spatial_sort, workdir)
+
+            # 64 page cache, no mmap: every page touched comes through pread
+            conn = sqlite3.connect(path)
+            conn.execute("PRAGMA cache_size = 64")
+            conn.execute("PRAGMA mmap_size = 0")
+
+            times = []
+            rows = 0
+            before = read_bytes()
+            for (minx, miny, maxx, maxy) in boxes:
+                t = time.perf_counter()
+                rows += len(conn.execute(
+                    "select p.* from rtree_points_geom r join points p on p.fid = r.id "
+                    "where r.minx <= ? and r.maxx >= ? and r.miny <= ? and r.maxy >= ?",
+                    (maxx, minx, maxy, miny)).fetchall())
+                times.append(time.perf_counter() - t)
+            after = read_bytes()
+            conn.close()
+
+            kb = 'n/a' if before is None else '%.1f' % ((after - before) / 1024.0 / len(boxes))
+            ms = [t * 1000.0 for t in times]
+            print("%-10s %10.1f %12.1f %14s %8.3fms %8.3fms"
+                  % (name, os.path.getsize(path) / 1048576.0, float(rows) / len(boxes), kb,
+                     percentile(ms, 50), percentile(ms, 95)))
+    finally:
+        for f in os.listdir(workdir):
+            os.remove(os.path.join(workdir, f))
+        os.rmdir(workdir)
+
+
+# ---------------------------------------------------------------------------
+# gzseek: gzip checkpoint index size vs seek latency
+# ---------------------------------------------------------------------------
+def write_synthetic_gz(path, size):
+    random.seed(1)
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        (written, node_id) = (0, 0)
+        while written < size:
+            node_id += random.randint(1, 20)
+            lines = []
+            for version in range(1, random.randint(2, 6)):
+                lines.append('  <node id="%d" version="%d" timestamp="20%02d-%02d-%02dT%02d:%02d:'
+                             '%02dZ" uid="%d" user="user%d" lat="%.7f" lon="%.7f">\n'
+                             '    <tag k="name" v="Node %d"/>\n  </node>\n'
+                             % (node_id, version, random.randint(5, 24), random.randint(1, 12),
+                                random.randint(1, 28), random.randint(0, 23),
+                                random.randint(0, 59), random.randint(0, 59),
+                                random.randint(1, 99999), random.randint(1, 99999),
+                                random.uniform(-90, 90), random.uniform(-180, 180), node_id))
+            data = ''.join(lines)
+            f.write(data)
+            written += len(data)
+        f.write('</osm>\n')
+
+
+def bench_gzseek(options):
+    from osm_gzindex import GzipRangeFile, build_index
+
+    workdir = tempfile.mkdtemp()
+    try:
+        # Index a link, so the index files go in workdir
+        path = os.path.join(workdir, 'bench.osm.gz')
+        if options.filename:
+            os.symlink(os.path.abspath(options.filename), path)
+        else:
+            write_synthetic_gz(path, 64 << 20)
+
+        print("%-10s %12s %12s %10s %10s %10s"
+              % ('span', 'checkpoints', 'index KB', 'build', 'p50', 'p95'))
+
+        length = None
+        for span_kb in (256, 1024, 4096, 16384):
+            start = time.perf_counter()
+            index = build_index(path, span_kb << 10)
+            build = time.perf_counter() - start
+            length = index.length
+
+            random.seed(2)
+            times = []
+            for _ in range(options.count):
+                offset = random.randrange(max(1, length - 4096))
+                t = time.perf_counter()
+                f = GzipRangeFile(path, offset, offset + 4096, index)
+                f.read(4096)
+                f.close()
+                times.append(time.perf_counter() - t)
+
+            ms = [t * 1000.0 for t in times]
+            print("%-10s %12d %12.1f %9.1fs %8.2fms %8.2fms"
+                  % ('%dKB' % span_kb, len(index.checkpoints),
+                     os.path.getsize(path + '.idx') / 1024.0, build,
+                     percentile(ms, 50), percentile(ms, 95)))
+
+        # No index: gzip decompresses from the start up to the offset
+        random.seed(2)
+        times = []
+        for _ in range(min(options.count, 10)):
+            offset = random.randrange(max(1, length - 4096))
+            t = time.perf_counter()
+            with gzip.open(path, 'rb') as f:
+                f.seek(offset)
+                f.read(4096)
+            times.append(time.perf_counter() - t)
+        ms = [t * 1000.0 for t in times]
+        print("%-10s %12s %12s %10s %8.2fms %8.2fms"
+              % ('none', '-', '-', '-', percentile(ms, 50), percentile(ms, 95)))
+    finally:
+        for f in os.listdir(workdir):
+            os.remove(os.path.join(workdir, f))
+        os.rmdir(workdir)
+
+
+# ---------------------------------------------------------------------------
+# pbf: XML vs PBF read throughput
+# ---------------------------------------------------------------------------
+def bench_pbf(options):
+    from osm_pbf import PbfWriter
+
+    if not options.filename and not options.xml:
+        print("pbf needs -i file.osm.pbf and/or -x file.osm")
+        return
+
+    tmpname = None
+    pbf_name = options.filename
+    if not pbf_name:
+        (fd, tmpname) = tempfile.mkstemp(suffix='.osm.pbf')
+        os.close(fd)
+        pbf_name = tmpname
+
+        t = time.perf_counter()
+        with open(tmpname, 'wb') as f:
+            writer = PbfWriter(f, options.threads, history=True)
+            for obj in OsmReader(options.xml).objects():
+                writer.write(obj)
+            writer.close()
+        seconds = time.perf_counter() - t
+        print("Wrote %d objects as PBF in %.2fs (%.0f objects/sec, -j %d): %.1f MB -> %.1f MB"
+              % (writer.count, seconds, writer.count / seconds, options.threads,
+                 os.path.getsize(options.xml) / 1048576.0, os.path.getsize(tmpname) / 1048576.0))
+
+    runs = []
+    if options.xml:
+        runs.append(('xml', options.xml, 0))
+    runs.append(('pbf', pbf_name, 0))
+    if options.threads > 1:
+        runs.append(('pbf -j %d' % options.threads, pbf_name, options.threads))
+
+    results = []
+    for (name, path, workers) in runs:
+        t = time.perf_counter()
+        counts = [0] * (ObjTypes.eof + 1)
+        for obj in OsmReader(path, workers=workers).objects():
+            counts[obj.type] += 1
+        results.append((name, path, counts, time.perf_counter() - t))
+
+    print("%-10s %10s %10s %10s %8s %12s %8s"
+          % ('format', 'nodes', 'ways', 'relations', 'seconds', 'objects/sec', 'MB/s'))
+    for (name, path, counts, seconds) in results:
+        print("%-10s %10d %10d %10d %8.2f %12.0f %8.1f"
+              % (name, counts[ObjTypes.node], counts[ObjTypes.way], counts[ObjTypes.relation],
+                 seconds, sum(counts) / seconds, os.path.getsize(path) / 1048576.0 / seconds))
+    if len({tuple(r[2]) for r in results}) > 1:
+        print("Object counts differ!")
+
+    if tmpname is not None:
+        os.remove(tmpname)
+
+
+# ---------------------------------------------------------------------------
+# codecs: decompression MB/s per codec on the same extract
+# ---------------------------------------------------------------------------
+def decompress_rate(codec, path, size, read_bytes):
+    t = time.perf_counter()
+    with codec.open(path, 'rb') as f:
+        while f.read(read_bytes):
+            pass
+    return size / 1048576.0 / (time.perf_counter() - t)
+
+
+def bench_codecs(options):
+    from osm_codecs import CODECS, PLAIN_READ_SIZE, detect
+
+    workdir = tempfile.mkdtemp()
+    try:
+        # The extract, uncompressed
+        plain = os.path.join(workdir, 'extract.osm')
+        if options.xml:
+            codec = detect(options.xml)
+            with (codec.open(options.xml, 'rb') if codec else open(options.xml, 'rb')) as f, \
+                    open(plain, 'wb') as out:
+                while True:
+                    data = f.read(1 << 20)
+                    if not data:
+                        break
+                    out.write(data)
+        else:
+            write_synthetic_gz(plain + '.gz', 32 << 20)
+            with gzip.open(plain + '.gz', 'rb') as f, open(plain, 'wb') as out:
+                out.write(f.read())
+            os.remove(plain + '.gz')
+        size = os.path.getsize(plain)
+        with open(plain, 'rb') as f:
+            data = f.read()
+
+        print("%.1f MB extract" % (size / 1048576.0))
+        print("%-6s %9s %7s %10s %10s %10s %10s %9s %12s"
+              % ('codec', 'MB', 'ratio', 'compress', '64KB MB/s', '1MB MB/s', '8MB MB/s',
+                 'read size', 'parse MB/s'))
+
+        # Uncompressed, for reference
+        rates = []
+        for n in (64 << 10, 1 << 20, 8 << 20):
+            t = time.perf_counter()
+            with open(plain, 'rb') as f:
+                while f.read(n):
+                    pass
+            rates.append(size / 1048576.0 / (time.perf_counter() - t))
+        t = time.perf_counter()
+        sum(1 for _ in OsmReader(plain).objects())
+        parse = size / 1048576.0 / (time.perf_counter() - t)
+        print("%-6s %9.1f %7.1f %10s %10.1f %10.1f %10.1f %8dK %12.1f"
+              % ('none', size / 1048576.0, 1.0, '-', rates[0], rates[1], rates[2],
+                 PLAIN_READ_SIZE >> 10, parse))
+
+        for (name, codec) in CODECS.items():
+            path = plain + codec.ext
+            t = time.perf_counter()
+            with codec.open(path, 'wb') as f:
+                f.write(data)
+            compress = time.perf_counter() - t
+
+            rates = [decompress_rate(codec, path, size, n) for n in (64 << 10, 1 << 20, 8 << 20)]
+
+            t = time.perf_counter()
+            reader = OsmReader(path)
+            sum(1 for _ in reader.objects())
+            parse = size / 1048576.0 / (time.perf_counter() - t)
+
+            print("%-6s %9.1f %7.1f %9.1fs %10.1f %10.1f %10.1f %8dK %12.1f"
+                  % (name, os.path.getsize(path) / 1048576.0, size / float(os.path.getsize(path)),
+                     compress, rates[0], rates[1], rates[2], codec.read_size >> 10, parse))
+            os.remove(path)
+    finally:
+        for f in os.listdir(workdir):
+            os.remove(os.path.join(workdir, f))
+        os.rmdir(workdir)
+
+
+BENCHMARKS = {
+    'query': bench_query,
+    'export': bench_export,
+    'multipolygon': bench_multipolygon,
+    'hilbert': bench_hilbert,
+    'gzseek': bench_gzseek,
+    'pbf': bench_pbf,
+    'codecs': bench_codecs,
+}
+
+
+def main():
+    parser = OptionParser(usage="%prog benchmark [options]\n\nbenchmarks: "
+                          + ", ".join(sorted(BENCHMARKS)))
+
+    parser.add_option('-d', '--database', dest='dbname',
+                      help="SQLite3 DB written by osm2sqlite.py", metavar="FILE")
+
+    parser.add_option('-i', '--input', dest='filename',
+                      help="Input file where the benchmark takes one (gzseek: a .gz file, "
+                           "pbf: a .osm.pbf file).",
+                      metavar="FILE")
+
+    parser.add_option('-x', '--xml', dest='xml',
+                      help="pbf: the same data as OSM XML, to compare with. codecs: the "
+                           "extract to compress.", metavar="FILE")
+
+    parser.add_option('-n', '--count', dest='count', type='int', default=200,
+                      help="Repetitions per measurement.")
+
+    parser.add_option('-j', '--threads', dest='threads', type='int', default=4,
+                      help="Concurrent threads/processes where the benchmark uses them.")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.print_help()
+        sys.exit(-1)
+
+    BENCHMARKS[args[0]](options)
+
+
+if __name__ == '__main__':
+    main()
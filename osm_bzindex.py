@@ -0,0 +1,302 @@
+# ---------------------------------------------------------------------------
+# osm_bzindex.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+#
+# Random access into a bz2 OSM file through a sidecar index:
+#
+#   osm_bzindex.py -i full-planet.osm.bz2 [-j 8]
+#
+#       full-planet.osm.bz2.idx.json
+#
+# Planet files are compressed with pbzip2/lbzip2 into many bz2 streams
+# (one or a few 900k blocks each) one after the other. Every stream starts
+# on a byte boundary with "BZh" + level + the block magic, and decompresses
+# on its own, so those are the places a reader can start. (bz2 blocks
+# inside a stream start at arbitrary bit offsets and depend on the stream
+# around them, so a single-stream file gets one entry and no random
+# access; recompress it with pbzip2 or lbzip2 first.)
+#
+# Building the index reads the file once looking for stream headers and
+# decompresses only the start of every stream, in -j processes, for the
+# first whole object in it:
+#
+#   {"source": "full-planet.osm.bz2", "size": 212345678901, "mtime": ...,
+#    "streams": [[0, 172, "node", 1, 1],
+#                [912345, 406, "node", 16733, 3],
+#                [offset, skip, type, id, version], ...]}
+#
+# skip is how many decompressed bytes there are before that object, so
+# OsmReader(path, byte_range=(offset, None), skip=skip) starts reading at
+# a whole object. type is null for a stream with no object starting in it.
+#
+# Objects in planet files are sorted by type (nodes, ways, relations), id
+# and version, so the first objects tell where every stream is in the
+# file. objects_from() jumps to a type (and id range) from there, and
+# parallel_ranges() / range_objects() cut the file into pieces that
+# workers decompress at the same time: a piece's reader keeps going past
+# its last stream to finish the object there, and stops at the first
+# object of the next piece.
+#
+#   osm_bzindex.py -i full-planet.osm.bz2 -c [-j 8]
+#       counts the objects by type with -j processes.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_bzindex.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser
+from bisect import bisect_left
+import bz2
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from osm_codecs import detect
+from osm_reader import OsmReader, ObjTypes, TYPE_NAMES
+from splitter import OBJECT_STARTS
+
+# "BZh", block size 1-9, then the first block's magic (pi in BCD)
+STREAM_HEADER = re.compile(rb'BZh[1-9]1AY&SY')
+HEADER_LENGTH = 10
+
+SCAN_BLOCK = 16 << 20
+
+# Compressed bytes fed at a time when looking for a stream's first object
+FEED_SIZE = 64 << 10
+
+
+def index_path(path):
+    return path + '.idx.json'
+
+
+# ---------------------------------------------------------------------------
+# Building
+# ---------------------------------------------------------------------------
+def find_streams(path):
+    # Offsets of everything that looks like a stream header
+    offsets = []
+    with open(path, 'rb') as f:
+        pos = 0
+        while True:
+            f.seek(pos)
+            block = f.read(SCAN_BLOCK + HEADER_LENGTH - 1)
+            if len(block) < HEADER_LENGTH:
+                break
+            offsets.extend(pos + m.start() for m in STREAM_HEADER.finditer(block)
+                           if m.start() < SCAN_BLOCK)
+            pos += SCAN_BLOCK
+    return offsets
+
+
+def object_attribute(tag, name):
+    m = re.search(rb' ' + name + rb'="([^"]*)"', tag)
+    return m.group(1) if m else None
+
+
+def first_object(args):
+    # [offset, skip, type, id, version] of a stream's first whole object,
+    # or None if offset turns out not to be a stream after all
+    (path, offset, end) = args
+    decompressor = bz2.BZ2Decompressor()
+    data = b''
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while offset < end and not decompressor.eof:
+            compressed = f.read(min(FEED_SIZE, end - offset))
+            if not compressed:
+                break
+            offset += len(compressed)
+            try:
+                data += decompressor.decompress(compressed)
+            except OSError:
+                return None
+
+            starts = [(data.find(p), name) for (p, name) in OBJECT_STARTS.items()]
+            starts = [s for s in starts if s[0] >= 0]
+            if starts:
+                (skip, name) = min(starts)
+                if data.find(b'>', skip) >= 0:
+                    tag = data[skip:data.find(b'>', skip)]
+                    version = object_attribute(tag, b'version')
+                    return [args[1], skip, name, int(object_attribute(tag, b'id')),
+                            int(version) if version else 0]
+            # An object start can't be further in than this
+            if len(data) > (1 << 24):
+                break
+
+    return [args[1], 0, None, None, None]
+
+
+def build_index(path, workers=1):
+    size = os.path.getsize(path)
+    offsets = find_streams(path)
+    if not offsets or offsets[0] != 0:
+        raise ValueError(path + " doesn't start with a bz2 stream")
+
+    jobs = [(path, offset, end) for (offset, end) in zip(offsets, offsets[1:] + [size])]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            streams = pool.map(first_object, jobs, chunksize=64)
+    else:
+        streams = [first_object(job) for job in jobs]
+
+    index = {'source': os.path.basename(path), 'size': size,
+             'mtime': int(os.path.getmtime(path)),
+             'streams': [s for s in streams if s is not None]}
+    with open(index_path(path), 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+    return index
+
+
+def load_index(path):
+    with open(index_path(path), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    if index['size'] != os.path.getsize(path):
+        raise ValueError(index_path(path) + " is out of date - rebuild it")
+    return index
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+def object_key(obj_type, obj_id, version):
+    # Planet file order; obj_type is an element name or ObjTypes value
+    if isinstance(obj_type, str):
+        obj_type = TYPE_NAMES.index(obj_type)
+    return (obj_type, obj_id, version)
+
+
+def indexed_streams(index):
+    # (key, stream) for the streams with an object starting in them
+    return [(object_key(s[2], s[3], s[4]), s) for s in index['streams'] if s[2] is not None]
+
+
+def open_stream(path, stream):
+    return OsmReader(path, byte_range=(stream[0], None), skip=stream[1])
+
+
+def objects_from(path, index, obj_type, min_id=None, max_id=None):
+    # Objects of obj_type (element name) with min_id <= id <= max_id,
+    # starting at the last stream before the first one of them
+    streams = indexed_streams(index)
+    target = object_key(obj_type, -1 if min_id is None else min_id, -1)
+    pos = max(0, bisect_left([key for (key, _) in streams], target) - 1)
+
+    rank = target[0]
+    for obj in open_stream(path, streams[pos][1]).objects():
+        if obj.type < rank or (min_id is not None and obj.type == rank and obj.id < min_id):
+            continue
+        if obj.type > rank or (max_id is not None and obj.id > max_id):
+            return
+        yield obj
+
+
+def parallel_ranges(index, pieces):
+    # Up to `pieces` (first stream, stop key) pairs of about the same
+    # compressed size for range_objects(); the last stop key is None
+    streams = indexed_streams(index)
+    if not streams:
+        return []
+    size = index['size']
+
+    starts = [0]
+    for n in range(1, pieces):
+        pos = bisect_left([s[0] for (_, s) in streams], size * n // pieces)
+        if pos < len(streams) and pos > starts[-1]:
+            starts.append(pos)
+
+    ranges = []
+    for (n, pos) in enumerate(starts):
+        stop = streams[starts[n + 1]][0] if n + 1 < len(starts) else None
+        ranges.append((streams[pos][1], stop))
+    return ranges
+
+
+def range_objects(path, stream, stop=None):
+    # The objects from a stream's first one up to (not including) the
+    # object with key stop
+    for obj in open_stream(path, stream).objects():
+        if stop is not None and object_key(obj.type, obj.id, obj.version) >= tuple(stop):
+            return
+        yield obj
+
+
+def count_range(args):
+    (path, stream, stop) = args
+    counts = [0] * len(TYPE_NAMES)
+    for obj in range_objects(path, stream, stop):
+        counts[obj.type] += 1
+    return counts
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-i', '--input', dest='filename',
+                      help="bz2 OSM file to index", metavar="FILE")
+
+    parser.add_option('-j', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help="Worker processes (default: one per CPU).")
+
+    parser.add_option('-c', '--count', dest='count', action="store_true", default=False,
+                      help="Count the objects by type with the index (-j processes).")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    filename = options.filename
+    if filename is None and args:
+        filename = args[0]
+    if filename is None:
+        parser.print_help()
+        sys.exit(-1)
+    codec = detect(filename) if os.path.exists(filename) else None
+    if codec is None or codec.name != 'bz2':
+        print(filename + " is not a bz2 file")
+        sys.exit(-1)
+
+    start = time.perf_counter()
+
+    try:
+        if options.count and os.path.exists(index_path(filename)):
+            index = load_index(filename)
+        else:
+            index = build_index(filename, max(1, options.workers))
+            print("Indexed %d streams in %.1f seconds"
+                  % (len(index['streams']), time.perf_counter() - start))
+    except (OSError, ValueError) as Err:
+        print("Unable to index " + filename + ": " + str(Err))
+        sys.exit(-1)
+
+    streams = indexed_streams(index)
+    if len(index['streams']) == 1:
+        print("Single stream file: no random access. Recompress with pbzip2 or lbzip2.")
+    for obj_type in (ObjTypes.node, ObjTypes.way, ObjTypes.relation, ObjTypes.changeset):
+        first = [s for (key, s) in streams if key[0] == obj_type]
+        if first:
+            print("%-10s from stream at byte %d" % (TYPE_NAMES[obj_type] + 's', first[0][0]))
+
+    if options.count:
+        start = time.perf_counter()
+        jobs = [(filename, stream, stop)
+                for (stream, stop) in parallel_ranges(index, max(1, options.workers))]
+        with multiprocessing.Pool(max(1, options.workers)) as pool:
+            results = pool.map(count_range, jobs)
+        for obj_type in (ObjTypes.node, ObjTypes.way, ObjTypes.relation, ObjTypes.changeset):
+            print("%-10s %12d" % (TYPE_NAMES[obj_type] + 's:', sum(r[obj_type] for r in results)))
+        print("Counted in %.1f seconds with %d processes" % (time.perf_counter() - start,
+                                                              len(jobs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,212 +1,1037 @@
-#---------------------------------------------------------------------------
+# ---------------------------------------------------------------------------
 # osm_chunker.py
 #
-# Takes an OSM Full Planet file and chops it up by object type.
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0902
+# pylint: disable=R0913 # Too many arguments
+# pylint: disable=R1732 # Consider using with
 #
-# e.g., osm_chunker.py full-planet.osm
+# Takes an OSM (Full Planet) file and chops it up by object type into
+# chunks of at most -n objects each:
 #
-#       Generates four new file sets:
-#          full-planet-nodes.osm.xxxx
-#          full-planet-ways.osm.xxxx
-#          full-planet-relations.osm.xxxx
-#          full-planet-changesets.osm.xxxx
+#   osm_chunker.py -i full-planet.osm.bz2 [-o chunks] [-n 500000]
 #
-# The resulting OSM files aren't correct XML. But that doesn't really matter. 
-# Each file contains only one object type. It also contains a maximum of 500,000
-# of those objects. This limits each file to under 300,000MB.
+#       full-planet-nodes.00000.osm, full-planet-nodes.00001.osm, ...
+#       full-planet-ways.00000.osm, ...
+#       full-planet-relations.00000.osm, ...
+#       full-planet-changesets.00000.osm, ...
+#       full-planet-manifest.json
 #
-# One "enhancement" that might be handy would be to add a bounding box tag to the start
-# of each file. But it might make more sense to do that later on.
+# Each chunk is a complete OSM XML file on its own (prolog, <osm> root,
+# whole objects of one type one XML tag per line in input order, </osm>),
+# so any chunk can be read with OsmReader or handed to a worker with no
+# state from the other chunks. -z gz/bz2/xz compresses them (.osm.gz,
+# .osm.bz2, ...; osm_codecs.py, zst and lz4 too where installed). Every
+# type has its own writer with a big buffer, open for as long as its chunk
+# is, so the input switching between types costs nothing.
 #
-# This allows for faster processing based on the separate files when
-# extracting footprints, especially when resolving ways and relations.
+# The manifest describes every chunk, so downstream tools can pick the
+# chunks they need without opening any:
 #
-# It also keeps the changesets for exploring user contributions.
+#   {"source": "full-planet.osm.bz2", "chunk_size": 500000,
+#    "chunks": [{"file": "full-planet-nodes.00000.osm", "type": "node",
+#                "objects": 500000, "min_id": 1, "max_id": 612345,
+#                "min_time": "2005-04-09T19:54:13Z", "max_time": "2011-01-25T19:13:46Z",
+#                "bytes": 87654321, "bbox": [-180.0, -85.1, 179.9, 84.2]}, ...]}
 #
-# Uses the OSMReader module so that it can real a compressed file if necessary
+# bbox is [left, bottom, right, top] of the node locations (changesets: of
+# their own bboxes), or null for ways and relations, which carry no
+# coordinates. Times are the ISO timestamps as they are in the file
+# (created_at for changesets), so they compare as strings.
 #
-# Warning: I am a crusty old C programmer. I like C. I want to rewrite this in C but
-#          Python's more portable and I want to use parts of the code in another
-#          script that has to be Python. So this is not going to be very Pythonic.
+#   manifest = load_manifest('full-planet-manifest.json')
+#   for chunk in select_chunks(manifest, 'node', bbox=(-158.3, 21.2, -157.6, 21.8)):
+#       ...chunk['path']...
 #
-#---------------------------------------------------------------------------
+# With -q (quadtree) nodes, ways and relations are chunked by place
+# instead: every node goes to the file of the quadtree tile it is in, and a
+# tile is split into its four quarters when it gets more than -n nodes, so
+# dense cities end up in small tiles and oceans in big ones:
+#
+#       full-planet-tile.12.1234.2345.osm, ...
+#
+# Tiles are equal-angle (z/x/y, x from 180W, y from 90S). Ways go to every
+# tile one of their nodes is in, relations to every tile one of their node
+# or way members is in. The node -> tile index is the node locations
+# (osm_nodestore.py, -L) and the final quadtree; way -> tiles is a compact
+# array index (8 bytes per way + 4 per tile). Objects that can't be placed
+# (deleted nodes, ways without known nodes, ...) and changesets go to the
+# ordinary per-type chunks. Tile chunks are "type": "tile" in the manifest
+# with the tile's bbox and per-type counts, so select_chunks() with a bbox
+# only returns the tiles that overlap it. Nodes must come before ways and
+# ways before relations, as they do in planet files.
+#
+# With -t year|month (time buckets) every type is chunked by object
+# timestamp as well, so a history file's versions end up in one set of
+# chunks per year or month:
+#
+#       full-planet-nodes.2012.00000.osm, full-planet-nodes.2013.00000.osm, ...
+#
+# Chunk entries get "bucket": "2012" (or "2012-03"; null for objects with
+# no timestamp), and the manifest gets the object count of every bucket by
+# type, for sizing:
+#
+#   "time_buckets": "year",
+#   "buckets": {"2012": {"node": 81234567, "way": 9876543, ...}, ...}
+#
+# Versions go to their bucket's current chunk, held in memory like tile
+# output and appended to the chunk files TILE_BUFFER at a time, so a
+# history file's jumping around between years costs no more than writing
+# the chunks in order. select_chunks() with a time window only returns the
+# chunks of the buckets that overlap it, and ManifestReader reads those
+# chunks back as one input in planet file order (osm2sqlite.py -i takes a
+# manifest and its -s/-e to do just that). -t can't be used with -q.
+#
+# With -P the chunks are written as PBF (.osm.pbf, osm_pbf.PbfWriter)
+# instead of XML, blocks encoded and compressed in -j processes shared by
+# all the chunk writers. The input is then read object by object (so it
+# can be PBF itself), changesets are dropped (PBF has no place for them)
+# and the manifest says "format": "pbf". OsmReader and ManifestReader
+# read PBF chunks like XML ones. -P can't be used with -q or -z.
+#
+# ---------------------------------------------------------------------------
 #   Name:       osm_chunker.py
-#   Version:    1.1
-#   Authored    By: Eric Wolf
+#   Version:    2.1
+#   Authored    By: Erica Wolf
 #   Copyright:  Public Domain.
-#---------------------------------------------------------------------------
-
-# Command line parameters - these help be do test runs in PythonWin.
-#
-# E:\GNIS_OSM\rhode_island.osm.bz2
-# E:\GNIS_OSM\djibouti.osm.bz2
-# E:\GNIS_OSM\full-planet-110115-1800.osm.bz2
-# E:\GNIS_OSM\hawaii.osm.bz2
+# ---------------------------------------------------------------------------
 
-# Import modules
-import sys
+from optparse import OptionParser
+from array import array
+from bisect import bisect_left
+import heapq
+import io
+import json
+import multiprocessing
 import os
-import math
+import sys
 import time
-import string
 
-from OSMReader import OSMReader
+from osm_codecs import CODECS, EXTENSIONS
+from osm_nodestore import open_node_store
+from osm_pbf import PbfWriter
+from osm_reader import OsmReader, ObjTypes, TYPE_NAMES
 
-inFile = str(sys.argv[1])
+WRITE_BUFFER = 8 << 20
 
-start = time.clock()
+# Quadtree tiles: deepest level (~0.0003 degrees), and how much tile
+# output to hold in memory before appending it to the tile files
+MAX_DEPTH = 20
+TILE_BUFFER = 64 << 20
 
-#
-# Step 1: Scan input file, build lists
-#
-try:
-    # Input is maybe a very big file
-    inputfile = OSMReader(inFile)
+# Element -> chunk file name part
+CHUNK_TYPES = {'node': 'nodes', 'way': 'ways', 'relation': 'relations',
+               'changeset': 'changesets'}
+
+# Extensions chunk_root() takes off before .osm
+COMPRESSED_EXTENSIONS = EXTENSIONS + ('.pbf',)
+
+# Time bucket granularity -> length of the ISO timestamp prefix that names it
+TIME_BUCKETS = {'year': 4, 'month': 7}
+
+# Chunk compression: name -> (open(path, mode), file extension), from the
+# osm_codecs.py registry. Appending makes multi-member gzip / multi-stream
+# bz2 (xz, ...) files, which all read back whole.
+COMPRESSION = {None: (open, '')}
+COMPRESSION.update({name: (codec.open, codec.ext) for (name, codec) in CODECS.items()})
+
+OSM_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<osm version="0.6" generator="osm_chunker.py">\n').encode('utf-8')
+OSM_FOOTER = '</osm>\n'.encode('utf-8')
+
+
+def attribute(tag, name):
+    # Value of the named attribute, or None if the tag doesn't have it
+    s = tag.find(' ' + name + '="')
+    if s < 0:
+        return None
+    s += len(name) + 3
+    return tag[s:tag.find('"', s)]
 
-except:
-    print "Failed to initialize OSMReader with file " + inFile
-    exit(-1)
 
-# These are consts. Don't change them ;)
-cUnknown = -1
-cNodes = 1
-cWays = 2
-cRelations = 3
-cChangesets = 4
+def open_chunk_file(opener, path, mode):
+    if opener is open:
+        return open(path, mode, buffering=WRITE_BUFFER)
+    # Compressors get the objects in big pieces, not one at a time
+    return io.BufferedWriter(opener(path, mode), WRITE_BUFFER)
 
-(root, ext) = os.path.splitext(string.lower(inFile))
 
-outFilename = root+"-junk.osm"
-outFile = open(outFilename, "a")
-working_on = cUnknown
-line_count = 0
+# ---------------------------------------------------------------------------
+# Whole objects from an OsmReader, one XML tag at a time so this doesn't
+# depend on line breaks (history files have none). Yields (element,
+# [tags]) per node/way/relation/changeset; whatever is between objects
+# (<?xml>, <osm>, <bound(s)>, </osm>) is dropped.
+# ---------------------------------------------------------------------------
+def read_objects(reader):
+    lines = []
+    current = None
 
-nfcount = 0
-wfcount = 0
-rfcount = 0
-cfcount = 0
+    while True:
+        tag = reader.get_next_tag()
+        if tag == '':
+            break
 
-nodes = 0
-ways = 0
-rels = 0
-csets = 0
+        if tag[1] == '/':
+            element = tag[1:tag.find('>', 1)]
+        else:
+            element = tag[1:tag.find(' ', 1)]
 
+        if current is None:
+            if element not in CHUNK_TYPES:
+                continue
+            if tag[-2] == '/':
+                yield (element, [tag])
+                continue
+            current = element
+            lines = [tag]
+        else:
+            lines.append(tag)
+            if element == '/' + current:
+                yield (current, lines)
+                current = None
 
-while True:
 
-    # Read one XML tag without depending on line breaks 
-    # (so this works with history files)
-    line = inputfile.getNextTag()
+def pbf_objects(reader):
+    # (element, OsmObject) per object, read_objects() style
+    for obj in reader.objects():
+        yield (TYPE_NAMES[obj.type], obj)
 
-    line_count += 1
 
-    if line == '':
-        break
+def update_entry(entry, obj_id, timestamp, box):
+    # One more object in a chunk's manifest entry
+    entry['objects'] += 1
+    if entry['min_id'] is None or obj_id < entry['min_id']:
+        entry['min_id'] = obj_id
+    if entry['max_id'] is None or obj_id > entry['max_id']:
+        entry['max_id'] = obj_id
+    if timestamp:
+        if entry['min_time'] is None or timestamp < entry['min_time']:
+            entry['min_time'] = timestamp
+        if entry['max_time'] is None or timestamp > entry['max_time']:
+            entry['max_time'] = timestamp
+    if box is not None:
+        b = entry['bbox']
+        if b is None:
+            entry['bbox'] = list(box)
+        else:
+            entry['bbox'] = [min(b[0], box[0]), min(b[1], box[1]),
+                             max(b[2], box[2]), max(b[3], box[3])]
 
-    if line[1] == '/':
-        element = line[1:line.find('>',1)]
+
+# ---------------------------------------------------------------------------
+# One type's chunks: writes objects to the current chunk, rolls over to
+# the next one every chunk_size objects and keeps its manifest entry.
+# ---------------------------------------------------------------------------
+class ChunkWriter:
+    def __init__(self, outdir, root, obj_type, chunk_size, compression=None):
+        self.outdir = outdir
+        self.root = root
+        self.obj_type = obj_type
+        self.chunk_size = chunk_size
+        (self.opener, self.ext) = COMPRESSION[compression]
+        self.chunks = []
+        self.fptr = None
+        self.path = None
+        self.entry = None
+
+    def open_chunk(self):
+        name = '%s-%s.%05d.osm%s' % (self.root, CHUNK_TYPES[self.obj_type], len(self.chunks),
+                                     self.ext)
+        self.path = os.path.join(self.outdir, name)
+        self.fptr = open_chunk_file(self.opener, self.path, 'wb')
+        self.fptr.write(OSM_HEADER)
+        self.entry = {'file': name, 'type': self.obj_type, 'objects': 0,
+                      'min_id': None, 'max_id': None, 'min_time': None, 'max_time': None,
+                      'bytes': 0, 'bbox': None}
+        self.chunks.append(self.entry)
+
+    def close_chunk(self):
+        if self.fptr is not None:
+            self.fptr.write(OSM_FOOTER)
+            self.fptr.close()
+            # Size on disk, compressed or not
+            self.entry['bytes'] = os.path.getsize(self.path)
+            self.fptr = None
+            self.entry = None
+
+    def write(self, lines, obj_id, timestamp, box):
+        if self.fptr is None:
+            self.open_chunk()
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.fptr.write(data)
+
+        update_entry(self.entry, obj_id, timestamp, box)
+        if self.entry['objects'] >= self.chunk_size:
+            self.close_chunk()
+
+    def close(self):
+        self.close_chunk()
+
+
+# ---------------------------------------------------------------------------
+# PBF chunks: the same rolling over, with a PbfWriter per chunk. write()
+# takes an OsmObject instead of lines.
+# ---------------------------------------------------------------------------
+class PbfChunkWriter(ChunkWriter):
+    def __init__(self, outdir, root, obj_type, chunk_size, pool=None):
+        ChunkWriter.__init__(self, outdir, root, obj_type, chunk_size)
+        self.ext = '.pbf'
+        self.pool = pool
+        self.writer = None
+
+    def open_chunk(self):
+        name = '%s-%s.%05d.osm%s' % (self.root, CHUNK_TYPES[self.obj_type], len(self.chunks),
+                                     self.ext)
+        self.path = os.path.join(self.outdir, name)
+        self.fptr = open(self.path, 'wb', buffering=WRITE_BUFFER)
+        self.writer = PbfWriter(self.fptr, history=True, pool=self.pool)
+        self.entry = {'file': name, 'type': self.obj_type, 'objects': 0,
+                      'min_id': None, 'max_id': None, 'min_time': None, 'max_time': None,
+                      'bytes': 0, 'bbox': None}
+        self.chunks.append(self.entry)
+
+    def close_chunk(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.fptr.close()
+            self.entry['bytes'] = os.path.getsize(self.path)
+            self.fptr = None
+            self.entry = None
+
+    def write(self, obj, obj_id, timestamp, box):
+        if self.fptr is None:
+            self.open_chunk()
+
+        self.writer.write(obj)
+
+        update_entry(self.entry, obj_id, timestamp, box)
+        if self.entry['objects'] >= self.chunk_size:
+            self.close_chunk()
+
+
+def object_info(tag, element):
+    # (id, timestamp, bbox or None) from an object's opening tag
+    obj_id = int(attribute(tag, 'id'))
+
+    if element == 'changeset':
+        timestamp = attribute(tag, 'created_at')
+        box = [attribute(tag, a) for a in ('min_lon', 'min_lat', 'max_lon', 'max_lat')]
     else:
-        element = line[1:line.find(' ',1)]
-
-    # 
-    # Node
-    # 
-    if element == 'node':
-        nodes += 1
-         
-        #
-        # 500,000 Nodes should be < 100MB (typically)
-        #
-        if (nodes % 10000) == 0:
-            nfcount += 1
-            outFile.close()
-    
-            print "Node Files: {:05d}   Nodes: {:d}".format(nfcount, nodes)
-            outFilename = root + "-nodes.osm.{:05d}".format(nfcount)
-            outFile.close()
-            outFile = open(outFilename, "w")
-       
-        if working_on != cNodes:
-            outFile.close()
-            outFilename = root + "-nodes.osm.{:05d}".format(nfcount)
-            outFile = open(outFilename, "a")
-
-        working_on = cNodes
-           
-    elif element == 'way':
-        ways += 1
-         
-        #
-        # 500,000 Ways should be < ???MB (typically)
-        #
-        if (ways % 10000) == 0:
-            wfcount += 1
-            outFile.close()
-    
-            print "Way Files: {:05d}   Way: {:d}".format(wfcount, ways)
-            outFilename = root + "-ways.osm.{:05d}".format(wfcount)
-            outFile.close()
-            outFile = open(outFilename, "w")
-       
-        if working_on != cWays:
-            outFile.close()
-            outFilename = root + "-ways.osm.{:05d}".format(wfcount)
-            outFile = open(outFilename, "a")
-
-        working_on = cWays
-
-    elif element == 'relation':
-        rels += 1
-    
-        #
-        # 500,000 Relations should be < ???MB (typically)
-        #
-        if (rels % 1000000) == 0:
-            rfcount += 1
-            outFile.close()
-    
-            print "Relations Files: {:05d}   Relations: {:d}".format(wfcount, ways)
-            outFilename = root + "-relations.osm.{:05d}".format(wfcount)
-            outFile.close()
-            outFile = open(outFilename, "w")
-            
-        if working_on != cRelations:
-            outFile.close()
-            outFilename = root + "-relations.osm.{:05d}".format(rfcount)
-            outFile = open(outFilename, "a")
-
-        working_on = cRelations
-
-    elif element == 'changeset':
-        csets += 1
-         
-        #
-        # 500,000 Changesets should be < ???MB (typically)
-        #
-        if (csets % 1000000) == 0:
-            cfcount += 1
-            outFile.close()
-    
-            print "Changeset Files: {:05d}   Changesets: {:d}".format(cfcount, csets)
-            outFilename = root + "-changesets.osm.{:05d}".format(cfcount)
-            outFile.close()
-            outFile = open(outFilename, "w")
-            
-        if working_on != cChangesets:
-            outFile.close()
-            outFilename = root + "-changesets.osm.{:05d}".format(cfcount)
-            outFile = open(outFilename, "a")
-            
-        working_on = cChangesets
-        
-    print >> outFile, line.encode("utf-8","ignore")
-    
-outFile.close()
-
-elapsed = time.clock() - start
-
-print "Nodes: {:d}".format(nodes)
-print "Ways: {:d}".format(ways)
-print "Relations: {:d}".format(rels)
-print "Changesets: {:d}".format(csets)
-print str(line_count) + " lines read in " + str(elapsed) + " seconds"
\ No newline at end of file
+        timestamp = attribute(tag, 'timestamp')
+        lon = attribute(tag, 'lon')
+        lat = attribute(tag, 'lat')
+        box = [lon, lat, lon, lat]
+
+    if None in box:
+        return (obj_id, timestamp, None)
+    return (obj_id, timestamp, [float(v) for v in box])
+
+
+def osm_object_info(obj):
+    # object_info() for an OsmObject
+    box = None
+    if obj.type == ObjTypes.node and obj.visible:
+        box = [obj.lon, obj.lat, obj.lon, obj.lat]
+    return (obj.id, obj.iso_timestamp or None, box)
+
+
+def chunk_root(filename):
+    # full-planet.osm.bz2 -> full-planet
+    root = os.path.basename(filename)
+    (base, ext) = os.path.splitext(root)
+    if ext.lower() in COMPRESSED_EXTENSIONS:
+        root = base
+    (base, ext) = os.path.splitext(root)
+    if ext.lower() == '.osm':
+        root = base
+    return root
+
+
+# ---------------------------------------------------------------------------
+# Quadtree tiles
+# ---------------------------------------------------------------------------
+def tile_bounds(tile):
+    (z, x, y) = tile
+    width = 360.0 / (1 << z)
+    height = 180.0 / (1 << z)
+    return [-180.0 + x * width, -90.0 + y * height,
+            -180.0 + (x + 1) * width, -90.0 + (y + 1) * height]
+
+
+def tile_children(tile):
+    (z, x, y) = tile
+    return [(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]
+
+
+def tile_child(tile, lon, lat):
+    (z, x, y) = tile
+    (left, bottom, right, top) = tile_bounds(tile)
+    return (z + 1, 2 * x + (lon >= (left + right) / 2.0), 2 * y + (lat >= (bottom + top) / 2.0))
+
+
+def split_objects(data):
+    # A tile file's text back into objects (lists of lines). Objects are
+    # written one tag per line, so an object is its first line up to the
+    # matching close tag.
+    objects = []
+    lines = None
+    close = None
+    for line in data.split('\n'):
+        if not line:
+            continue
+        if lines is None:
+            # The file's prolog and <osm> root
+            if line.startswith('<?xml') or line.startswith('<osm'):
+                continue
+            element = line[1:line.find(' ', 1)]
+            if line[-2] == '/':
+                objects.append([line])
+                continue
+            (lines, close) = ([line], '</' + element + '>')
+        else:
+            lines.append(line)
+            if line == close:
+                objects.append(lines)
+                lines = None
+    return objects
+
+
+def object_refs(lines):
+    # Way node ids, or relation members as (type, ref)
+    refs = []
+    for line in lines[1:]:
+        if line.startswith('<nd '):
+            refs.append(int(attribute(line, 'ref')))
+        elif line.startswith('<member '):
+            refs.append((attribute(line, 'type'), int(attribute(line, 'ref'))))
+    return refs
+
+
+def new_tile_stats():
+    return {'counts': {'node': 0, 'way': 0, 'relation': 0}, 'min_time': None,
+            'max_time': None, 'bytes': 0}
+
+
+class QuadtreeChunker:
+    def __init__(self, outdir, root, max_nodes, store, compression=None,
+                 buffer_size=TILE_BUFFER):
+        self.outdir = outdir
+        self.root = root
+        self.max_nodes = max_nodes
+        self.store = store
+        (self.opener, self.ext) = COMPRESSION[compression]
+        self.buffer_size = buffer_size
+
+        # Leaves and their stats; split tiles only route to their children
+        self.tiles = {(0, 0, 0): new_tile_stats()}
+        self.split_tiles = set()
+        self.frozen = False
+
+        self.buffers = {}
+        self.buffered = 0
+
+        # Way -> tiles: way ids, offsets into way_tiles, leaf numbers
+        self.leaf_numbers = None
+        self.leaves = None
+        self.way_ids = array('q')
+        self.way_offsets = array('Q', [0])
+        self.way_tiles = array('I')
+
+    def tile_path(self, tile):
+        return os.path.join(self.outdir, '%s-tile.%d.%d.%d.osm%s' % ((self.root,) + tile
+                                                                     + (self.ext,)))
+
+    def leaf(self, lon, lat):
+        tile = (0, 0, 0)
+        while tile in self.split_tiles:
+            tile = tile_child(tile, lon, lat)
+        return tile
+
+    def append(self, tile, data, obj_type, timestamp):
+        self.buffers.setdefault(tile, []).append(data)
+        self.buffered += len(data)
+
+        stats = self.tiles[tile]
+        stats['counts'][obj_type] += 1
+        stats['bytes'] += len(data)
+        if timestamp:
+            if stats['min_time'] is None or timestamp < stats['min_time']:
+                stats['min_time'] = timestamp
+            if stats['max_time'] is None or timestamp > stats['max_time']:
+                stats['max_time'] = timestamp
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush_tile(self, tile):
+        parts = self.buffers.pop(tile, None)
+        if parts:
+            path = self.tile_path(tile)
+            self.buffered -= sum(len(p) for p in parts)
+            if not os.path.exists(path):
+                parts.insert(0, OSM_HEADER)
+            with self.opener(path, 'ab') as f:
+                f.write(b''.join(parts))
+
+    def flush(self):
+        for tile in list(self.buffers):
+            self.flush_tile(tile)
+        self.buffered = 0
+
+    def split(self, tile):
+        # Move the tile's nodes down into its four quarters
+        self.flush_tile(tile)
+        path = self.tile_path(tile)
+        with self.opener(path, 'rb') as f:
+            data = f.read().decode('utf-8')
+        os.remove(path)
+
+        del self.tiles[tile]
+        self.split_tiles.add(tile)
+        children = tile_children(tile)
+        for child in children:
+            self.tiles[child] = new_tile_stats()
+
+        for lines in split_objects(data):
+            (_, timestamp, box) = object_info(lines[0], 'node')
+            self.append(tile_child(tile, box[0], box[1]),
+                        ('\n'.join(lines) + '\n').encode('utf-8'), 'node', timestamp)
+
+        for child in children:
+            if self.tiles[child]['counts']['node'] > self.max_nodes and child[0] < MAX_DEPTH:
+                self.split(child)
+
+    def freeze(self):
+        # No more splits once ways start; number the leaves for the way index
+        self.frozen = True
+        self.leaves = sorted(self.tiles)
+        self.leaf_numbers = {tile: n for (n, tile) in enumerate(self.leaves)}
+
+    def node_tile(self, node_id):
+        location = self.store.get(node_id)
+        if location is None:
+            return None
+        return self.leaf(location[0], location[1])
+
+    def way_tile_list(self, way_id):
+        tiles = set()
+        pos = bisect_left(self.way_ids, way_id)
+        # History files have a run of versions per way
+        while pos < len(self.way_ids) and self.way_ids[pos] == way_id:
+            for n in range(self.way_offsets[pos], self.way_offsets[pos + 1]):
+                tiles.add(self.leaves[self.way_tiles[n]])
+            pos += 1
+        return tiles
+
+    # Each add_* returns False if the object couldn't be placed in a tile
+    def add_node(self, lines, obj_id, timestamp, box):
+        if box is None:
+            return False
+
+        (lon, lat) = (box[0], box[1])
+        self.store.set(obj_id, lon, lat)
+        tile = self.leaf(lon, lat)
+        self.append(tile, ('\n'.join(lines) + '\n').encode('utf-8'), 'node', timestamp)
+
+        if not self.frozen and self.tiles[tile]['counts']['node'] > self.max_nodes \
+                and tile[0] < MAX_DEPTH:
+            self.split(tile)
+        return True
+
+    def add_way(self, lines, obj_id, timestamp):
+        if not self.frozen:
+            self.freeze()
+
+        tiles = set()
+        for node_id in object_refs(lines):
+            tile = self.node_tile(node_id)
+            if tile is not None:
+                tiles.add(tile)
+        if not tiles:
+            return False
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        for tile in tiles:
+            self.append(tile, data, 'way', timestamp)
+
+        # Out of order ids would break the bisection, so those aren't indexed
+        if not self.way_ids or obj_id >= self.way_ids[-1]:
+            self.way_ids.append(obj_id)
+            self.way_tiles.extend(sorted(self.leaf_numbers[t] for t in tiles))
+            self.way_offsets.append(len(self.way_tiles))
+        return True
+
+    def add_relation(self, lines, timestamp):
+        if not self.frozen:
+            self.freeze()
+
+        tiles = set()
+        for (member_type, ref) in object_refs(lines):
+            if member_type == 'node':
+                tile = self.node_tile(ref)
+                if tile is not None:
+                    tiles.add(tile)
+            elif member_type == 'way':
+                tiles.update(self.way_tile_list(ref))
+        if not tiles:
+            return False
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        for tile in tiles:
+            self.append(tile, data, 'relation', timestamp)
+        return True
+
+    def close(self):
+        self.flush()
+
+        chunks = []
+        for tile in sorted(self.tiles):
+            stats = self.tiles[tile]
+            counts = stats['counts']
+            if not stats['bytes']:
+                continue
+
+            path = self.tile_path(tile)
+            with self.opener(path, 'ab') as f:
+                f.write(OSM_FOOTER)
+            stats['bytes'] = os.path.getsize(path)
+            chunks.append({'file': os.path.basename(self.tile_path(tile)), 'type': 'tile',
+                           'tile': list(tile), 'objects': sum(counts.values()),
+                           'counts': counts, 'min_id': None, 'max_id': None,
+                           'min_time': stats['min_time'], 'max_time': stats['max_time'],
+                           'bytes': stats['bytes'], 'bbox': tile_bounds(tile)})
+        return chunks
+
+
+# ---------------------------------------------------------------------------
+# Time buckets: every (type, bucket) has its own run of chunks. Output is
+# held in memory and appended to the chunk files buffer_size at a time;
+# footers go on at close().
+# ---------------------------------------------------------------------------
+class BucketChunker:
+    def __init__(self, outdir, root, chunk_size, granularity, compression=None,
+                 buffer_size=TILE_BUFFER):
+        self.outdir = outdir
+        self.root = root
+        self.chunk_size = chunk_size
+        self.prefix = TIME_BUCKETS[granularity]
+        (self.opener, self.ext) = COMPRESSION[compression]
+        self.buffer_size = buffer_size
+
+        # (type, bucket) -> its chunk entries, the last one being filled
+        self.runs = {}
+        self.buffers = {}
+        self.buffered = 0
+
+    def bucket(self, timestamp):
+        return timestamp[:self.prefix] if timestamp else None
+
+    def chunk_path(self, entry):
+        return os.path.join(self.outdir, entry['file'])
+
+    def current(self, obj_type, bucket):
+        run = self.runs.setdefault((obj_type, bucket), [])
+        if not run or run[-1]['objects'] >= self.chunk_size:
+            name = '%s-%s.%s.%05d.osm%s' % (self.root, CHUNK_TYPES[obj_type],
+                                            bucket or 'undated', len(run), self.ext)
+            run.append({'file': name, 'type': obj_type, 'bucket': bucket, 'objects': 0,
+                        'min_id': None, 'max_id': None, 'min_time': None, 'max_time': None,
+                        'bytes': 0, 'bbox': None})
+        return run[-1]
+
+    def write(self, obj_type, lines, obj_id, timestamp, box):
+        entry = self.current(obj_type, self.bucket(timestamp))
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.buffers.setdefault(entry['file'], []).append(data)
+        self.buffered += len(data)
+        update_entry(entry, obj_id, timestamp, box)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for (name, parts) in self.buffers.items():
+            path = os.path.join(self.outdir, name)
+            if not os.path.exists(path):
+                parts.insert(0, OSM_HEADER)
+            with self.opener(path, 'ab') as f:
+                f.write(b''.join(parts))
+        self.buffers = {}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+        chunks = []
+        # Types in file order, each type's buckets in time order (undated first)
+        for key in sorted(self.runs, key=lambda k: (list(CHUNK_TYPES).index(k[0]), k[1] or '')):
+            for entry in self.runs[key]:
+                path = self.chunk_path(entry)
+                with self.opener(path, 'ab') as f:
+                    f.write(OSM_FOOTER)
+                entry['bytes'] = os.path.getsize(path)
+                chunks.append(entry)
+        return chunks
+
+
+# ---------------------------------------------------------------------------
+# Time buckets as PBF: OsmObjects are held (up to buffer_objects) and
+# appended to the chunk files as PBF blocks; no footers.
+# ---------------------------------------------------------------------------
+class PbfBucketChunker(BucketChunker):
+    def __init__(self, outdir, root, chunk_size, granularity, pool=None,
+                 buffer_objects=TILE_BUFFER >> 6):
+        BucketChunker.__init__(self, outdir, root, chunk_size, granularity)
+        self.ext = '.pbf'
+        self.pool = pool
+        self.buffer_size = buffer_objects
+
+    def write(self, obj_type, obj, obj_id, timestamp, box):
+        entry = self.current(obj_type, self.bucket(timestamp))
+        self.buffers.setdefault(entry['file'], []).append(obj)
+        self.buffered += 1
+        update_entry(entry, obj_id, timestamp, box)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for (name, objects) in self.buffers.items():
+            path = os.path.join(self.outdir, name)
+            header = not os.path.exists(path)
+            with open(path, 'ab', buffering=WRITE_BUFFER) as f:
+                writer = PbfWriter(f, history=True, header=header, pool=self.pool)
+                for obj in objects:
+                    writer.write(obj)
+                writer.close()
+        self.buffers = {}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+        chunks = []
+        for key in sorted(self.runs, key=lambda k: (list(CHUNK_TYPES).index(k[0]), k[1] or '')):
+            for entry in self.runs[key]:
+                entry['bytes'] = os.path.getsize(self.chunk_path(entry))
+                chunks.append(entry)
+        return chunks
+
+
+# ---------------------------------------------------------------------------
+# Chunk filename into outdir. Returns the manifest (also written to
+# <root>-manifest.json).
+# ---------------------------------------------------------------------------
+def chunk_file(filename, outdir, chunk_size=500000, progress=None, quadtree=False,
+               locations='dense', compression=None, time_buckets=None, pbf=False, workers=0):
+    if quadtree and time_buckets:
+        raise ValueError("Time buckets can't be used with quadtree chunking")
+    if pbf and (quadtree or compression):
+        raise ValueError("PBF chunks can't be quadtree tiles or compressed again")
+
+    root = chunk_root(filename)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # One pool for all the PBF writers
+    pool = multiprocessing.Pool(workers) if pbf and workers > 1 else None
+
+    buckets = None
+    if time_buckets and pbf:
+        buckets = PbfBucketChunker(outdir, root, chunk_size, time_buckets, pool)
+        writers = {}
+    elif time_buckets:
+        buckets = BucketChunker(outdir, root, chunk_size, time_buckets, compression)
+        writers = {}
+    elif pbf:
+        writers = {obj_type: PbfChunkWriter(outdir, root, obj_type, chunk_size, pool)
+                   for obj_type in CHUNK_TYPES if obj_type != 'changeset'}
+    else:
+        writers = {obj_type: ChunkWriter(outdir, root, obj_type, chunk_size, compression)
+                   for obj_type in CHUNK_TYPES}
+
+    tiles = None
+    store_path = None
+    if quadtree:
+        if locations == 'dense':
+            store_path = os.path.join(outdir, root + '-nodes.dense')
+        tiles = QuadtreeChunker(outdir, root, chunk_size,
+                                open_node_store(store_path, 'w', locations), compression)
+
+    reader = OsmReader(filename)
+
+    count = 0
+    dropped = 0
+    # With -P, lines is an OsmObject
+    for (element, lines) in (pbf_objects(reader) if pbf else read_objects(reader)):
+        if pbf and element == 'changeset':
+            dropped += 1
+            continue
+
+        if pbf:
+            (obj_id, timestamp, box) = osm_object_info(lines)
+        else:
+            (obj_id, timestamp, box) = object_info(lines[0], element)
+
+        if tiles is None:
+            placed = False
+        elif element == 'node':
+            placed = tiles.add_node(lines, obj_id, timestamp, box)
+        elif element == 'way':
+            placed = tiles.add_way(lines, obj_id, timestamp)
+        elif element == 'relation':
+            placed = tiles.add_relation(lines, timestamp)
+        else:
+            placed = False
+
+        if buckets is not None:
+            buckets.write(element, lines, obj_id, timestamp, box)
+        elif not placed:
+            writers[element].write(lines, obj_id, timestamp, box)
+
+        count += 1
+        if progress is not None and count % 1000000 == 0:
+            progress(count)
+
+    chunks = []
+    for writer in writers.values():
+        writer.close()
+        chunks.extend(writer.chunks)
+
+    if buckets is not None:
+        chunks.extend(buckets.close())
+
+    if tiles is not None:
+        chunks.extend(tiles.close())
+        tiles.store.close()
+        if store_path is not None:
+            os.remove(store_path)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    manifest = {'source': os.path.basename(filename), 'chunk_size': chunk_size,
+                'quadtree': quadtree, 'compression': compression,
+                'time_buckets': time_buckets, 'format': 'pbf' if pbf else 'xml',
+                'chunks': chunks}
+    if dropped:
+        manifest['dropped_changesets'] = dropped
+    if time_buckets:
+        manifest['buckets'] = bucket_counts(manifest)
+    with open(os.path.join(outdir, root + '-manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+
+    return manifest
+
+
+# ---------------------------------------------------------------------------
+# Manifest readers
+# ---------------------------------------------------------------------------
+def load_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    # Chunk paths relative to wherever the manifest is
+    base = os.path.dirname(path)
+    for chunk in manifest['chunks']:
+        chunk['path'] = os.path.join(base, chunk['file'])
+    return manifest
+
+
+def select_chunks(manifest, obj_type=None, bbox=None, start=None, end=None,
+                  min_id=None, max_id=None):
+    # Chunks that may hold objects of obj_type in the bbox (left, bottom,
+    # right, top), the time window [start, end] (ISO strings, dates work
+    # too) and the id range. Chunks without a bbox (ways, relations) are
+    # only skipped by type, time or id, tiles (no id range) by type, time
+    # or bbox.
+    for chunk in manifest['chunks']:
+        if chunk['type'] == 'tile':
+            if obj_type is not None and not chunk['counts'].get(obj_type):
+                continue
+        elif obj_type is not None and chunk['type'] != obj_type:
+            continue
+        if min_id is not None and chunk['max_id'] is not None and chunk['max_id'] < min_id:
+            continue
+        if max_id is not None and chunk['min_id'] is not None and chunk['min_id'] > max_id:
+            continue
+        if start is not None and chunk['max_time'] is not None and chunk['max_time'] < start:
+            continue
+        # An end date takes in the whole day
+        if end is not None and chunk['min_time'] is not None \
+                and chunk['min_time'][:len(end)] > end:
+            continue
+        # A bucket covers all of its year/month, whatever its chunks hold
+        bucket = chunk.get('bucket')
+        if bucket is not None:
+            if start is not None and bucket < start[:len(bucket)]:
+                continue
+            if end is not None and bucket > end[:len(bucket)]:
+                continue
+        box = chunk['bbox']
+        if bbox is not None and box is not None and \
+                (box[0] > bbox[2] or box[2] < bbox[0] or box[1] > bbox[3] or box[3] < bbox[1]):
+            continue
+        yield chunk
+
+
+def bucket_counts(manifest):
+    # {bucket: {type: objects}} over a time bucketed manifest's chunks,
+    # buckets in time order (objects with no timestamp are under None)
+    counts = {}
+    for chunk in manifest['chunks']:
+        if 'bucket' in chunk:
+            by_type = counts.setdefault(chunk['bucket'], {})
+            by_type[chunk['type']] = by_type.get(chunk['type'], 0) + chunk['objects']
+    return {bucket: counts[bucket] for bucket in sorted(counts, key=lambda b: b or '')}
+
+
+# ---------------------------------------------------------------------------
+# The chunks of a manifest that a bbox / time window needs, read back as
+# one input: objects() yields OsmObjects like OsmReader.objects() does,
+# nodes first, then ways, relations and changesets. A type's chunks from
+# different time buckets are merged on (id, version), so every object's
+# versions come one after the other as they do in the source file.
+# Quadtree tiles can't be read in that order, so they aren't taken.
+# ---------------------------------------------------------------------------
+class ManifestReader:
+    def __init__(self, path, bbox=None, start=None, end=None):
+        self.manifest = load_manifest(path)
+        if self.manifest.get('quadtree'):
+            raise ValueError(path + " is a quadtree manifest; its tiles can't be read in order")
+        self.bbox = bbox
+        self.start = start
+        self.end = end
+        self.readers = []
+
+    def type_chunks(self, obj_type):
+        # Selected chunks of a type, grouped by bucket
+        groups = {}
+        for chunk in select_chunks(self.manifest, obj_type, self.bbox, self.start, self.end):
+            groups.setdefault(chunk.get('bucket'), []).append(chunk)
+        return list(groups.values())
+
+    def chunk_objects(self, chunks):
+        for chunk in chunks:
+            reader = OsmReader(chunk['path'])
+            self.readers.append(reader)
+            yield from reader.objects()
+
+    def objects(self):
+        for obj_type in CHUNK_TYPES:
+            groups = self.type_chunks(obj_type)
+            if len(groups) == 1:
+                yield from self.chunk_objects(groups[0])
+            elif groups:
+                yield from heapq.merge(*[self.chunk_objects(g) for g in groups],
+                                       key=lambda obj: (obj.id, obj.version))
+
+    def get_bytes_read(self):
+        return sum(reader.get_bytes_read() for reader in self.readers)
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-i', '--input', dest='filename',
+                      help="OSM file to chunk (.osm, compressed, .pbf with -P)", metavar="FILE")
+
+    parser.add_option('-o', '--outdir', dest='outdir', default=None,
+                      help="Directory for the chunks (default: next to the input).")
+
+    parser.add_option('-n', '--chunk-size', dest='chunk_size', type='int', default=500000,
+                      help="Objects per chunk (default 500000). With -q, the node count "
+                           "at which a tile is split.")
+
+    parser.add_option('-q', '--quadtree', dest='quadtree', action="store_true", default=False,
+                      help="Chunk nodes, ways and relations into quadtree tiles.")
+
+    parser.add_option('-z', '--compress', dest='compression', default=None,
+                      choices=list(CODECS),
+                      help="Compress the chunks: " + ", ".join(CODECS) + ".")
+
+    parser.add_option('-t', '--time-buckets', dest='time_buckets', default=None,
+                      choices=list(TIME_BUCKETS),
+                      help="Also chunk every type by object timestamp: year or month.")
+
+    parser.add_option('-P', '--pbf', dest='pbf', action="store_true", default=False,
+                      help="Write the chunks as PBF (.osm.pbf).")
+
+    parser.add_option('-j', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help="Processes encoding PBF blocks for -P (default: one per CPU).")
+
+    parser.add_option('-L', '--locations', dest='locations', default='dense',
+                      choices=['dense', 'sparse'],
+                      help="Node location store for -q: dense (memory-mapped file, default) "
+                           "or sparse (in memory, for small extracts).")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    filename = options.filename
+    if filename is None and args:
+        filename = args[0]
+    if filename is None or options.chunk_size < 1:
+        parser.print_help()
+        sys.exit(-1)
+
+    if options.quadtree and options.time_buckets:
+        print("-t can't be used with -q")
+        sys.exit(-1)
+
+    if options.pbf and (options.quadtree or options.compression):
+        print("-P can't be used with -q or -z")
+        sys.exit(-1)
+
+    outdir = options.outdir
+    if outdir is None:
+        outdir = os.path.dirname(filename) or '.'
+
+    start = time.perf_counter()
+
+    def progress(count):
+        print("%d objects in %.1fs" % (count, time.perf_counter() - start))
+
+    try:
+        manifest = chunk_file(filename, outdir, options.chunk_size, progress, options.quadtree,
+                              options.locations, options.compression, options.time_buckets,
+                              options.pbf, options.workers)
+    except OSError as Err:
+        print("Failed: " + str(Err))
+        sys.exit(-1)
+
+    for obj_type in CHUNK_TYPES:
+        chunks = [c for c in manifest['chunks'] if c['type'] == obj_type]
+        print("%-12s %12d objects %6d chunks %14d bytes"
+              % (CHUNK_TYPES[obj_type].capitalize() + ':', sum(c['objects'] for c in chunks),
+                 len(chunks), sum(c['bytes'] for c in chunks)))
+
+    tiles = [c for c in manifest['chunks'] if c['type'] == 'tile']
+    if tiles:
+        print("%-12s %12d objects %6d chunks %14d bytes (deepest z%d)"
+              % ('Tiles:', sum(c['objects'] for c in tiles), len(tiles),
+                 sum(c['bytes'] for c in tiles), max(c['tile'][0] for c in tiles)))
+
+    if manifest.get('dropped_changesets'):
+        print("%d changesets dropped (PBF has no changesets)" % manifest['dropped_changesets'])
+
+    if options.time_buckets:
+        print()
+        print("%-12s %12s %12s %12s %12s" % ('Bucket', 'Nodes', 'Ways', 'Relations',
+                                              'Changesets'))
+        for (bucket, counts) in manifest['buckets'].items():
+            print("%-12s %12d %12d %12d %12d"
+                  % (bucket or 'undated', counts.get('node', 0), counts.get('way', 0),
+                     counts.get('relation', 0), counts.get('changeset', 0)))
+        print()
+
+    print("Finished in %.1f seconds" % (time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
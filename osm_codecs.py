@@ -0,0 +1,136 @@
+# ---------------------------------------------------------------------------
+# osm_codecs.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0903
+#
+# The compression codecs OsmReader reads and the chunk/piece/export writers
+# write, in one place:
+#
+#   codec = detect('planet.osm.zst')    # by the file's first bytes
+#   f = codec.open(path, 'rb')          # binary, like bz2.open/gzip.open
+#   f.read(codec.read_size)
+#
+#   codec = codec_for_name('oahu.osm.xz')   # writers: by the output name
+#
+# Input is recognized by magic bytes, not by its name, so a renamed or
+# oddly named planet still opens with the right decompressor, and a file
+# in a format whose module isn't installed is an error instead of being
+# read as XML text. Writers go by extension since there are no bytes yet.
+#
+# bz2, gz and xz come with Python; zst needs compression.zstd (3.14) or
+# the zstandard package and lz4 the lz4 package, and are only registered
+# when those are there. All of them read back concatenated streams/frames
+# whole, so chunk files can be appended to.
+#
+# read_size is how much decompressed text OsmReader asks for at a time:
+# "osm_bench.py codecs" measures decompression MB/s per codec and read
+# size on the same file. bz2 gains from big reads (~900k blocks), gz and
+# xz don't, and smaller reads keep OsmReader's buffer shifting cheap.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_codecs.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import bz2
+import functools
+import gzip
+import io
+import lzma
+import os
+
+# Uncompressed .osm
+PLAIN_READ_SIZE = 8 << 20
+
+
+class Codec:
+    def __init__(self, name, ext, magic, opener, read_size):
+        self.name = name
+        self.ext = ext
+        self.magic = magic
+        self.opener = opener
+        self.read_size = read_size
+
+    def open(self, path, mode='rb'):
+        return self.opener(path, mode)
+
+    def __repr__(self):
+        return "Codec(%s)" % self.name
+
+
+# Available codecs by name, and every codec this knows about (installed
+# or not) by magic, for detect()'s error message
+CODECS = {}
+KNOWN_MAGIC = {b'BZh': 'bz2', b'\x1f\x8b': 'gz', b'\xfd7zXZ\x00': 'xz',
+               b'\x28\xb5\x2f\xfd': 'zst', b'\x04\x22\x4d\x18': 'lz4'}
+
+# Every codec's extension, for taking it off file names
+EXTENSIONS = ('.bz2', '.gz', '.xz', '.zst', '.lz4')
+
+
+def register(codec):
+    CODECS[codec.name] = codec
+
+
+register(Codec('bz2', '.bz2', b'BZh', bz2.open, 8 << 20))
+register(Codec('gz', '.gz', b'\x1f\x8b', functools.partial(gzip.open, compresslevel=6), 1 << 20))
+register(Codec('xz', '.xz', b'\xfd7zXZ\x00', lzma.open, 1 << 20))
+
+try:
+    from compression import zstd
+    register(Codec('zst', '.zst', b'\x28\xb5\x2f\xfd', zstd.open, 4 << 20))
+except ImportError:
+    try:
+        import zstandard
+
+        def zstandard_open(path, mode='rb'):
+            if 'r' not in mode:
+                return zstandard.open(path, mode)
+            # zstandard.open stops after the first frame
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                                read_across_frames=True)
+            return io.BufferedReader(reader)
+
+        register(Codec('zst', '.zst', b'\x28\xb5\x2f\xfd', zstandard_open, 4 << 20))
+    except ImportError:
+        pass
+
+try:
+    import lz4.frame
+    register(Codec('lz4', '.lz4', b'\x04\x22\x4d\x18', lz4.frame.open, 4 << 20))
+except ImportError:
+    pass
+
+
+def detect(filename):
+    # The codec filename is compressed with, or None for uncompressed
+    with open(filename, 'rb') as f:
+        head = f.read(8)
+    for codec in CODECS.values():
+        if head.startswith(codec.magic):
+            return codec
+    for (magic, name) in KNOWN_MAGIC.items():
+        if head.startswith(magic):
+            raise ValueError("%s is %s compressed, but there is no %s module installed"
+                             % (filename, name, name))
+    return None
+
+
+def codec_for_name(filename):
+    # The codec a file of this name should be written with, or None
+    ext = os.path.splitext(filename.lower())[1]
+    for codec in CODECS.values():
+        if codec.ext == ext:
+            return codec
+    if ext in EXTENSIONS:
+        raise ValueError("No %s module installed to write %s" % (ext[1:], filename))
+    return None
+
+
+def read_size(codec):
+    return PLAIN_READ_SIZE if codec is None else codec.read_size
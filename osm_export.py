@@ -0,0 +1,375 @@
+# ---------------------------------------------------------------------------
+# osm_export.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0913 # Too many arguments
+# pylint: disable=R0914 # Too many locals
+#
+# Exports a BBOX and/or timeframe from a database written by osm2sqlite.py
+# back to OSM XML, so regional extracts that are already loaded don't have
+# to be cut from the planet again with osm_fpextract.py.
+#
+#   osm_export.py -d planet.sqlite -o oahu.osm.bz2 -l -158.29 -r -157.661 -t 21.73 -b 21.2
+#
+# Output is sorted (nodes, ways, relations, each by id) and is written
+# straight to .osm, .osm.gz, .osm.bz2 or .osm.xz (osm_codecs.py)
+# depending on the output name -
+# or to .osm.pbf, through osm_pbf.PbfWriter (blocks encoded in -j
+# processes).
+#
+# Memory stays flat however big the export is:
+#   - The selected ids go into temp tables (INTEGER PRIMARY KEY, so sorted)
+#   - Objects are read a page at a time with keyset pagination
+#     (where id > last id of previous page ... limit N) - no OFFSET, so
+#     every page is an index seek
+#   - Tags, way nodes and members for a page are read with one query per
+#     table, joined against the page's ids in the temp table (between first
+#     and last id of the page), so only the exported objects' rows are read
+#     however sparse the selection is
+#
+# Ways are exported if their bbox overlaps the export bbox, and all of
+# their nodes are exported with them (complete ways) unless -R is given.
+# Relations are exported if they have a node or way member in the export.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_export.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser, OptionGroup
+from xml.sax.saxutils import escape
+import io
+import multiprocessing
+import sqlite3
+import sys
+import time
+
+from osm_codecs import codec_for_name
+from osm_pbf import PbfWriter
+from osm_reader import ObjTypes, OsmObject
+
+# Attribute values also need quotes and whitespace escaped to round trip
+ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+WRITE_BUFFER = 1 << 20
+
+# The child queries cross join (SQLite keeps the join order as written)
+# so the loop runs over the page's temp table ids, with an index lookup
+# per id - given a plain join the planner may range scan the base table
+# from first to last id instead, all of it for a sparse selection.
+SQL = {
+    'nodes_page': "select n.id, n.timestamp, n.user, n.lat, n.lon from export_nodes s "
+                  "join nodes n on n.id = s.id where s.id > ? order by s.id limit ?",
+    'ways_page': "select w.id, w.timestamp, w.user from export_ways s "
+                 "join ways w on w.id = s.id where s.id > ? order by s.id limit ?",
+    'relations_page': "select r.id, r.timestamp, r.user from export_relations s "
+                      "join relations r on r.id = s.id where s.id > ? order by s.id limit ?",
+
+    'node_tags': "select t.node_id, t.key, t.value from export_nodes s "
+                 "cross join node_tags t on t.node_id = s.id where s.id between ? and ?",
+    'way_tags': "select t.way_id, t.key, t.value from export_ways s "
+                "cross join way_tags t on t.way_id = s.id where s.id between ? and ?",
+    'relation_tags': "select t.relation_id, t.key, t.value from export_relations s "
+                     "cross join relation_tags t on t.relation_id = s.id "
+                     "where s.id between ? and ?",
+    'way_nodes': "select wn.way_id, wn.node_id from export_ways s "
+                 "cross join way_nodes wn on wn.way_id = s.id where s.id between ? and ? "
+                 "order by s.id, wn.local_order",
+    'relation_members': "select m.relation_id, m.type, m.ref, m.role from export_relations s "
+                        "cross join relation_members m on m.relation_id = s.id "
+                        "where s.id between ? and ? order by s.id, m.local_order",
+}
+
+
+def attr(value):
+    return escape(value, ATTR_ENTITIES)
+
+
+# ---------------------------------------------------------------------------
+# Open the output, compressed by extension
+# ---------------------------------------------------------------------------
+def open_output(filename):
+    if filename is None or filename == '-':
+        return sys.stdout
+    codec = codec_for_name(filename)
+    if codec is not None:
+        return io.TextIOWrapper(io.BufferedWriter(codec.open(filename, 'wb'), WRITE_BUFFER),
+                                encoding='utf-8')
+    return open(filename, 'w', encoding='utf-8', buffering=WRITE_BUFFER)
+
+
+# ---------------------------------------------------------------------------
+# Fill the export_* temp tables with the ids to export
+# ---------------------------------------------------------------------------
+def select_ids(conn, bbox, timeframe, complete_ways=True):
+    (left, bottom, right, top) = bbox
+    (start, end) = (str(timeframe[0]), str(timeframe[1]))
+
+    conn.execute("create temp table export_nodes (id INTEGER PRIMARY KEY)")
+    conn.execute("create temp table export_ways (id INTEGER PRIMARY KEY)")
+    conn.execute("create temp table export_relations (id INTEGER PRIMARY KEY)")
+
+    conn.execute("insert into export_ways select way_id from way_geometry g "
+                 "join ways w on w.id = g.way_id "
+                 "where g.min_lat <= ? and g.max_lat >= ? "
+                 "and g.min_lon <= ? and g.max_lon >= ? "
+                 "and w.timestamp >= ? and w.timestamp < ?",
+                 (top, bottom, right, left, start, end))
+
+    conn.execute("insert into export_nodes select id from nodes "
+                 "where lat between ? and ? and lon between ? and ? "
+                 "and timestamp >= ? and timestamp < ?",
+                 (bottom, top, left, right, start, end))
+
+    if complete_ways:
+        conn.execute("insert or ignore into export_nodes "
+                     "select wn.node_id from export_ways s cross "
+                     "join way_nodes wn on wn.way_id = s.id "
+                     "join nodes n on n.id = wn.node_id")
+
+    conn.execute("insert into export_relations select distinct relation_id "
+                 "from relation_members m join relations r on r.id = m.relation_id "
+                 "where ((m.type = 'node' and m.ref in (select id from export_nodes)) "
+                 "or (m.type = 'way' and m.ref in (select id from export_ways))) "
+                 "and r.timestamp >= ? and r.timestamp < ?", (start, end))
+
+
+# ---------------------------------------------------------------------------
+# Keyset-paginated pages of (row, children) where children is the merged
+# list of tags (and way nodes/members) for that row.
+# ---------------------------------------------------------------------------
+def pages(conn, page_sql, child_sqls, page_size):
+    last_id = -(1 << 62)
+    while True:
+        rows = conn.execute(page_sql, (last_id, page_size)).fetchall()
+        if not rows:
+            return
+
+        first_id = rows[0][0]
+        last_id = rows[-1][0]
+
+        # One query per child table for the page's ids, grouped by id. The
+        # page is every temp table id from first_id to last_id, so every
+        # child row belongs to a row of the page.
+        children = []
+        for sql in child_sqls:
+            mine = {row[0]: [] for row in rows}
+            for kid in conn.execute(sql, (first_id, last_id)):
+                mine[kid[0]].append(kid)
+            children.append([mine[row[0]] for row in rows])
+
+        yield (rows, children)
+
+
+def common_attrs(row):
+    s = ' id="%d"' % row[0]
+    if row[1]:
+        s += ' timestamp="%s"' % row[1]
+    if row[2]:
+        s += ' user="%s"' % attr(row[2])
+    return s
+
+
+def tag_lines(tags):
+    return ['    <tag k="%s" v="%s"/>' % (attr(k), attr(v)) for (_, k, v) in tags]
+
+
+# ---------------------------------------------------------------------------
+# Write the selection. Returns a dict of counts.
+# ---------------------------------------------------------------------------
+def export(conn, out, bbox=(-180.0, -90.0, 180.0, 90.0),
+           timeframe=('2000-01-01', '2100-01-01'), complete_ways=True, page_size=5000):
+    counts = {'nodes': 0, 'ways': 0, 'relations': 0}
+
+    select_ids(conn, bbox, timeframe, complete_ways)
+
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<osm version="0.6" generator="osm_export.py" timestamp="' + timestamp + '">\n')
+    out.write('  <bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n'
+              % (bbox[1], bbox[0], bbox[3], bbox[2]))
+
+    for (rows, (tags,)) in pages(conn, SQL['nodes_page'], [SQL['node_tags']], page_size):
+        lines = []
+        for (row, mytags) in zip(rows, tags):
+            head = '  <node' + common_attrs(row) + ' lat="%.7f" lon="%.7f"' % (row[3], row[4])
+            if mytags:
+                lines.append(head + '>')
+                lines.extend(tag_lines(mytags))
+                lines.append('  </node>')
+            else:
+                lines.append(head + '/>')
+        lines.append('')
+        out.write('\n'.join(lines))
+        counts['nodes'] += len(rows)
+
+    for (rows, (tags, nds)) in pages(conn, SQL['ways_page'],
+                                     [SQL['way_tags'], SQL['way_nodes']], page_size):
+        lines = []
+        for (row, mytags, mynds) in zip(rows, tags, nds):
+            lines.append('  <way' + common_attrs(row) + '>')
+            lines.extend(['    <nd ref="%d"/>' % nd[1] for nd in mynds])
+            lines.extend(tag_lines(mytags))
+            lines.append('  </way>')
+        lines.append('')
+        out.write('\n'.join(lines))
+        counts['ways'] += len(rows)
+
+    for (rows, (tags, members)) in pages(conn, SQL['relations_page'],
+                                         [SQL['relation_tags'], SQL['relation_members']],
+                                         page_size):
+        lines = []
+        for (row, mytags, mymembers) in zip(rows, tags, members):
+            lines.append('  <relation' + common_attrs(row) + '>')
+            lines.extend(['    <member type="%s" ref="%d" role="%s"/>' % (m[1], m[2], attr(m[3]))
+                          for m in mymembers])
+            lines.extend(tag_lines(mytags))
+            lines.append('  </relation>')
+        lines.append('')
+        out.write('\n'.join(lines))
+        counts['relations'] += len(rows)
+
+    out.write('</osm>\n')
+
+    return counts
+
+
+# ---------------------------------------------------------------------------
+# The same selection as PBF. Returns a dict of counts.
+# ---------------------------------------------------------------------------
+def page_object(obj_type, row, tags):
+    obj = OsmObject(obj_type, row[0])
+    obj.iso_timestamp = row[1] or ''
+    obj.user = row[2] or ''
+    obj.tags = [(k, v) for (_, k, v) in tags]
+    return obj
+
+
+def export_pbf(conn, out, bbox=(-180.0, -90.0, 180.0, 90.0),
+               timeframe=('2000-01-01', '2100-01-01'), complete_ways=True, page_size=5000,
+               workers=0):
+    counts = {'nodes': 0, 'ways': 0, 'relations': 0}
+
+    select_ids(conn, bbox, timeframe, complete_ways)
+    writer = PbfWriter(out, workers, bbox=bbox)
+
+    for (rows, (tags,)) in pages(conn, SQL['nodes_page'], [SQL['node_tags']], page_size):
+        for (row, mytags) in zip(rows, tags):
+            obj = page_object(ObjTypes.node, row, mytags)
+            (obj.lat, obj.lon) = (round(row[3], 7), round(row[4], 7))
+            writer.write(obj)
+        counts['nodes'] += len(rows)
+
+    for (rows, (tags, nds)) in pages(conn, SQL['ways_page'],
+                                     [SQL['way_tags'], SQL['way_nodes']], page_size):
+        for (row, mytags, mynds) in zip(rows, tags, nds):
+            obj = page_object(ObjTypes.way, row, mytags)
+            obj.nodes = [nd[1] for nd in mynds]
+            writer.write(obj)
+        counts['ways'] += len(rows)
+
+    member_types = {'node': ObjTypes.node, 'way': ObjTypes.way, 'relation': ObjTypes.relation}
+    for (rows, (tags, members)) in pages(conn, SQL['relations_page'],
+                                         [SQL['relation_tags'], SQL['relation_members']],
+                                         page_size):
+        for (row, mytags, mymembers) in zip(rows, tags, members):
+            obj = page_object(ObjTypes.relation, row, mytags)
+            obj.members = [(member_types[m[1]], m[2], m[3]) for m in mymembers]
+            writer.write(obj)
+        counts['relations'] += len(rows)
+
+    writer.close()
+    return counts
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-d', '--database', dest='dbname',
+                      help="SQLite3 DB written by osm2sqlite.py", metavar="FILE")
+
+    parser.add_option('-o', '--output', dest='output', default='-',
+                      help="OSM file to write (.osm, .gz, .bz2, .xz, .pbf), default stdout",
+                      metavar="FILE")
+
+    bbox_group = OptionGroup(parser, "Bounding Box (Decimal Degrees)")
+    bbox_group.add_option('-l', '--left', dest='left',
+                          type='float', default='-180.0')
+    bbox_group.add_option('-r', '--right', dest='right',
+                          type='float', default='180.0')
+    bbox_group.add_option('-t', '--top', dest='top',
+                          type='float', default='90.0')
+    bbox_group.add_option('-b', '--bottom', dest='bottom',
+                          type='float', default='-90.0')
+
+    parser.add_option_group(bbox_group)
+
+    tframe_group = OptionGroup(parser, "Time Frame (YYYY-MM-DD)")
+    tframe_group.add_option('-s', '--start', dest='start', default='2000-01-01')
+    tframe_group.add_option('-e', '--end', dest='end', default='2100-01-01')
+    parser.add_option_group(tframe_group)
+
+    parser.add_option('-R', '--resolve', dest='resolve', action="store_false", default=True,
+                      help="DO NOT add the nodes of ways that extend past bbox.")
+
+    parser.add_option('-n', '--page', dest='page', type='int', default=5000,
+                      help="Objects per page.")
+
+    parser.add_option('-j', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help="Processes encoding PBF blocks (default: one per CPU).")
+
+    parser.add_option('-x', '--stats', dest='showstats', action="store_true", default=False,
+                      help="Show processing/debugging statistics.")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    if options.dbname is None:
+        parser.print_help()
+        sys.exit(-1)
+
+    if options.start > options.end:
+        print("End date must be greater than start date\n\n")
+        sys.exit(-1)
+
+    start = time.perf_counter()
+    pbf = options.output.lower().endswith('.pbf')
+
+    try:
+        conn = sqlite3.connect(options.dbname)
+        if pbf:
+            out = open(options.output, 'wb', buffering=WRITE_BUFFER)
+        else:
+            out = open_output(options.output)
+    except (sqlite3.Error, OSError, ValueError) as Err:
+        print("Failed to open: " + str(Err))
+        sys.exit(-1)
+
+    bbox = (options.left, options.bottom, options.right, options.top)
+    if pbf:
+        counts = export_pbf(conn, out, bbox, (options.start, options.end), options.resolve,
+                            options.page, options.workers)
+    else:
+        counts = export(conn, out, bbox, (options.start, options.end), options.resolve,
+                        options.page)
+
+    if out is not sys.stdout:
+        out.close()
+    conn.close()
+
+    if options.showstats:
+        elapsed = time.perf_counter() - start
+        total = counts['nodes'] + counts['ways'] + counts['relations']
+        print("Nodes: " + str(counts['nodes']), file=sys.stderr)
+        print("Ways: " + str(counts['ways']), file=sys.stderr)
+        print("Relations: " + str(counts['relations']), file=sys.stderr)
+        print("Export complete in " + str(elapsed) + " seconds ("
+              + str(int(total / max(elapsed, 1e-9))) + " objects/sec).", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+# ---------------------------------------------------------------------------
+# osm_extsort.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0902
+# pylint: disable=R1732 # Consider using with
+#
+# External (on disk) sort for record tuples that don't fit in RAM.
+#
+#   sorter = ExternalSorter('work', 'waynodes', (int, int, int), run_size=8000000)
+#   for ...:
+#       sorter.add((node_id, way_num, seq))
+#   for record in sorter.sorted():
+#       ...
+#
+# Records are tuples of int/float/coord/str/bytes and sort as tuples, so put the sort key
+# first. add() collects up to run_size records in memory; when full they are
+# sorted and spilled to a run file in the work directory. sorted() merges the
+# runs with heapq.merge, at most MERGE_FANIN at a time: with more runs than
+# that, groups of them are first merged into bigger runs (another write and
+# read of those records), so merge memory is bounded by the fan-in however
+# many runs there are. Up to MERGE_FANIN runs every record is written and
+# read exactly once. If everything fit in one run nothing touches the disk.
+#
+# A merging run holds one block: its payload, and the columns as arrays that
+# are turned into Python values a record at a time as the merge takes them.
+#
+# Run files are binary, written and read a block (BLOCK_RECORDS records) at a
+# time and stored by column so every column is packed/unpacked in bulk with
+# array:
+#   int    - the first column as deltas from the previous record (runs are
+#            sorted, so they're small), the others as is. Either way packed
+#            in the narrowest array type that holds the block's values.
+#   coord  - fixed point int32, 10^-7 degrees (the precision OSM keeps)
+#   float  - float64
+#   str    - utf-8, lengths + one blob
+#   bytes  - as str, without the utf-8
+# With compress=True each block is also zlib'd at level 1, which is cheap
+# and shrinks the narrowed deltas further.
+#
+#   block  = records (u32) payload bytes (u32) flags (u8) payload
+#   column = typecode (u8) bytes (u32) data
+#
+# RunWriter/read_run work on their own for files that are written in
+# order and read back in order (no sort).
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_extsort.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import heapq
+import os
+import struct
+import zlib
+
+from array import array
+from itertools import accumulate
+
+from osm_nodestore import SCALE, INV_SCALE
+
+BLOCK_RECORDS = 65536
+
+BLOCK_HEADER = struct.Struct('<IIB')
+COLUMN_HEADER = struct.Struct('<BI')
+
+FLAG_ZLIB = 1
+
+READ_BUFFER = 1 << 20
+
+# Runs merged at once
+MERGE_FANIN = 64
+
+# Narrowest first
+INT_TYPECODES = 'bBhHiIqQ'
+
+
+def coord(value):
+    # Field type for lon/lat - a float, stored in run files as fixed point
+    return float(value)
+
+
+def narrowest(values):
+    lo = min(values)
+    hi = max(values)
+    for typecode in INT_TYPECODES:
+        bits = array(typecode).itemsize * 8
+        if typecode.islower():
+            if -(1 << (bits - 1)) <= lo and hi < (1 << (bits - 1)):
+                return typecode
+        elif lo >= 0 and hi < (1 << bits):
+            return typecode
+    raise OverflowError("Integer out of range for a run file")
+
+
+def pack_column(field, values, first):
+    if field is int:
+        if first:
+            values = [values[0]] + [b - a for (a, b) in zip(values, values[1:])]
+        typecode = narrowest(values)
+        return (typecode, array(typecode, values).tobytes())
+    if field is coord:
+        return ('i', array('i', [round(v * SCALE) for v in values]).tobytes())
+    if field is float:
+        return ('d', array('d', values).tobytes())
+
+    if field is bytes:
+        encoded = values
+    else:
+        encoded = [str(v).encode('utf-8') for v in values]
+    lengths = [len(e) for e in encoded]
+    typecode = narrowest(lengths)
+    return ('s', bytes((ord(typecode),)) + array(typecode, lengths).tobytes() + b''.join(encoded))
+
+
+def unpack_column(field, typecode, data, first, count):
+    # An iterator over the column's values, decoded as they're taken
+    if typecode == 's':
+        lengths = array(chr(data[0]))
+        end = 1 + lengths.itemsize * count
+        lengths.frombytes(data[1:end])
+        blob = bytes(data[end:])
+        if field is bytes:
+            return (blob[pos - n:pos] for (n, pos) in zip(lengths, accumulate(lengths)))
+        return (blob[pos - n:pos].decode('utf-8')
+                for (n, pos) in zip(lengths, accumulate(lengths)))
+
+    values = array(typecode)
+    values.frombytes(data)
+    if field is coord:
+        return map(INV_SCALE.__rmul__, values)
+    if field is int and first:
+        return accumulate(values)
+    return iter(values)
+
+
+class RunWriter:
+    def __init__(self, path, fields, compress=False):
+        self.fields = fields
+        self.compress = compress
+        self.records = []
+        self.fptr = open(path, 'wb', buffering=READ_BUFFER)
+
+    def add(self, record):
+        self.records.append(record)
+        if len(self.records) >= BLOCK_RECORDS:
+            self.write_block()
+
+    def write_block(self):
+        if not self.records:
+            return
+
+        parts = []
+        for (n, (field, values)) in enumerate(zip(self.fields, zip(*self.records))):
+            (typecode, data) = pack_column(field, values, n == 0)
+            parts.append(COLUMN_HEADER.pack(ord(typecode), len(data)))
+            parts.append(data)
+        payload = b''.join(parts)
+
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+            flags |= FLAG_ZLIB
+
+        self.fptr.write(BLOCK_HEADER.pack(len(self.records), len(payload), flags))
+        self.fptr.write(payload)
+        self.records = []
+
+    def close(self):
+        self.write_block()
+        self.fptr.close()
+
+
+def write_run(path, records, fields, compress=False):
+    writer = RunWriter(path, fields, compress)
+    for pos in range(0, len(records), BLOCK_RECORDS):
+        writer.records = records[pos:pos + BLOCK_RECORDS]
+        writer.write_block()
+    writer.close()
+
+
+def read_run(path, fields):
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            (count, size, flags) = BLOCK_HEADER.unpack(header)
+            payload = f.read(size)
+            if flags & FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            payload = memoryview(payload)
+
+            columns = []
+            pos = 0
+            for (n, field) in enumerate(fields):
+                (typecode, length) = COLUMN_HEADER.unpack_from(payload, pos)
+                pos += COLUMN_HEADER.size
+                columns.append(unpack_column(field, chr(typecode),
+                                             payload[pos:pos + length], n == 0, count))
+                pos += length
+
+            yield from zip(*columns)
+
+
+class ExternalSorter:
+    def __init__(self, workdir, name, fields, run_size=4000000, compress=False):
+        self.workdir = workdir
+        self.name = name
+        self.fields = fields
+        self.run_size = run_size
+        self.compress = compress
+        self.records = []
+        self.runs = []
+        self.run_number = 0
+        self.count = 0
+
+    def add(self, record):
+        self.records.append(record)
+        self.count += 1
+
+        if len(self.records) >= self.run_size:
+            self.spill()
+
+    def run_path(self):
+        path = os.path.join(self.workdir, '%s.run%04d.dat' % (self.name, self.run_number))
+        self.run_number += 1
+        return path
+
+    def spill(self):
+        self.records.sort()
+        path = self.run_path()
+        write_run(path, self.records, self.fields, self.compress)
+        self.runs.append(path)
+        self.records = []
+
+    def merge_runs(self, paths):
+        # Merge paths into one new run, at the end of the list
+        path = self.run_path()
+        writer = RunWriter(path, self.fields, self.compress)
+        for record in heapq.merge(*[read_run(p, self.fields) for p in paths]):
+            writer.add(record)
+        writer.close()
+
+        for p in paths:
+            os.remove(p)
+            self.runs.remove(p)
+        self.runs.append(path)
+
+    def sorted(self):
+        # Everything fit in memory - no disk at all
+        if not self.runs:
+            self.records.sort()
+            records = self.records
+            self.records = []
+            yield from records
+            return
+
+        if self.records:
+            self.spill()
+
+        # Oldest (smallest) runs first, so a record goes through as few
+        # intermediate runs as possible
+        while len(self.runs) > MERGE_FANIN:
+            self.merge_runs(self.runs[:MERGE_FANIN])
+
+        yield from heapq.merge(*[read_run(path, self.fields) for path in self.runs])
+
+    def cleanup(self):
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+        self.records = []
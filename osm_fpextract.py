@@ -53,6 +53,25 @@
 #
 # Of course, all tags for each object are also copied.
 #
+# On a plain .osm file, or a .gz with an osm_gzindex.py checkpoint index,
+# pass 1 also notes where every object it keeps is in the (decompressed)
+# file: an offset and a length, in file order, so it's a sorted list of
+# 16 bytes per object. Pass 2 then doesn't read the input again - it
+# copies those byte ranges out (mmap, or decompressing forward from the
+# nearest checkpoint), so it takes time in proportion to the extract, not
+# the planet. -O FILE saves the list (pairs of little endian uint64
+# offset, length); -F makes pass 2 read the whole input anyway. .bz2
+# (and .xz, ...) files have no decompressed offset index, so they always
+# get the full pass 2.
+#
+# The seek pass 2 writes exactly the versions pass 1 kept; the full one
+# writes every version of a kept way or relation id.
+#
+# -P FILE writes the extract to FILE as PBF instead (osm_pbf.py, blocks
+# encoded and compressed in -j processes). Pass 2 then reads the input
+# object by object, like the full pass 2. PBF has no changesets, so -c
+# does nothing there. PBF input (it's read like any other) needs -P.
+#
 # Since this is designed to work with historical data, it tends to grab more
 # than it needs. Specifically, old, deleted nodes will cause ways and relations
 # to be included (etc.). It does not thoroughly resolve relations because that
@@ -70,7 +89,7 @@
 #
 # ---------------------------------------------------------------------------
 #   Name:       osm_fpextract.py
-#   Version:    1.0
+#   Version:    1.1
 #   Authored    By: Erica Wolf
 #   Copyright:  Public Domain.
 # ---------------------------------------------------------------------------
@@ -87,17 +106,43 @@
 
 # Import modules
 from optparse import OptionParser, OptionGroup
+from array import array
 from datetime import date
+import heapq
+import mmap
+import multiprocessing
+import os
 import sys
 import time
 
-from osm_reader import OsmReader
+from osm_codecs import detect
+from osm_gzindex import GzipRangeReader, index_path
+from osm_pbf import PbfWriter
+from osm_reader import OsmReader, is_pbf
 
 
 class ObjTypes:
     (nul, node, way, relation, changeset, eof) = range(0, 6)
 
 
+def open_ranges(filename):
+    # read(offset, length) on the decompressed input, or None if it can't
+    # seek
+    codec = detect(filename)
+    if is_pbf(filename) or (codec is not None and codec.name != 'gz'):
+        return None
+    if codec is not None:
+        if not os.path.exists(index_path(filename)):
+            return None
+        return GzipRangeReader(filename).read
+
+    fptr = open(filename, 'rb')
+    if os.path.getsize(filename) == 0:
+        return None
+    data = mmap.mmap(fptr.fileno(), 0, access=mmap.ACCESS_READ)
+    return lambda offset, length: data[offset:offset + length]
+
+
 parser = OptionParser()
 
 parser.add_option('-i', '--input', dest='filename',
@@ -130,6 +175,19 @@ parser.add_option('-R', '--resolve', dest='resolve', action="store_false", defau
                   help='''DO NOT resolve ways and relations
                           that extend past bbox (default is to resolve).''')
 
+parser.add_option('-F', '--full-scan', dest='full_scan', action="store_true", default=False,
+                  help="Read the whole input in pass 2 even when it can seek.")
+
+parser.add_option('-O', '--offsets', dest='offsets', default=None, metavar="FILE",
+                  help="Save the offsets/lengths of the extracted objects to FILE.")
+
+parser.add_option('-P', '--pbf', dest='pbf', default=None, metavar="FILE",
+                  help="Write the extract to FILE as PBF instead of XML to stdout.")
+
+parser.add_option('-j', '--workers', dest='workers', type='int',
+                  default=multiprocessing.cpu_count(),
+                  help="Processes encoding PBF blocks for -P (default: one per CPU).")
+
 parser.add_option('-x', '--stats', dest='showstats', action="store_true", default=False,
                   help="Show processing/debugging statistics.")
 
@@ -161,9 +219,26 @@ if start_date > end_date:
     print("End date must be greater than start date\n\n")
     sys.exit(-1)
 
+if options.pbf is None and is_pbf(inFile):
+    print("PBF input is extracted to PBF: use -P FILE")
+    sys.exit(-1)
+
 # Show stats just does the first pass and gives stats on the data
 show_stats = options.showstats
 
+# Seek based pass 2: where each kept object is, in file order
+read_range = None
+if not options.full_scan and options.pbf is None:
+    read_range = open_ranges(inFile)
+obj_offsets = array('Q')
+obj_lengths = array('Q')
+last_node = -1
+
+# Changesets are only known to be wanted after pass 1
+cs_ids = array('q')
+cs_offsets = array('Q')
+cs_lengths = array('Q')
+
 node_list = set()
 way_list = set()
 relation_list = set()
@@ -224,6 +299,12 @@ try:
             if (obj_count % 250000) == 0:
                 print("Processed " + str(obj_count) + " objects.")
 
+        if read_range is not None and output_changesets and \
+                inputfile.obj_type == ObjTypes.changeset:
+            cs_ids.append(inputfile.obj_id)
+            cs_offsets.append(inputfile.obj_offset)
+            cs_lengths.append(inputfile.obj_length)
+
         # Is the node within the timestamp?
         if (inputfile.obj_timestamp < start_date or inputfile.obj_timestamp > end_date):
             continue
@@ -254,6 +335,16 @@ try:
             if not output_history:
                 node_ver_dict[inputfile.obj_id] = inputfile.obj_version
 
+            if read_range is not None:
+                # A later version of the last node kept replaces it
+                if not output_history and last_node == inputfile.obj_id:
+                    obj_offsets[-1] = inputfile.obj_offset
+                    obj_lengths[-1] = inputfile.obj_length
+                else:
+                    obj_offsets.append(inputfile.obj_offset)
+                    obj_lengths.append(inputfile.obj_length)
+                last_node = inputfile.obj_id
+
         # Way
         elif inputfile.obj_type == ObjTypes.way:
 
@@ -264,6 +355,11 @@ try:
 
                     changeset_list.add(inputfile.obj_changeset)
 
+                    if read_range is not None:
+                        obj_offsets.append(inputfile.obj_offset)
+                        obj_lengths.append(inputfile.obj_length)
+                        last_node = -1
+
                     # This adds nodes not in BBOX but part of way that intersects it
                     # This really slows things down!
                     # if resolve:
@@ -278,6 +374,11 @@ try:
 
             relation_list.add(inputfile.obj_id)
             changeset_list.add(inputfile.obj_changeset)
+
+            if read_range is not None:
+                obj_offsets.append(inputfile.obj_offset)
+                obj_lengths.append(inputfile.obj_length)
+                last_node = -1
             node_list.update(relation_nodes)
             way_list.update(relation_ways)
 
@@ -295,7 +396,7 @@ try:
     del inputfile
 
 except Exception as Err:
-    print("Step 1 Failed : " + type(Err.message))
+    print("Step 1 Failed : " + str(Err))
     print("Line " + str(inputfile.line_count) +
           ":" + inputfile.get_next_tag())
     print("Bytes read: " + str(inputfile.get_bytes_read()))
@@ -303,136 +404,192 @@ except Exception as Err:
     print("Extract incomplete in " + str(finish - start) + " seconds.")
     sys.exit(-2)
 
-LINE_COUNT = 0
+# The wanted changesets go in with the other objects, in file order
+ranges = zip(obj_offsets, obj_lengths)
+if read_range is not None and cs_ids:
+    ranges = heapq.merge(ranges, [(o, n) for (i, o, n) in zip(cs_ids, cs_offsets, cs_lengths)
+                                  if i in changeset_list])
+    ranges = list(ranges)
+    obj_offsets = array('Q', (o for (o, _) in ranges))
+    obj_lengths = array('Q', (n for (_, n) in ranges))
+
+if options.offsets is not None and read_range is not None:
+    with open(options.offsets, 'wb') as f:
+        pairs = array('Q')
+        for (o, n) in zip(obj_offsets, obj_lengths):
+            pairs.append(o)
+            pairs.append(n)
+        if sys.byteorder != 'little':
+            pairs.byteswap()
+        pairs.tofile(f)
+
+if options.pbf is not None:
+    # PBF pass 2: the same objects as the full pass 2, through PbfWriter
+    try:
+        inputfile = OsmReader(inFile)
+        with open(options.pbf, 'wb') as pbf_file:
+            writer = PbfWriter(pbf_file, options.workers, output_history,
+                               (bbox_left, bbox_bottom, bbox_right, bbox_top))
+            for obj in inputfile.objects():
+                if obj.type == ObjTypes.node:
+                    if obj.id in node_list and (output_history
+                                                or node_ver_dict[obj.id] == obj.version):
+                        writer.write(obj)
+                elif obj.type == ObjTypes.way:
+                    if obj.id in way_list:
+                        writer.write(obj)
+                elif obj.type == ObjTypes.relation:
+                    if obj.id in relation_list:
+                        writer.write(obj)
+            writer.close()
 
-try:
-    # Input is maybe a very big file
-    inputfile = OsmReader(inFile)
+        if show_stats:
+            print("Objects written: " + str(writer.count))
 
-    # OSM XML Header stuff - made up as usual
-    print('<?xml version="1.0" encoding="UTF-8"?>')
-    # "2011-02-16T01:11:04Z"  "%Y-%m-%dT%H:%M:%SZ"
-    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    print('<osm version="0.6" generator="OSM_Extract.py" timestamp="' + timestamp + '">')
-    print(''''<!-- copyright="OpenStreetMap and contributors"
-                   attribution="http://www.openstreetmap.org/copyright/"
-                   license="http://creativecommons.org/licenses/by/2.0/" 
-             -->''')
-    print('  <bound box="' + str(bbox_left) + ',' + str(bbox_bottom)
-          + ',' + str(bbox_right) + ',' + str(bbox_top)
-          + '> origin="http://www.openstreetmap.org/api/0.6" />')
-
-    KEEP_FLAG = False
+    except Exception as ErrorDesc:
+        print("Step 2 Failed : " + str(ErrorDesc))
+        finish = time.perf_counter()
+        print("Extract incomplete in " + str(finish - start) + " seconds.")
+        sys.exit(-2)
 
+else:
     LINE_COUNT = 0
 
-    while True:
-        # Read one XML tag without depending on line breaks
-        # (so this works with history files)
-        line = inputfile.get_next_tag()
+    try:
+        if read_range is None:
+            # Input is maybe a very big file
+            inputfile = OsmReader(inFile)
+
+        # OSM XML Header stuff - made up as usual
+        print('<?xml version="1.0" encoding="UTF-8"?>')
+        # "2011-02-16T01:11:04Z"  "%Y-%m-%dT%H:%M:%SZ"
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        print('<osm version="0.6" generator="OSM_Extract.py" timestamp="' + timestamp + '">')
+        print('''<!-- copyright="OpenStreetMap and contributors"
+                       attribution="http://www.openstreetmap.org/copyright/"
+                       license="http://creativecommons.org/licenses/by/2.0/" 
+                 -->''')
+        print('  <bound box="' + str(bbox_left) + ',' + str(bbox_bottom)
+              + ',' + str(bbox_right) + ',' + str(bbox_top)
+              + '" origin="http://www.openstreetmap.org/api/0.6" />')
+
+        KEEP_FLAG = False
+
+        LINE_COUNT = 0
+
+        # Seek based: copy the objects' bytes straight to the output
+        if read_range is not None:
+            sys.stdout.flush()
+            for (offset, length) in zip(obj_offsets, obj_lengths):
+                sys.stdout.buffer.write(read_range(offset, length))
+            sys.stdout.buffer.write(b'\n')
+            sys.stdout.buffer.flush()
+
+        while read_range is None:
+            # Read one XML tag without depending on line breaks
+            # (so this works with history files)
+            line = inputfile.get_next_tag()
+
+            LINE_COUNT += 1
+
+            if line == '':
+                break
+
+            if line[1] == '/':
+                element = line[1:line.find('>', 1)]  # FIXME!
+            else:
+                element = line[1:line.find(' ', 1)]
+
+            #
+            # Node
+            #
+            if element == 'node':
+                KEEP_FLAG = False
+
+                s = line.find('id="', 5) + 4
+                e = line.find('"', s)
+                node_id = int(line[s:e])
 
-        LINE_COUNT += 1
-
-        if line == '':
-            break
-
-        if line[1] == '/':
-            element = line[1:line.find('>', 1)]  # FIXME!
-        else:
-            element = line[1:line.find(' ', 1)]
-
-        #
-        # Node
-        #
-        if element == 'node':
-            KEEP_FLAG = False
-
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            node_id = int(line[s:e])
-
-            if node_id in node_list:
-                # Save the highest version number
-                if not output_history:
-                    s = line.find('version="', 4) + 9
-                    e = line.find('"', s)
-                    ver = int(line[s:e])
-                    if node_ver_dict[node_id] == ver:
-                        print("  " + line.encode("utf-8", "ignore"))
+                if node_id in node_list:
+                    # Save the highest version number
+                    if not output_history:
+                        s = line.find('version="', 4) + 9
+                        e = line.find('"', s)
+                        ver = int(line[s:e])
+                        if node_ver_dict[node_id] == ver:
+                            print("  " + line)
+                            if not line[-2] == '/':
+                                KEEP_FLAG = True
+                    else:
+                        print("  " + line)
                         if not line[-2] == '/':
                             KEEP_FLAG = True
-                else:
-                    print("  " + line.encode("utf-8", "ignore"))
-                    if not line[-2] == '/':
-                        KEEP_FLAG = True
-
-        #
-        # Way
-        #
-        elif element == 'way':
-            KEEP_FLAG = False
-
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            way_id = int(line[s:e])
-
-            if way_id in way_list:
-                print("  " + line.encode("utf-8", "ignore"))
-                KEEP_FLAG = True
-
-        #
-        # Relation
-        #
-        elif element == 'relation':
-            KEEP_FLAG = False
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            rel_id = int(line[s:e])
-
-            if rel_id in relation_list:
-                print("  " + line.encode("utf-8", "ignore"))
-                KEEP_FLAG = True
 
-        #
-        # Changeset
-        #
-        elif element == 'changeset':
-            KEEP_FLAG = False
-
-            s = line.find('id="', 5) + 4
-            e = line.find('"', s)
-            cs_id = int(line[s:e])
-
-            if output_changesets and cs_id in changeset_list:
-                print("    " + line.encode("utf-8", "ignore"))
-                KEEP_FLAG = True
-
-        elif element in ['tag', 'nd', 'member']:
-            if KEEP_FLAG:
-                print("    " + line.encode("utf-8", "ignore"))
-
-        elif element in ['/node', '/way', '/relation', '/changeset']:
-            if KEEP_FLAG:
-                print("  " + line.encode("utf-8", "ignore"))
-
-            KEEP_FLAG = False
-
-        else:
-            if KEEP_FLAG:
-                print("  " + line.encode("utf-8", "ignore"))
-
-    # While True:
-
-    print('</osm>\n')
-
-except Exception as ErrorDesc:
-    print("Step 2 Failed : " + type(ErrorDesc))
-    print("Line " + str(inputfile.LINE_COUNT) + ":" +
-          inputfile.getTag().encode("utf-8", "ignore"))
-    print("Bytes read: " + str(inputfile.get_bytes_read()))
-    finish = time.perf_counter()
-    print("Extract incomplete in " + str(finish - start) + " seconds.")
-    sys.exit(-2)
+            #
+            # Way
+            #
+            elif element == 'way':
+                KEEP_FLAG = False
+
+                s = line.find('id="', 5) + 4
+                e = line.find('"', s)
+                way_id = int(line[s:e])
+
+                if way_id in way_list:
+                    print("  " + line)
+                    KEEP_FLAG = True
+
+            #
+            # Relation
+            #
+            elif element == 'relation':
+                KEEP_FLAG = False
+                s = line.find('id="', 5) + 4
+                e = line.find('"', s)
+                rel_id = int(line[s:e])
+
+                if rel_id in relation_list:
+                    print("  " + line)
+                    KEEP_FLAG = True
+
+            #
+            # Changeset
+            #
+            elif element == 'changeset':
+                KEEP_FLAG = False
+
+                s = line.find('id="', 5) + 4
+                e = line.find('"', s)
+                cs_id = int(line[s:e])
+
+                if output_changesets and cs_id in changeset_list:
+                    print("    " + line)
+                    KEEP_FLAG = True
+
+            elif element in ['tag', 'nd', 'member']:
+                if KEEP_FLAG:
+                    print("    " + line)
+
+            elif element in ['/node', '/way', '/relation', '/changeset']:
+                if KEEP_FLAG:
+                    print("  " + line)
+
+                KEEP_FLAG = False
+
+            else:
+                if KEEP_FLAG:
+                    print("  " + line)
+
+        # While True:
+
+        print('</osm>\n')
+
+    except Exception as ErrorDesc:
+        print("Step 2 Failed : " + str(ErrorDesc))
+        print("Line " + str(LINE_COUNT))
+        finish = time.perf_counter()
+        print("Extract incomplete in " + str(finish - start) + " seconds.")
+        sys.exit(-2)
 
 finish = time.perf_counter()
 if show_stats:
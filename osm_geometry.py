@@ -0,0 +1,219 @@
+# ---------------------------------------------------------------------------
+# osm_geometry.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+#
+# Well-Known Binary (WKB) encoding for OSM geometries.
+#
+# Coordinates are passed around as flat sequences - x0, y0, x1, y1, ... -
+# usually an array('d'), in lon/lat order like every other WKB producer.
+# Keeping them flat means one array per way instead of one tuple per node,
+# and lets the encoder use array.tobytes() instead of packing point by point.
+#
+# All WKB written here is little-endian (byte order flag 1).
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_geometry.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import struct
+import sys
+
+from array import array
+
+
+class WkbTypes:
+    (point, linestring, polygon) = range(1, 4)
+    (multipoint, multilinestring, multipolygon) = range(4, 7)
+
+
+# Closed ways with one of these keys are areas unless tagged area=no
+AREA_KEYS = {'building', 'landuse', 'natural', 'leisure', 'amenity', 'area',
+             'water', 'waterway', 'place', 'boundary', 'man_made', 'shop',
+             'tourism', 'historic', 'military', 'aeroway', 'landcover'}
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+_header = struct.Struct('<BI')
+_count = struct.Struct('<I')
+_point = struct.Struct('<BIdd')
+
+
+def _coord_bytes(coords):
+    # array('d') is native byte order; WKB here is always little-endian
+    if not isinstance(coords, array):
+        coords = array('d', coords)
+    if not _LITTLE_ENDIAN:
+        coords = array('d', coords)
+        coords.byteswap()
+    return coords.tobytes()
+
+
+# ---------------------------------------------------------------------------
+# Is a closed way an area? (first == last node and tags say so)
+# ---------------------------------------------------------------------------
+def is_area(node_ids, tags):
+    if len(node_ids) < 4 or node_ids[0] != node_ids[-1]:
+        return False
+
+    area = False
+    for (key, value) in tags:
+        if key == 'area':
+            return value != 'no'
+        if key in AREA_KEYS:
+            area = True
+
+    return area
+
+
+# ---------------------------------------------------------------------------
+# Bounding box of a flat coordinate sequence: (min_x, min_y, max_x, max_y)
+# ---------------------------------------------------------------------------
+def bbox(coords):
+    xs = coords[0::2]
+    ys = coords[1::2]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+# ---------------------------------------------------------------------------
+# Hilbert curve key of a lon/lat on a 2^order x 2^order grid over the world.
+# Sorting by it puts things that are close together on the ground close
+# together in the output.
+# ---------------------------------------------------------------------------
+def hilbert_key(lon, lat, order=16):
+    side = 1 << order
+    x = min(side - 1, max(0, int((lon + 180.0) / 360.0 * side)))
+    y = min(side - 1, max(0, int((lat + 90.0) / 180.0 * side)))
+
+    key = 0
+    s = side >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        key += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = side - 1 - x
+                y = side - 1 - y
+            (x, y) = (y, x)
+        s >>= 1
+
+    return key
+
+
+# ---------------------------------------------------------------------------
+# Encoders
+# ---------------------------------------------------------------------------
+def point_wkb(x, y):
+    return _point.pack(1, WkbTypes.point, x, y)
+
+
+def linestring_wkb(coords):
+    return (_header.pack(1, WkbTypes.linestring)
+            + _count.pack(len(coords) // 2)
+            + _coord_bytes(coords))
+
+
+def _rings_bytes(rings):
+    parts = [_count.pack(len(rings))]
+    for ring in rings:
+        parts.append(_count.pack(len(ring) // 2))
+        parts.append(_coord_bytes(ring))
+    return b''.join(parts)
+
+
+def polygon_wkb(rings):
+    # rings[0] is the outer ring, the rest are holes
+    return _header.pack(1, WkbTypes.polygon) + _rings_bytes(rings)
+
+
+def multipolygon_wkb(polygons):
+    parts = [_header.pack(1, WkbTypes.multipolygon), _count.pack(len(polygons))]
+    for rings in polygons:
+        parts.append(_header.pack(1, WkbTypes.polygon))
+        parts.append(_rings_bytes(rings))
+    return b''.join(parts)
+
+
+# ---------------------------------------------------------------------------
+# Decoder - returns (wkb_type, parts)
+#
+#   point        - parts is array('d', [x, y])
+#   linestring   - parts is a flat array('d')
+#   polygon      - parts is a list of rings (flat arrays)
+#   multipolygon - parts is a list of polygons (lists of rings)
+# ---------------------------------------------------------------------------
+def _read_coords(blob, pos, npoints):
+    end = pos + npoints * 16
+    coords = array('d')
+    coords.frombytes(blob[pos:end])
+    if not _LITTLE_ENDIAN:
+        coords.byteswap()
+    return (coords, end)
+
+
+def _read_rings(blob, pos):
+    (nrings,) = _count.unpack_from(blob, pos)
+    pos += 4
+    rings = []
+    for _ in range(nrings):
+        (npoints,) = _count.unpack_from(blob, pos)
+        (ring, pos) = _read_coords(blob, pos + 4, npoints)
+        rings.append(ring)
+    return (rings, pos)
+
+
+def parse_wkb(blob):
+    (order, wkb_type) = _header.unpack_from(blob, 0)
+    if order != 1:
+        raise ValueError("Only little-endian WKB is supported")
+
+    if wkb_type == WkbTypes.point:
+        return (wkb_type, _read_coords(blob, 5, 1)[0])
+
+    if wkb_type == WkbTypes.linestring:
+        (npoints,) = _count.unpack_from(blob, 5)
+        return (wkb_type, _read_coords(blob, 9, npoints)[0])
+
+    if wkb_type == WkbTypes.polygon:
+        return (wkb_type, _read_rings(blob, 5)[0])
+
+    if wkb_type == WkbTypes.multipolygon:
+        (npolys,) = _count.unpack_from(blob, 5)
+        pos = 9
+        polygons = []
+        for _ in range(npolys):
+            (rings, pos) = _read_rings(blob, pos + 5)
+            polygons.append(rings)
+        return (wkb_type, polygons)
+
+    raise ValueError("Unsupported WKB type %d" % wkb_type)
+
+
+# ---------------------------------------------------------------------------
+# Worker entry point: (way_id, coords, area) -> geometry row
+#
+# Returns (way_id, min_lon, min_lat, max_lon, max_lat, wkb) or None when the
+# way has fewer than two resolved nodes. Top-level so it can be pickled by
+# multiprocessing.
+# ---------------------------------------------------------------------------
+def build_way_geometry(item):
+    (way_id, coords, area) = item
+
+    if len(coords) < 4:
+        return None
+
+    if area:
+        blob = polygon_wkb([coords])
+    else:
+        blob = linestring_wkb(coords)
+
+    (min_x, min_y, max_x, max_y) = bbox(coords)
+    return (way_id, min_x, min_y, max_x, max_y, blob)
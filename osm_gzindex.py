@@ -0,0 +1,463 @@
+# ---------------------------------------------------------------------------
+# osm_gzindex.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0902
+#
+# Random access into a .gz OSM file through a checkpoint index (the zran
+# technique from zlib's examples):
+#
+#   osm_gzindex.py -i planet.osm.gz [-s 32] [-p 8]
+#
+#       planet.osm.gz.idx
+#
+# Deflate can't start just anywhere: every byte depends on up to 32KB of
+# output before it, and blocks start at arbitrary bit offsets. So one
+# streaming pass stops at the first block boundary after every -s MB of
+# output and saves a checkpoint there - the compressed byte and bit
+# offset, the uncompressed offset and the 32KB window before it
+# (compressed). Decompressing from a checkpoint is: seek, prime the
+# leftover bits, set the window as the dictionary, inflate. Each
+# checkpoint also has the distance to the first object start after it.
+#
+# With the index, OsmReader(path.gz, byte_range=(start, end)) takes
+# uncompressed offsets, like byte ranges of an uncompressed file: it
+# starts at the checkpoint before start and drops the difference, so a
+# seek costs decompressing at most -s MB. split_ranges() cuts the file into
+# object-aligned ranges at checkpoints for parallel readers (-p prints
+# them). A smaller -s means faster seeks and a bigger index (about 10-15KB
+# per checkpoint); osm_bench.py gzseek measures both.
+#
+# Multi-member files (pigz, osm_chunker.py -z gz appends) work too.
+#
+# Python's zlib module has neither Z_BLOCK nor inflatePrime, so this
+# calls the zlib shared library through ctypes.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_gzindex.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser
+from bisect import bisect_right
+import ctypes
+import ctypes.util
+import io
+import os
+import struct
+import sys
+import time
+import zlib
+
+from osm_codecs import detect
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+WINDOW_SIZE = 32768
+READ_SIZE = 1 << 20
+OUT_SIZE = 1 << 18
+
+# Object start tags, for the first object after each checkpoint
+OBJECT_STARTS = (b'<node ', b'<way ', b'<relation ', b'<changeset ')
+
+# Index file: header, compressed windows, then the checkpoint table
+# (offset of the table in the header)
+INDEX_MAGIC = b'OSMGZIX1'
+HEADER = struct.Struct('<8sQQQQI')    # magic, size, mtime, length, span, checkpoints
+TABLE_OFFSET = struct.Struct('<Q')
+CHECKPOINT = struct.Struct('<QQBqQI')  # out, in, bits, skip, window at, window length
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+
+def load_zlib():
+    name = ctypes.util.find_library('z')
+    if name is None:
+        raise OSError("The zlib shared library (libz) isn't installed")
+    lib = ctypes.CDLL(name)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    return lib
+
+
+_zlib = None
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+# ---------------------------------------------------------------------------
+# inflate through libz. wbits as for zlib: -15 raw deflate, 31 gzip, 47
+# gzip or zlib.
+# ---------------------------------------------------------------------------
+class Inflater:
+    def __init__(self, wbits):
+        global _zlib
+        if _zlib is None:
+            _zlib = load_zlib()
+
+        self.strm = ZStream()
+        self.input = b''
+        self.out = ctypes.create_string_buffer(OUT_SIZE)
+        ret = _zlib.inflateInit2_(ctypes.byref(self.strm), wbits, _zlib.zlibVersion(),
+                                  ctypes.sizeof(ZStream))
+        if ret != Z_OK:
+            raise OSError("inflateInit2 failed (%d)" % ret)
+
+    def feed(self, data):
+        # Keep a reference; zlib reads straight out of the bytes object
+        self.input = data
+        self.strm.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self.strm.avail_in = len(data)
+
+    def advance(self, count):
+        self.strm.next_in += count
+        self.strm.avail_in -= count
+
+    def prime(self, bits, value):
+        _zlib.inflatePrime(ctypes.byref(self.strm), bits, value)
+
+    def set_window(self, window):
+        if window:
+            _zlib.inflateSetDictionary(ctypes.byref(self.strm), window, len(window))
+
+    def reset(self, wbits=None):
+        if wbits is None:
+            _zlib.inflateReset(ctypes.byref(self.strm))
+        else:
+            _zlib.inflateReset2(ctypes.byref(self.strm), wbits)
+
+    def inflate(self, size, flush=Z_NO_FLUSH):
+        # (return code, output)
+        size = min(size, OUT_SIZE)
+        self.strm.next_out = ctypes.addressof(self.out)
+        self.strm.avail_out = size
+        ret = _zlib.inflate(ctypes.byref(self.strm), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise OSError("Corrupt gzip data (%d)" % ret)
+        return (ret, ctypes.string_at(self.out, size - self.strm.avail_out))
+
+    def close(self):
+        _zlib.inflateEnd(ctypes.byref(self.strm))
+
+
+# ---------------------------------------------------------------------------
+# Building
+# ---------------------------------------------------------------------------
+def find_object(data):
+    starts = [p for p in (data.find(s) for s in OBJECT_STARTS) if p >= 0]
+    return min(starts) if starts else -1
+
+
+def build_index(path, span=32 << 20):
+    inflater = Inflater(47)
+    checkpoints = []
+    window = b''
+    (total_in, total_out, last) = (0, 0, -span)
+
+    # The last checkpoint that hasn't found its first object yet, the
+    # output since it (with a few bytes of overlap) to look in and where
+    # that starts
+    pending = None
+    scan = b''
+    scan_at = 0
+
+    out_path = index_path(path)
+    with open(path, 'rb') as f, open(out_path, 'wb') as idx:
+        idx.write(b'\0' * (HEADER.size + TABLE_OFFSET.size))
+
+        while True:
+            if inflater.strm.avail_in == 0:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                inflater.feed(data)
+
+            before = inflater.strm.avail_in
+            (ret, out) = inflater.inflate(OUT_SIZE, Z_BLOCK)
+            total_in += before - inflater.strm.avail_in
+
+            if out:
+                total_out += len(out)
+                window = (window + out)[-WINDOW_SIZE:]
+                if pending is not None:
+                    scan += out
+                    p = find_object(scan)
+                    if p >= 0:
+                        pending[3] = scan_at + p - pending[0]
+                        pending = None
+                    else:
+                        drop = max(0, len(scan) - 16)
+                        scan_at += drop
+                        scan = scan[drop:]
+
+            if ret == Z_STREAM_END:
+                # Another gzip member may follow
+                inflater.reset()
+                continue
+
+            # At a block boundary that isn't the end of the member
+            dt = inflater.strm.data_type
+            if (dt & 128) and not dt & 64 and total_out - last >= span:
+                blob = zlib.compress(window, 6)
+                checkpoints.append([total_out, total_in, dt & 7, -1, idx.tell(), len(blob)])
+                idx.write(blob)
+                last = total_out
+                pending = checkpoints[-1]
+                (scan, scan_at) = (b'', total_out)
+
+        inflater.close()
+
+        table = idx.tell()
+        for cp in checkpoints:
+            idx.write(CHECKPOINT.pack(*cp))
+        idx.seek(0)
+        idx.write(HEADER.pack(INDEX_MAGIC, os.path.getsize(path), int(os.path.getmtime(path)),
+                              total_out, span, len(checkpoints)))
+        idx.write(TABLE_OFFSET.pack(table))
+
+    return load_index(path)
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+class GzipIndex:
+    def __init__(self, path, size, length, span, checkpoints):
+        self.path = path
+        self.size = size
+        self.length = length
+        self.span = span
+        self.checkpoints = checkpoints
+        self.outs = [cp[0] for cp in checkpoints]
+
+    def checkpoint_before(self, offset):
+        pos = bisect_right(self.outs, offset) - 1
+        return self.checkpoints[pos] if pos >= 0 else None
+
+    def window(self, checkpoint):
+        with open(index_path(self.path), 'rb') as f:
+            f.seek(checkpoint[4])
+            return zlib.decompress(f.read(checkpoint[5]))
+
+
+def load_index(path):
+    with open(index_path(path), 'rb') as f:
+        (magic, size, _, length, span, count) = HEADER.unpack(f.read(HEADER.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError(index_path(path) + " isn't a gzip checkpoint index")
+        if size != os.path.getsize(path):
+            raise ValueError(index_path(path) + " is out of date - rebuild it")
+        (table,) = TABLE_OFFSET.unpack(f.read(TABLE_OFFSET.size))
+        f.seek(table)
+        data = f.read(count * CHECKPOINT.size)
+    checkpoints = [cp for cp in CHECKPOINT.iter_unpack(data)]
+    return GzipIndex(path, size, length, span, checkpoints)
+
+
+# ---------------------------------------------------------------------------
+# Raw file of the uncompressed bytes [start, end) of a .gz file, end None
+# for the end of the data
+# ---------------------------------------------------------------------------
+class GzipRangeFile(io.RawIOBase):
+    def __init__(self, filename, start, end=None, index=None):
+        super().__init__()
+        if index is None:
+            index = load_index(filename)
+
+        self.fptr = open(filename, 'rb')
+        self.trailer = 0
+        self.done = False
+
+        checkpoint = index.checkpoint_before(start)
+        if checkpoint is None:
+            # Before the first checkpoint: from the top
+            self.inflater = Inflater(47)
+            self.raw = False
+            drop = start
+        else:
+            (out, offset, bits) = checkpoint[:3]
+            self.inflater = Inflater(-15)
+            self.raw = True
+            if bits:
+                self.fptr.seek(offset - 1)
+                self.inflater.prime(bits, self.fptr.read(1)[0] >> (8 - bits))
+            else:
+                self.fptr.seek(offset)
+            self.inflater.set_window(index.window(checkpoint))
+            drop = start - out
+
+        while drop > 0:
+            data = self.inflate(drop)
+            if not data:
+                break
+            drop -= len(data)
+
+        self.remaining = None if end is None else end - start
+
+    def readable(self):
+        return True
+
+    def inflate(self, size):
+        while not self.done:
+            if self.inflater.strm.avail_in == 0:
+                data = self.fptr.read(READ_SIZE)
+                if not data:
+                    self.done = True
+                    break
+                self.inflater.feed(data)
+
+            # The gzip trailer after a member read as raw deflate; the next
+            # member has a gzip header
+            if self.trailer:
+                n = min(self.trailer, self.inflater.strm.avail_in)
+                self.inflater.advance(n)
+                self.trailer -= n
+                if self.trailer:
+                    continue
+                self.inflater.reset(31)
+                self.raw = False
+
+            (ret, out) = self.inflater.inflate(size)
+            if ret == Z_STREAM_END:
+                if self.raw:
+                    self.trailer = 8
+                else:
+                    self.inflater.reset()
+            if out:
+                return out
+        return b''
+
+    def readinto(self, b):
+        n = len(b)
+        if self.remaining is not None:
+            n = min(n, self.remaining)
+        if n <= 0:
+            return 0
+        data = self.inflate(n)
+        b[:len(data)] = data
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.inflater.close()
+            self.fptr.close()
+        super().close()
+
+
+# ---------------------------------------------------------------------------
+# read(offset, length) for ranges in increasing order: keeps decompressing
+# forward while the next range is less than a span ahead, and only goes
+# back to a checkpoint for the ones further on
+# ---------------------------------------------------------------------------
+class GzipRangeReader:
+    def __init__(self, filename, index=None):
+        self.filename = filename
+        self.index = index if index is not None else load_index(filename)
+        self.fptr = None
+        self.pos = 0
+
+    def read_exact(self, size):
+        parts = []
+        while size > 0:
+            data = self.fptr.read(min(size, READ_SIZE))
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+            self.pos += len(data)
+        return b''.join(parts)
+
+    def read(self, offset, length):
+        if self.fptr is None or offset < self.pos or offset - self.pos > self.index.span:
+            self.close()
+            self.fptr = GzipRangeFile(self.filename, offset, None, self.index)
+            self.pos = offset
+        self.read_exact(offset - self.pos)
+        return self.read_exact(length)
+
+    def close(self):
+        if self.fptr is not None:
+            self.fptr.close()
+            self.fptr = None
+
+
+def split_ranges(index, pieces):
+    # Up to `pieces` object-aligned (start, end) uncompressed ranges, cut
+    # at the first object after evenly spaced checkpoints
+    cuts = [0]
+    for n in range(1, pieces):
+        checkpoint = index.checkpoint_before(index.length * n // pieces)
+        if checkpoint is not None and checkpoint[3] >= 0:
+            cut = checkpoint[0] + checkpoint[3]
+            if cut > cuts[-1]:
+                cuts.append(cut)
+    return [(start, cuts[n + 1] if n + 1 < len(cuts) else None)
+            for (n, start) in enumerate(cuts)]
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-i', '--input', dest='filename',
+                      help=".gz OSM file to index", metavar="FILE")
+
+    parser.add_option('-s', '--span', dest='span', type='int', default=32,
+                      help="MB of uncompressed data between checkpoints (default 32).")
+
+    parser.add_option('-p', '--pieces', dest='pieces', type='int', default=0,
+                      help="Print this many object-aligned byte ranges for parallel readers.")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    filename = options.filename
+    if filename is None and args:
+        filename = args[0]
+    if filename is None or options.span < 1:
+        parser.print_help()
+        sys.exit(-1)
+    codec = detect(filename) if os.path.exists(filename) else None
+    if codec is None or codec.name != 'gz':
+        print(filename + " is not a gzip file")
+        sys.exit(-1)
+
+    start = time.perf_counter()
+    try:
+        if options.pieces and os.path.exists(index_path(filename)):
+            index = load_index(filename)
+        else:
+            index = build_index(filename, options.span << 20)
+            print("%d checkpoints, %d bytes of index for %d bytes of data, in %.1f seconds"
+                  % (len(index.checkpoints), os.path.getsize(index_path(filename)),
+                     index.length, time.perf_counter() - start))
+    except (OSError, ValueError) as Err:
+        print("Unable to index " + filename + ": " + str(Err))
+        sys.exit(-1)
+
+    if options.pieces:
+        for (s, e) in split_ranges(index, options.pieces):
+            print("%d %d" % (s, index.length if e is None else e))
+
+
+if __name__ == '__main__':
+    main()
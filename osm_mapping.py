@@ -0,0 +1,148 @@
+# ---------------------------------------------------------------------------
+# osm_mapping.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0903 # Too few public methods
+#
+# Tag to column mapping for osm2fgdb.py: which tags become columns of the
+# nodes/ways/multipolygons layers, and which are ignored. Everything else
+# goes to the other_*_tags tables.
+#
+# The mapping is a JSON file:
+#
+#   {
+#     "ignore": ["fred", "barney"],
+#     "columns": [
+#       {"key": "highway"},
+#       {"key": "name:en", "column": "name_en", "width": 100},
+#       {"key": "layer", "type": "LONG"},
+#       {"key": "ele", "type": "DOUBLE", "types": ["node"]}
+#     ]
+#   }
+#
+# column defaults to the key with ':' replaced by '_', type to TEXT (LONG
+# and DOUBLE also work), width (TEXT only - longer values are cut) to 255
+# and types (which of node, way, relation get the column) to all three.
+# Values that don't parse as a LONG/DOUBLE are left empty (None).
+#
+# The mapping is compiled once per OSM type into a flat dict of
+# key -> (column position, converter) and a row template, so mapping an
+# object costs one dict lookup per tag however many columns there are:
+#
+#   mapping = load_mapping('tags.json')
+#   waymap = mapping.compile('way')
+#   waymap.fields                       # [(column, type, width), ...]
+#   (row, others) = waymap.map(tags)    # tags: [(key, value), ...]
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_mapping.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import json
+
+OSM_TYPES = ('node', 'way', 'relation')
+
+COLUMN_TYPES = ('TEXT', 'LONG', 'DOUBLE')
+
+# The columns osm2fgdb.py always had
+DEFAULT_MAPPING = {
+    'ignore': ['fred', 'barney'],
+    'columns': [{'key': key} for key in
+                ('attribution', 'converted_by', 'created_by', 'highway', 'source')],
+}
+
+
+def to_long(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def to_double(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def text_converter(width):
+    def to_text(value):
+        return value[:width]
+    return to_text
+
+
+class CompiledMapping:
+    def __init__(self, columns, ignore):
+        self.fields = []
+        self.lookup = {}
+        self.ignore = frozenset(ignore)
+
+        for (n, (key, column, ctype, width)) in enumerate(columns):
+            self.fields.append((column, ctype, width))
+            if ctype == 'LONG':
+                converter = to_long
+            elif ctype == 'DOUBLE':
+                converter = to_double
+            else:
+                converter = text_converter(width)
+            self.lookup[key] = (n, converter)
+
+        # Unset TEXT columns are '', numbers None
+        self.template = [('' if f[1] == 'TEXT' else None) for f in self.fields]
+
+    def map(self, tags):
+        row = self.template[:]
+        others = []
+        lookup = self.lookup
+        ignore = self.ignore
+
+        for (key, value) in tags:
+            target = lookup.get(key)
+            if target is not None:
+                row[target[0]] = target[1](value)
+            elif key not in ignore:
+                others.append((key, value))
+
+        return (tuple(row), others)
+
+
+class TagMapping:
+    def __init__(self, config):
+        self.ignore = list(config.get('ignore', ()))
+        self.columns = []
+
+        seen = set()
+        for entry in config.get('columns', ()):
+            key = entry['key']
+            column = entry.get('column', key.replace(':', '_'))
+            ctype = entry.get('type', 'TEXT').upper()
+            width = int(entry.get('width', 255 if ctype == 'TEXT' else 0))
+            types = tuple(entry.get('types', OSM_TYPES))
+
+            if ctype not in COLUMN_TYPES:
+                raise ValueError("Unknown column type %s for %s" % (ctype, key))
+            for osm_type in types:
+                if osm_type not in OSM_TYPES:
+                    raise ValueError("Unknown OSM type %s for %s" % (osm_type, key))
+            if column.lower() in seen:
+                raise ValueError("Duplicate column " + column)
+            seen.add(column.lower())
+
+            self.columns.append((key, column, ctype, width, types))
+
+    def compile(self, osm_type):
+        return CompiledMapping([c[:4] for c in self.columns if osm_type in c[4]], self.ignore)
+
+
+def load_mapping(filename=None):
+    if filename is None:
+        return TagMapping(DEFAULT_MAPPING)
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        return TagMapping(json.load(f))
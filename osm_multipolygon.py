@@ -0,0 +1,194 @@
+# ---------------------------------------------------------------------------
+# osm_multipolygon.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+#
+# Multipolygon assembly for type=multipolygon and type=boundary relations:
+# member way geometries in, polygons (outer ring + holes) out.
+#
+#   polygons = assemble_multipolygon([coords, coords, ...])
+#
+# Coordinates are flat (x0, y0, x1, y1, ...) like everywhere else, and so
+# are the rings that come back:
+#   [[outer, hole, hole], [outer], ...]
+# Outer rings are counterclockwise and holes clockwise (as GeoJSON wants;
+# shapefile writers flip them).
+#
+# Ring building is linear in the number of ways: every open way is put in
+# a hash map under both of its end points, and rings are grown by looking
+# up the current end point - no pairwise matching of ways. Ways that don't
+# close into a ring are dropped.
+#
+# Inner/outer is decided from the geometry, not from member roles (which
+# are often missing or wrong): rings are nested by containment, and rings
+# at an even depth are outers, rings at an odd depth are holes of the ring
+# they're in.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_multipolygon.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from array import array
+
+# Relation types that are assembled into polygons
+MULTIPOLYGON_TYPES = ('multipolygon', 'boundary')
+
+
+# ---------------------------------------------------------------------------
+# Ring helpers
+# ---------------------------------------------------------------------------
+def ring_area(ring):
+    # Shoelace, positive when counterclockwise
+    area = 0.0
+    for i in range(0, len(ring) - 2, 2):
+        area += ring[i] * ring[i + 3] - ring[i + 2] * ring[i + 1]
+    return area / 2.0
+
+
+def reverse_ring(ring):
+    out = array('d')
+    for i in range(len(ring) - 2, -1, -2):
+        out.append(ring[i])
+        out.append(ring[i + 1])
+    return out
+
+
+def ring_bbox(ring):
+    xs = ring[0::2]
+    ys = ring[1::2]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def point_in_ring(x, y, ring):
+    # Ray casting
+    inside = False
+    (x1, y1) = (ring[-2], ring[-1])
+    for i in range(0, len(ring), 2):
+        (x2, y2) = (ring[i], ring[i + 1])
+        if (y2 > y) != (y1 > y) and x < (x1 - x2) * (y - y2) / (y1 - y2) + x2:
+            inside = not inside
+        (x1, y1) = (x2, y2)
+    return inside
+
+
+# ---------------------------------------------------------------------------
+# Join way geometries into closed rings through an end point hash map.
+# Returns (rings, number of ways that didn't end up in a ring).
+# ---------------------------------------------------------------------------
+def assemble_rings(ways):
+    rings = []
+    dropped = 0
+
+    ends = {}
+    open_ways = []
+    for coords in ways:
+        if len(coords) < 4:
+            dropped += 1
+            continue
+
+        first = (coords[0], coords[1])
+        last = (coords[-2], coords[-1])
+        if first == last:
+            if len(coords) >= 8:
+                rings.append(array('d', coords))
+            else:
+                dropped += 1
+            continue
+
+        n = len(open_ways)
+        open_ways.append(coords)
+        ends.setdefault(first, []).append(n)
+        ends.setdefault(last, []).append(n)
+
+    used = [False] * len(open_ways)
+
+    for start in range(len(open_ways)):
+        if used[start]:
+            continue
+        used[start] = True
+
+        ring = array('d', open_ways[start])
+        nways = 1
+        head = (ring[0], ring[1])
+        tail = (ring[-2], ring[-1])
+
+        while tail != head:
+            nxt = -1
+            for n in ends.get(tail, ()):
+                if not used[n]:
+                    nxt = n
+                    break
+            if nxt < 0:
+                break
+
+            used[nxt] = True
+            nways += 1
+            coords = open_ways[nxt]
+            if (coords[0], coords[1]) != tail:
+                coords = reverse_ring(coords)
+            # Skip the shared end point
+            ring.extend(coords[2:])
+            tail = (ring[-2], ring[-1])
+
+        if tail == head and len(ring) >= 8:
+            rings.append(ring)
+        else:
+            dropped += nways
+
+    return (rings, dropped)
+
+
+# ---------------------------------------------------------------------------
+# Nest rings by containment: even depth -> outer, odd -> hole of its parent
+# ---------------------------------------------------------------------------
+def classify_rings(rings):
+    # Biggest first, so a ring's possible parents all come before it
+    info = sorted(((abs(ring_area(r)), ring_bbox(r), r) for r in rings),
+                  key=lambda item: -item[0])
+
+    depth = []
+    parent = []
+    for (i, (_, box, ring)) in enumerate(info):
+        (x, y) = (ring[0], ring[1])
+        found = -1
+        # Smallest containing ring is the last one that contains us
+        for j in range(i - 1, -1, -1):
+            pbox = info[j][1]
+            if (pbox[0] <= box[0] and pbox[1] <= box[1] and pbox[2] >= box[2]
+                    and pbox[3] >= box[3] and point_in_ring(x, y, info[j][2])):
+                found = j
+                break
+        parent.append(found)
+        depth.append(0 if found < 0 else depth[found] + 1)
+
+    polygons = []
+    polygon_of = {}
+    for (i, (_, _, ring)) in enumerate(info):
+        area = ring_area(ring)
+        if depth[i] % 2 == 0:
+            if area < 0:
+                ring = reverse_ring(ring)
+            polygon_of[i] = len(polygons)
+            polygons.append([ring])
+        else:
+            if area > 0:
+                ring = reverse_ring(ring)
+            polygons[polygon_of[parent[i]]].append(ring)
+
+    return polygons
+
+
+# ---------------------------------------------------------------------------
+# Member way geometries -> list of polygons ([outer, hole, ...]), or [] if
+# no ring could be closed.
+# ---------------------------------------------------------------------------
+def assemble_multipolygon(ways):
+    (rings, _) = assemble_rings(ways)
+    if not rings:
+        return []
+    return classify_rings(rings)
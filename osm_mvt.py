@@ -0,0 +1,174 @@
+# ---------------------------------------------------------------------------
+# osm_mvt.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+#
+# Mapbox Vector Tile (MVT 2.1) encoding with a small protobuf writer - no
+# protobuf package needed.
+#
+#   layer = MvtLayer('ways')
+#   layer.add_feature(way_id, GEOM_LINESTRING, [parts], {'highway': 'residential'})
+#   data = encode_tile([layer])
+#
+# Geometry is in tile coordinates (0 .. extent, y down), already clipped and
+# rounded to integers. Parts are flat like everywhere else (x0, y0, x1, y1, ...):
+#   GEOM_POINT      - one part holding all the points
+#   GEOM_LINESTRING - one part per line
+#   GEOM_POLYGON    - one part per ring, not closed (no repeated first point),
+#                     exterior rings clockwise on screen (positive shoelace
+#                     area with y down), each followed by its holes
+#
+# Keys and values are shared by all features of a layer, as the spec wants.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_mvt.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import struct
+
+EXTENT = 4096
+
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+GEOM_POLYGON = 3
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_CLOSE_PATH = 7
+
+# Protobuf wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LEN = 2
+
+_double = struct.Struct('<d')
+
+
+# ---------------------------------------------------------------------------
+# Protobuf wire format
+# ---------------------------------------------------------------------------
+def varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field_key(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+
+def len_field(number, data):
+    return field_key(number, WIRE_LEN) + varint(len(data)) + data
+
+
+def varint_field(number, value):
+    return field_key(number, WIRE_VARINT) + varint(value)
+
+
+def packed_field(number, values):
+    return len_field(number, b''.join(varint(v) for v in values))
+
+
+# ---------------------------------------------------------------------------
+# Geometry commands
+# ---------------------------------------------------------------------------
+def command(cmd, count):
+    return (cmd & 0x7) | (count << 3)
+
+
+def geometry_commands(geom_type, parts):
+    out = []
+    (cx, cy) = (0, 0)
+
+    for part in parts:
+        npoints = len(part) // 2
+        if geom_type == GEOM_POINT:
+            out.append(command(CMD_MOVE_TO, npoints))
+
+        for i in range(npoints):
+            if geom_type != GEOM_POINT:
+                if i == 0:
+                    out.append(command(CMD_MOVE_TO, 1))
+                elif i == 1:
+                    out.append(command(CMD_LINE_TO, npoints - 1))
+
+            (x, y) = (part[2 * i], part[2 * i + 1])
+            out.append(zigzag(x - cx))
+            out.append(zigzag(y - cy))
+            (cx, cy) = (x, y)
+
+        # ClosePath takes the place of the repeated first point
+        if geom_type == GEOM_POLYGON:
+            out.append(command(CMD_CLOSE_PATH, 1))
+
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Values
+# ---------------------------------------------------------------------------
+def encode_value(value):
+    if isinstance(value, bool):
+        return varint_field(7, int(value))
+    if isinstance(value, int):
+        return varint_field(6, zigzag(value))
+    if isinstance(value, float):
+        return field_key(3, WIRE_FIXED64) + _double.pack(value)
+    return len_field(1, str(value).encode('utf-8'))
+
+
+class MvtLayer:
+    def __init__(self, name, extent=EXTENT):
+        self.name = name
+        self.extent = extent
+        self.keys = {}
+        self.values = {}
+        self.features = []
+
+    def __len__(self):
+        return len(self.features)
+
+    def tag(self, key, value):
+        k = self.keys.setdefault(key, len(self.keys))
+        # (type, value), so 1 and '1' and True stay different values
+        v = self.values.setdefault((type(value), value), len(self.values))
+        return (k, v)
+
+    def add_feature(self, feature_id, geom_type, parts, properties):
+        tags = []
+        for (key, value) in properties.items():
+            tags.extend(self.tag(key, value))
+
+        data = []
+        if feature_id is not None and feature_id >= 0:
+            data.append(varint_field(1, feature_id))
+        if tags:
+            data.append(packed_field(2, tags))
+        data.append(varint_field(3, geom_type))
+        data.append(packed_field(4, geometry_commands(geom_type, parts)))
+        self.features.append(b''.join(data))
+
+    def encode(self):
+        data = [varint_field(15, 2), len_field(1, self.name.encode('utf-8'))]
+        data.extend(len_field(2, f) for f in self.features)
+        data.extend(len_field(3, key.encode('utf-8')) for key in self.keys)
+        data.extend(len_field(4, encode_value(value)) for (_, value) in self.values)
+        data.append(varint_field(5, self.extent))
+        return b''.join(data)
+
+
+def encode_tile(layers):
+    # Empty layers are left out
+    return b''.join(len_field(3, layer.encode()) for layer in layers if len(layer))
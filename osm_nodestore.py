@@ -0,0 +1,273 @@
+# ---------------------------------------------------------------------------
+# osm_nodestore.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0902
+# pylint: disable=R1732 # Consider using with
+#
+# Node location stores - where is node N? - for anything that builds way
+# geometry (osm2sqlite.py, osm2fgdb.py, ...).
+#
+# Locations are kept as fixed-point int32 pairs (degrees * 10^7, the same
+# precision as the OSM database), never as Python objects per node.
+#
+# DenseNodeStore
+#   A file of int32 (lon, lat) pairs indexed directly by node id and
+#   memory-mapped, so a lookup is two array reads. The file is sparse on
+#   disk (holes where there are no nodes) and grows as higher ids arrive.
+#   Use for planets and big extracts. Other processes can open the same
+#   file read-only once it's written (open_node_store(path, 'r')).
+#
+# SparseNodeStore
+#   Sorted parallel arrays of ids and locations, looked up by bisection.
+#   Use for small extracts, where a dense file would be mostly holes.
+#   Can be saved to and loaded from a file.
+#
+# Both have the same interface:
+#   store.set(node_id, lon, lat)
+#   store.get(node_id)      -> (lon, lat) or None
+#   node_id in store
+#   store.delete(node_id)
+#   store.coords(node_ids)  -> array('d') of lon, lat for the ids found
+#   store.close()
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_nodestore.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import mmap
+import os
+
+from array import array
+from bisect import bisect_left
+
+SCALE = 10000000
+INV_SCALE = 1.0 / SCALE
+
+# Latitudes are stored biased so that a zero slot (a hole in the file)
+# means "no node". lat * 10^7 + LAT_BIAS is always in 100,000,000 .. 1,900,000,000.
+LAT_BIAS = 1000000000
+
+# Grow dense files in steps of this many node ids (8 bytes each)
+GROW_IDS = 1 << 24
+
+
+def to_fixed(value):
+    return int(round(value * SCALE))
+
+
+# ---------------------------------------------------------------------------
+# DenseNodeStore
+# ---------------------------------------------------------------------------
+class DenseNodeStore:
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self.writable = mode != 'r'
+
+        if mode == 'w':
+            self.fptr = open(path, 'w+b')
+        elif mode == 'a':
+            self.fptr = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        else:
+            self.fptr = open(path, 'rb')
+
+        self.map = None
+        self.view = None
+        self.capacity = 0
+        self._map(os.path.getsize(path) // 8)
+
+    def _map(self, capacity):
+        self._unmap()
+
+        if self.writable and os.path.getsize(self.path) < capacity * 8:
+            self.fptr.truncate(capacity * 8)
+
+        self.capacity = capacity
+        if capacity == 0:
+            return
+
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self.map = mmap.mmap(self.fptr.fileno(), capacity * 8, access=access)
+        self.view = memoryview(self.map).cast('i')
+
+    def _unmap(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def set(self, node_id, lon, lat):
+        if node_id >= self.capacity:
+            self._map(max(node_id + 1, self.capacity * 2, GROW_IDS))
+
+        pos = node_id << 1
+        self.view[pos] = to_fixed(lon)
+        self.view[pos + 1] = to_fixed(lat) + LAT_BIAS
+
+    def get(self, node_id):
+        if node_id < 0 or node_id >= self.capacity:
+            return None
+
+        pos = node_id << 1
+        lat = self.view[pos + 1]
+        if lat == 0:
+            return None
+        return (self.view[pos] * INV_SCALE, (lat - LAT_BIAS) * INV_SCALE)
+
+    def __contains__(self, node_id):
+        return 0 <= node_id < self.capacity and self.view[(node_id << 1) + 1] != 0
+
+    def delete(self, node_id):
+        if 0 <= node_id < self.capacity:
+            pos = node_id << 1
+            self.view[pos] = 0
+            self.view[pos + 1] = 0
+
+    def coords(self, node_ids):
+        view = self.view
+        capacity = self.capacity
+        out = array('d')
+        for node_id in node_ids:
+            if 0 <= node_id < capacity:
+                pos = node_id << 1
+                lat = view[pos + 1]
+                if lat != 0:
+                    out.append(view[pos] * INV_SCALE)
+                    out.append((lat - LAT_BIAS) * INV_SCALE)
+        return out
+
+    def flush(self):
+        if self.map is not None and self.writable:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        self._unmap()
+        if self.fptr is not None:
+            self.fptr.close()
+            self.fptr = None
+
+
+# ---------------------------------------------------------------------------
+# SparseNodeStore
+# ---------------------------------------------------------------------------
+class SparseNodeStore:
+    def __init__(self, path=None, mode='w'):
+        self.path = path
+        self.ids = array('q')
+        self.lons = array('i')
+        self.lats = array('i')
+        self.is_sorted = True
+
+        if path is not None and mode != 'w' and os.path.exists(path):
+            self.load(path)
+
+    def set(self, node_id, lon, lat):
+        if self.ids and node_id <= self.ids[-1]:
+            self.is_sorted = False
+
+        self.ids.append(node_id)
+        self.lons.append(to_fixed(lon))
+        self.lats.append(to_fixed(lat))
+
+    def _sort(self):
+        # Stable, so for duplicate ids the last one set comes last
+        order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+
+        ids = array('q')
+        lons = array('i')
+        lats = array('i')
+        for i in order:
+            if ids and ids[-1] == self.ids[i]:
+                lons[-1] = self.lons[i]
+                lats[-1] = self.lats[i]
+            else:
+                ids.append(self.ids[i])
+                lons.append(self.lons[i])
+                lats.append(self.lats[i])
+
+        (self.ids, self.lons, self.lats) = (ids, lons, lats)
+        self.is_sorted = True
+
+    def _find(self, node_id):
+        if not self.is_sorted:
+            self._sort()
+
+        pos = bisect_left(self.ids, node_id)
+        if pos < len(self.ids) and self.ids[pos] == node_id:
+            return pos
+        return -1
+
+    def get(self, node_id):
+        pos = self._find(node_id)
+        if pos < 0:
+            return None
+        return (self.lons[pos] * INV_SCALE, self.lats[pos] * INV_SCALE)
+
+    def __contains__(self, node_id):
+        return self._find(node_id) >= 0
+
+    def delete(self, node_id):
+        pos = self._find(node_id)
+        if pos >= 0:
+            del self.ids[pos]
+            del self.lons[pos]
+            del self.lats[pos]
+
+    def coords(self, node_ids):
+        out = array('d')
+        for node_id in node_ids:
+            pos = self._find(node_id)
+            if pos >= 0:
+                out.append(self.lons[pos] * INV_SCALE)
+                out.append(self.lats[pos] * INV_SCALE)
+        return out
+
+    def save(self, path):
+        if not self.is_sorted:
+            self._sort()
+
+        with open(path, 'wb') as f:
+            array('q', [len(self.ids)]).tofile(f)
+            self.ids.tofile(f)
+            self.lons.tofile(f)
+            self.lats.tofile(f)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            count = array('q')
+            count.fromfile(f, 1)
+            self.ids = array('q')
+            self.ids.fromfile(f, count[0])
+            self.lons = array('i')
+            self.lons.fromfile(f, count[0])
+            self.lats = array('i')
+            self.lats.fromfile(f, count[0])
+        self.is_sorted = True
+
+    def flush(self):
+        if self.path is not None:
+            self.save(self.path)
+
+    def close(self):
+        self.flush()
+
+
+# ---------------------------------------------------------------------------
+# Open a store. kind is 'dense' or 'sparse'; mode is 'w' (new), 'a'
+# (add to an existing one) or 'r' (read only, e.g. from another process).
+# A sparse store with no path lives in memory only.
+# ---------------------------------------------------------------------------
+def open_node_store(path, mode='w', kind='dense'):
+    if kind == 'dense':
+        return DenseNodeStore(path, mode)
+    if kind == 'sparse':
+        return SparseNodeStore(path, mode)
+    raise ValueError("Unknown node store " + str(kind))
@@ -0,0 +1,656 @@
+# ---------------------------------------------------------------------------
+# osm_pbf.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0912 # Too many branches
+# pylint: disable=R0914 # Too many locals
+#
+# OSM PBF (.osm.pbf) reading with a small protobuf wire format decoder -
+# no protobuf package needed. OsmReader uses this when it's given a PBF
+# file (it looks at the first bytes, not the name), so everything that
+# reads with OsmReader.objects() takes PBF as well:
+#
+#   for obj in OsmReader('hawaii.osm.pbf', workers=4).objects():
+#       ...the same OsmObject records as from the XML...
+#
+# A PBF file is a row of blobs: 4 byte length, BlobHeader, Blob. A blob is
+# a zlib (or raw, or lzma) compressed PrimitiveBlock of ~8000 objects with
+# its own string table; nodes are mostly DenseNodes - each column (ids,
+# lats, lons, timestamps, ...) packed and delta coded, decoded here into
+# arrays with a running sum.
+#
+# Blobs decode on their own, so with workers > 1 they are spread over a
+# process pool: the file is read in order, a bounded number of blobs is in
+# flight, and the objects come back in file order. Pool workers can't have
+# pools of their own, so the default is to decode in this process.
+#
+# Supports the OsmSchema-V0.6, DenseNodes and HistoricalInformation
+# features (planet and Geofabrik files, history files).
+#
+# PbfWriter goes the other way, for the tools that write OSM data
+# (osm_fpextract.py -P, osm_chunker.py -P, osm_export.py to .pbf):
+#
+#   with open('extract.osm.pbf', 'wb') as f:
+#       writer = PbfWriter(f, workers=4, history=True)
+#       for obj in objects:
+#           writer.write(obj)
+#       writer.close()
+#
+# Objects are collected into blocks of up to block_size objects of one
+# type (DenseNodes for nodes), each with its own string table, and
+# encoded + zlib compressed in the pool (or in this process) while the
+# next block fills; blobs are written in the order the objects came in.
+# Changesets have no place in PBF and are dropped (writer.dropped counts
+# them). A writer can be handed a pool to share with other writers, and
+# header=False appends blocks to an existing PBF file.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_pbf.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from array import array
+from collections import deque
+from datetime import date
+from itertools import accumulate
+import calendar
+import lzma
+import multiprocessing
+import struct
+import time
+import zlib
+
+from osm_mvt import len_field, varint_field, zigzag
+from osm_reader import ObjTypes, OsmObject
+
+SUPPORTED_FEATURES = {'OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'}
+
+# Relation member types, as stored
+MEMBER_TYPES = (ObjTypes.node, ObjTypes.way, ObjTypes.relation)
+
+_frame_length = struct.Struct('>I')
+
+
+# ---------------------------------------------------------------------------
+# Protobuf wire format
+# ---------------------------------------------------------------------------
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (result, pos)
+        shift += 7
+
+
+def signed(value):
+    # int32/int64 fields: negative values are 64 bit two's complement
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def message_fields(data):
+    # (field number, value) per field: an int for varints, a memoryview
+    # for length delimited fields (fixed width fields are skipped)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        (key, pos) = read_varint(data, pos)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            (value, pos) = read_varint(data, pos)
+        elif wire_type == 2:
+            (length, pos) = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            pos += 8
+            continue
+        elif wire_type == 5:
+            pos += 4
+            continue
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield (key >> 3, value)
+
+
+def packed_varints(data):
+    # One byte each is common (keys_vals, versions, small deltas)
+    if not data or max(data) < 0x80:
+        return list(data)
+    out = []
+    append = out.append
+    value = 0
+    shift = 0
+    for b in data:
+        if b < 0x80:
+            append(value | (b << shift))
+            value = 0
+            shift = 0
+        else:
+            value |= (b & 0x7f) << shift
+            shift += 7
+    return out
+
+
+def packed_sint(data):
+    return [(v >> 1) ^ -(v & 1) for v in packed_varints(data)]
+
+
+def packed_delta(data):
+    # Delta coded sint64 column -> absolute values
+    return array('q', accumulate(packed_sint(data)))
+
+
+# ---------------------------------------------------------------------------
+# PrimitiveBlock -> OsmObjects
+# ---------------------------------------------------------------------------
+class BlockContext:
+    def __init__(self, strings, granularity, lat_offset, lon_offset, date_granularity):
+        self.strings = strings
+        self.granularity = granularity
+        self.lat_offset = lat_offset
+        self.lon_offset = lon_offset
+        self.date_granularity = date_granularity
+        self.dates = {}
+
+    def set_time(self, obj, timestamp):
+        seconds = timestamp * self.date_granularity // 1000
+        t = time.gmtime(seconds)
+        obj.iso_timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', t)
+        day = t[:3]
+        if day not in self.dates:
+            self.dates[day] = date(*day)
+        obj.timestamp = self.dates[day]
+
+    def set_info(self, obj, info):
+        for (field, value) in message_fields(info):
+            if field == 1:
+                obj.version = signed(value)
+            elif field == 2:
+                self.set_time(obj, signed(value))
+            elif field == 3:
+                obj.changeset = signed(value)
+            elif field == 4:
+                obj.uid = signed(value)
+            elif field == 5:
+                obj.user = self.strings[value]
+            elif field == 6:
+                obj.visible = bool(value)
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for (k, v) in zip(packed_varints(keys),
+                                                            packed_varints(vals))]
+
+
+def decode_node(ctx, data):
+    obj = OsmObject(ObjTypes.node)
+    (keys, vals) = (b'', b'')
+    (lat, lon) = (0, 0)
+    for (field, value) in message_fields(data):
+        if field == 1:
+            obj.id = unzigzag(value)
+        elif field == 2:
+            keys = value
+        elif field == 3:
+            vals = value
+        elif field == 4:
+            ctx.set_info(obj, value)
+        elif field == 8:
+            lat = unzigzag(value)
+        elif field == 9:
+            lon = unzigzag(value)
+    obj.tags = ctx.tags(keys, vals)
+    # Deleted versions have no location, as in the XML
+    if obj.visible:
+        obj.lat = (ctx.lat_offset + ctx.granularity * lat) / 1e9
+        obj.lon = (ctx.lon_offset + ctx.granularity * lon) / 1e9
+    return obj
+
+
+def decode_dense(ctx, data):
+    ids = lats = lons = array('q')
+    info = None
+    keys_vals = []
+    for (field, value) in message_fields(data):
+        if field == 1:
+            ids = packed_delta(value)
+        elif field == 5:
+            info = value
+        elif field == 8:
+            lats = packed_delta(value)
+        elif field == 9:
+            lons = packed_delta(value)
+        elif field == 10:
+            keys_vals = packed_varints(value)
+
+    count = len(ids)
+    versions = timestamps = changesets = uids = users = visibles = None
+    if info is not None:
+        for (field, value) in message_fields(info):
+            if field == 1:
+                versions = packed_varints(value)
+                # No version is -1, which int32 stores as 10 bytes
+                if versions and max(versions) >= (1 << 63):
+                    versions = [signed(v) for v in versions]
+            elif field == 2:
+                timestamps = packed_delta(value)
+            elif field == 3:
+                changesets = packed_delta(value)
+            elif field == 4:
+                uids = packed_delta(value)
+            elif field == 5:
+                users = packed_delta(value)
+            elif field == 6:
+                visibles = packed_varints(value)
+
+    strings = ctx.strings
+    (scale, lat_offset, lon_offset) = (ctx.granularity, ctx.lat_offset, ctx.lon_offset)
+    objects = []
+    kv = 0
+    for i in range(count):
+        obj = OsmObject(ObjTypes.node, ids[i])
+        if versions is not None:
+            obj.version = versions[i]
+        if timestamps is not None:
+            ctx.set_time(obj, timestamps[i])
+        if changesets is not None:
+            obj.changeset = changesets[i]
+        if uids is not None:
+            obj.uid = uids[i]
+        if users is not None:
+            obj.user = strings[users[i]]
+        if visibles is not None:
+            obj.visible = bool(visibles[i])
+        if obj.visible:
+            obj.lat = (lat_offset + scale * lats[i]) / 1e9
+            obj.lon = (lon_offset + scale * lons[i]) / 1e9
+
+        # keys_vals: k, v, k, v, ..., 0 per node
+        if keys_vals:
+            tags = []
+            while keys_vals[kv]:
+                tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+            obj.tags = tags
+        objects.append(obj)
+    return objects
+
+
+def decode_way(ctx, data):
+    obj = OsmObject(ObjTypes.way)
+    (keys, vals) = (b'', b'')
+    for (field, value) in message_fields(data):
+        if field == 1:
+            obj.id = value
+        elif field == 2:
+            keys = value
+        elif field == 3:
+            vals = value
+        elif field == 4:
+            ctx.set_info(obj, value)
+        elif field == 8:
+            obj.nodes = list(packed_delta(value))
+    obj.tags = ctx.tags(keys, vals)
+    return obj
+
+
+def decode_relation(ctx, data):
+    obj = OsmObject(ObjTypes.relation)
+    (keys, vals) = (b'', b'')
+    (roles, refs, types) = ([], [], [])
+    for (field, value) in message_fields(data):
+        if field == 1:
+            obj.id = value
+        elif field == 2:
+            keys = value
+        elif field == 3:
+            vals = value
+        elif field == 4:
+            ctx.set_info(obj, value)
+        elif field == 8:
+            roles = packed_varints(value)
+        elif field == 9:
+            refs = packed_delta(value)
+        elif field == 10:
+            types = packed_varints(value)
+    obj.tags = ctx.tags(keys, vals)
+    strings = ctx.strings
+    obj.members = [(MEMBER_TYPES[t], ref, strings[role])
+                   for (t, ref, role) in zip(types, refs, roles)]
+    return obj
+
+
+def decode_block(data):
+    strings = []
+    groups = []
+    (granularity, lat_offset, lon_offset, date_granularity) = (100, 0, 0, 1000)
+    for (field, value) in message_fields(data):
+        if field == 1:
+            strings = [bytes(s).decode('utf-8') for (f, s) in message_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 18:
+            date_granularity = value
+        elif field == 19:
+            lat_offset = signed(value)
+        elif field == 20:
+            lon_offset = signed(value)
+
+    ctx = BlockContext(strings, granularity, lat_offset, lon_offset, date_granularity)
+    objects = []
+    for group in groups:
+        for (field, value) in message_fields(group):
+            if field == 1:
+                objects.append(decode_node(ctx, value))
+            elif field == 2:
+                objects.extend(decode_dense(ctx, value))
+            elif field == 3:
+                objects.append(decode_way(ctx, value))
+            elif field == 4:
+                objects.append(decode_relation(ctx, value))
+    return objects
+
+
+# ---------------------------------------------------------------------------
+# Blobs
+# ---------------------------------------------------------------------------
+def blob_data(blob):
+    for (field, value) in message_fields(memoryview(blob)):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+        if field == 4:
+            return lzma.decompress(value)
+        if field in (5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression (field %d)" % field)
+    return b''
+
+
+def decode_blob(blob):
+    # OSMData blob -> its objects (what the pool workers run)
+    return decode_block(memoryview(blob_data(blob)))
+
+
+def check_header(blob):
+    for (field, value) in message_fields(memoryview(blob_data(blob))):
+        if field == 4:
+            feature = bytes(value).decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError("PBF feature not supported: " + feature)
+
+
+class PbfReader:
+    def __init__(self, filename, workers=0):
+        self.filename = filename
+        self.workers = workers
+        self.bytes_read = 0
+
+    def blobs(self):
+        # (type, blob) per frame, in file order
+        with open(self.filename, 'rb') as f:
+            while True:
+                head = f.read(4)
+                if len(head) < 4:
+                    return
+                header = f.read(_frame_length.unpack(head)[0])
+                (blob_type, size) = ('', 0)
+                for (field, value) in message_fields(memoryview(header)):
+                    if field == 1:
+                        blob_type = bytes(value).decode('utf-8')
+                    elif field == 3:
+                        size = value
+                blob = f.read(size)
+                self.bytes_read += 4 + len(header) + len(blob)
+                yield (blob_type, blob)
+
+    def data_blobs(self):
+        for (blob_type, blob) in self.blobs():
+            if blob_type == 'OSMHeader':
+                check_header(blob)
+            elif blob_type == 'OSMData':
+                yield blob
+
+    def objects(self):
+        if self.workers < 2:
+            for blob in self.data_blobs():
+                yield from decode_blob(blob)
+            return
+
+        # Up to 2 blobs per worker in flight, results taken in order
+        with multiprocessing.Pool(self.workers) as pool:
+            pending = deque()
+            for blob in self.data_blobs():
+                pending.append(pool.apply_async(decode_blob, (blob,)))
+                if len(pending) >= 2 * self.workers:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+BLOCK_SIZE = 8000
+GRANULARITY = 100
+
+_mask64 = (1 << 64) - 1
+
+
+def packed(number, values):
+    # packed_field without a varint() call per value
+    if not values or (min(values) >= 0 and max(values) < 0x80):
+        return len_field(number, bytes(values))
+    out = bytearray()
+    append = out.append
+    for v in values:
+        while v > 0x7f:
+            append((v & 0x7f) | 0x80)
+            v >>= 7
+        append(v)
+    return len_field(number, bytes(out))
+
+
+def deltas(values):
+    out = []
+    append = out.append
+    prev = 0
+    for v in values:
+        d = v - prev
+        append((d << 1) ^ (d >> 63))
+        prev = v
+    return out
+
+
+def iso_seconds(iso_timestamp):
+    # "2015-03-04T01:02:03Z" -> seconds since 1970
+    if not iso_timestamp:
+        return 0
+    s = iso_timestamp
+    return calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                            int(s[11:13]), int(s[14:16]), int(s[17:19])))
+
+
+def coordinate(value):
+    return int(round(value * (1000000000 // GRANULARITY)))
+
+
+class StringTable:
+    def __init__(self):
+        self.index = {'': 0}
+
+    def __call__(self, s):
+        n = self.index.get(s)
+        if n is None:
+            n = self.index[s] = len(self.index)
+        return n
+
+    def encode(self):
+        return b''.join(len_field(1, s.encode('utf-8')) for s in self.index)
+
+
+def encode_info(obj, strings, history):
+    data = (varint_field(1, obj.version & _mask64)
+            + varint_field(2, iso_seconds(obj.iso_timestamp))
+            + varint_field(3, obj.changeset & _mask64)
+            + varint_field(4, obj.uid & _mask64)
+            + varint_field(5, strings(obj.user)))
+    if history or not obj.visible:
+        data += varint_field(6, int(obj.visible))
+    return data
+
+
+def encode_dense(nodes, strings, history):
+    keys_vals = []
+    for obj in nodes:
+        for (k, v) in obj.tags:
+            keys_vals.append(strings(k))
+            keys_vals.append(strings(v))
+        keys_vals.append(0)
+
+    info = (packed(1, [v & _mask64 for v in (obj.version for obj in nodes)])
+            + packed(2, deltas([iso_seconds(obj.iso_timestamp) for obj in nodes]))
+            + packed(3, deltas([obj.changeset for obj in nodes]))
+            + packed(4, deltas([obj.uid for obj in nodes]))
+            + packed(5, deltas([strings(obj.user) for obj in nodes])))
+    if history or not all(obj.visible for obj in nodes):
+        info += packed(6, [int(obj.visible) for obj in nodes])
+
+    # Deleted versions have no location
+    lats = [coordinate(obj.lat) if obj.visible else 0 for obj in nodes]
+    lons = [coordinate(obj.lon) if obj.visible else 0 for obj in nodes]
+
+    data = (packed(1, deltas([obj.id for obj in nodes])) + len_field(5, info)
+            + packed(8, deltas(lats)) + packed(9, deltas(lons)))
+    if any(keys_vals):
+        data += packed(10, keys_vals)
+    return len_field(2, data)
+
+
+def encode_tags(obj, strings):
+    return (packed(2, [strings(k) for (k, _) in obj.tags])
+            + packed(3, [strings(v) for (_, v) in obj.tags]))
+
+
+def encode_way(obj, strings, history):
+    return len_field(3, varint_field(1, obj.id) + encode_tags(obj, strings)
+                     + len_field(4, encode_info(obj, strings, history))
+                     + packed(8, deltas(obj.nodes)))
+
+
+def encode_relation(obj, strings, history):
+    return len_field(4, varint_field(1, obj.id) + encode_tags(obj, strings)
+                     + len_field(4, encode_info(obj, strings, history))
+                     + packed(8, [strings(role) for (_, _, role) in obj.members])
+                     + packed(9, deltas([ref for (_, ref, _) in obj.members]))
+                     + packed(10, [MEMBER_TYPES.index(t) for (t, _, _) in obj.members]))
+
+
+def encode_frame(blob_type, data, level=6):
+    # One file block: length, BlobHeader, zlib Blob
+    blob = varint_field(2, len(data)) + len_field(3, zlib.compress(data, level))
+    header = len_field(1, blob_type.encode('utf-8')) + varint_field(3, len(blob))
+    return _frame_length.pack(len(header)) + header + blob
+
+
+def encode_block(args):
+    # Objects of one type -> an OSMData frame (what the pool workers run)
+    (objects, history) = args
+    strings = StringTable()
+    if objects[0].type == ObjTypes.node:
+        group = encode_dense(objects, strings, history)
+    elif objects[0].type == ObjTypes.way:
+        group = b''.join(encode_way(obj, strings, history) for obj in objects)
+    else:
+        group = b''.join(encode_relation(obj, strings, history) for obj in objects)
+
+    data = (len_field(1, strings.encode()) + len_field(2, group)
+            + varint_field(17, GRANULARITY))
+    return encode_frame('OSMData', data)
+
+
+def encode_header(history=False, bbox=None):
+    data = b''
+    if bbox is not None:
+        # HeaderBBox: left, right, top, bottom in nanodegrees
+        (left, bottom, right, top) = bbox
+        data += len_field(1, b''.join(varint_field(n, zigzag(int(round(v * 1e9))))
+                                      for (n, v) in ((1, left), (2, right),
+                                                     (3, top), (4, bottom))))
+    features = ['OsmSchema-V0.6', 'DenseNodes']
+    if history:
+        features.append('HistoricalInformation')
+    for feature in features:
+        data += len_field(4, feature.encode('utf-8'))
+    data += len_field(16, b'osm_pbf.py')
+    return encode_frame('OSMHeader', data)
+
+
+class PbfWriter:
+    def __init__(self, fptr, workers=0, history=False, bbox=None, block_size=BLOCK_SIZE,
+                 header=True, pool=None):
+        self.fptr = fptr
+        self.history = history
+        self.block_size = block_size
+        self.block = []
+        self.count = 0
+        self.dropped = 0
+
+        # Our own pool only if there isn't one to share
+        self.own_pool = pool is None and workers > 1
+        self.pool = multiprocessing.Pool(workers) if self.own_pool else pool
+        self.in_flight = 2 * (workers if workers > 1 else multiprocessing.cpu_count())
+        self.pending = deque()
+
+        if header:
+            self.fptr.write(encode_header(history, bbox))
+
+    def write(self, obj):
+        if obj.type not in MEMBER_TYPES:
+            self.dropped += 1
+            return
+        if self.block and (obj.type != self.block[0].type or len(self.block) >= self.block_size):
+            self.flush_block()
+        self.block.append(obj)
+        self.count += 1
+
+    def flush_block(self):
+        if not self.block:
+            return
+        args = (self.block, self.history)
+        self.block = []
+        if self.pool is None:
+            self.fptr.write(encode_block(args))
+            return
+
+        self.pending.append(self.pool.apply_async(encode_block, (args,)))
+        while len(self.pending) >= self.in_flight:
+            self.fptr.write(self.pending.popleft().get())
+
+    def flush(self):
+        # Everything written so far into the file
+        self.flush_block()
+        while self.pending:
+            self.fptr.write(self.pending.popleft().get())
+
+    def close(self):
+        self.flush()
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,417 @@
+# ---------------------------------------------------------------------------
+# osm_query.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0902
+# pylint: disable=R0913 # Too many arguments
+#
+# Read-only query API over a database written by osm2sqlite.py.
+#
+#   q = OsmQuery('hawaii.sqlite')
+#   for node in q.nodes_in_bbox((-158.29, 21.2, -157.661, 21.73)):
+#       print(node.id, node.tags)
+#
+# Every query is a generator of OsmObject records - the same records
+# OsmReader.objects() yields - so code written against the reader works
+# against the database. Rows are pulled with fetchmany() in fixed-size
+# batches, and the tags/way nodes/members for a whole batch are fetched with
+# one query, so memory stays flat however many rows match.
+#
+# All SQL is fixed text (ids for a batch are passed as one JSON array and
+# expanded with json_each), so sqlite3's per-connection statement cache
+# prepares each statement once and reuses it.
+#
+# Connections are opened read-only and kept in a small pool so several
+# threads can query at once. A query only holds a connection while it
+# fetches and builds a batch, not while the caller works through it, so
+# queries can be nested inside a stream (on any thread) without waiting on
+# the pool. The stream's cursor stays open on its connection in between
+# and rows are pulled from it there; the tags/way nodes/members for the
+# batch are fetched on whichever connection was acquired. sqlite3
+# connections are serialized, so another thread using the cursor's
+# connection meanwhile is safe.
+#
+# ShardedQuery has the same methods over the shard databases written by
+# osm2sqlite.py -N. Id lookups go straight to the owning shard when the
+# partition allows it; everything else fans out to every shard and the
+# (id ordered) results are merged back into one id ordered stream.
+# attach_shards() ATTACHes the shards to one connection for ad-hoc SQL.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_query.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import heapq
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+from datetime import date
+
+from osm_reader import ObjTypes, OsmObject
+from osm2sqlite import shard_name
+
+MEMBER_TYPES = {'node': ObjTypes.node, 'way': ObjTypes.way, 'relation': ObjTypes.relation}
+
+#
+# Statements. Kept as constants so the text - and so the cache key - never changes.
+#
+NODE_COLUMNS = "select id, timestamp, user, lat, lon from nodes "
+WAY_COLUMNS = "select id, timestamp, user from ways "
+RELATION_COLUMNS = "select id, timestamp, user from relations "
+
+SQL = {
+    'node_by_id': NODE_COLUMNS + "where id = ?",
+    'way_by_id': WAY_COLUMNS + "where id = ?",
+    'relation_by_id': RELATION_COLUMNS + "where id = ?",
+
+    'nodes_in_bbox': NODE_COLUMNS +
+                     "where lat between ? and ? and lon between ? and ? order by id",
+    'ways_in_bbox': WAY_COLUMNS +
+                    "where id in (select way_id from way_geometry "
+                    "where min_lat <= ? and max_lat >= ? and min_lon <= ? and max_lon >= ?) "
+                    "order by id",
+
+    'nodes_by_key': NODE_COLUMNS +
+                    "where id in (select node_id from node_tags where key = ?) order by id",
+    'nodes_by_tag': NODE_COLUMNS +
+                    "where id in (select node_id from node_tags where key = ? and value = ?) "
+                    "order by id",
+    'ways_by_key': WAY_COLUMNS +
+                   "where id in (select way_id from way_tags where key = ?) order by id",
+    'ways_by_tag': WAY_COLUMNS +
+                   "where id in (select way_id from way_tags where key = ? and value = ?) "
+                   "order by id",
+    'relations_by_key': RELATION_COLUMNS +
+                        "where id in (select relation_id from relation_tags where key = ?) "
+                        "order by id",
+    'relations_by_tag': RELATION_COLUMNS +
+                        "where id in (select relation_id from relation_tags "
+                        "where key = ? and value = ?) order by id",
+
+    'nodes_in_time': NODE_COLUMNS + "where timestamp >= ? and timestamp < ? order by id",
+    'ways_in_time': WAY_COLUMNS + "where timestamp >= ? and timestamp < ? order by id",
+    'relations_in_time': RELATION_COLUMNS +
+                         "where timestamp >= ? and timestamp < ? order by id",
+
+    'node_tags': "select node_id, key, value from node_tags "
+                 "where node_id in (select value from json_each(?))",
+    'way_tags': "select way_id, key, value from way_tags "
+                "where way_id in (select value from json_each(?))",
+    'relation_tags': "select relation_id, key, value from relation_tags "
+                     "where relation_id in (select value from json_each(?))",
+    'way_nodes': "select way_id, node_id from way_nodes "
+                 "where way_id in (select value from json_each(?)) "
+                 "order by way_id, local_order",
+    'relation_members': "select relation_id, type, ref, role from relation_members "
+                        "where relation_id in (select value from json_each(?)) "
+                        "order by relation_id, local_order",
+
+    'way_geometry': "select geom from way_geometry where way_id = ?",
+}
+
+TAG_SQL = {ObjTypes.node: SQL['node_tags'],
+           ObjTypes.way: SQL['way_tags'],
+           ObjTypes.relation: SQL['relation_tags']}
+
+
+# ---------------------------------------------------------------------------
+# Pool of read-only connections, safe to share between threads
+# ---------------------------------------------------------------------------
+class ConnectionPool:
+    def __init__(self, dbname, size=4, cached_statements=256):
+        self.dbname = dbname
+        self.size = size
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect('file:' + self.dbname + '?mode=ro', uri=True,
+                               check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            grow = self.created < self.size
+            if grow:
+                self.created += 1
+
+        if grow:
+            return self.connect()
+
+        return self.idle.get()
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self.created = 0
+
+
+# ---------------------------------------------------------------------------
+# OsmQuery
+# ---------------------------------------------------------------------------
+class OsmQuery:
+    def __init__(self, dbname, pool_size=4, batch_size=1000):
+        self.pool = ConnectionPool(dbname, pool_size)
+        self.batch_size = batch_size
+
+    def close(self):
+        self.pool.close()
+
+    # -----------------------------------------------------------------------
+    # Run a statement and yield OsmObjects, one fetchmany() batch at a time
+    # -----------------------------------------------------------------------
+    def _stream(self, obj_type, sql, params):
+        conn = self.pool.acquire()
+        try:
+            cur = conn.execute(sql, params)
+            batch = self._fetch(conn, cur, obj_type)
+        finally:
+            self.pool.release(conn)
+
+        try:
+            while batch:
+                yield from batch
+
+                conn = self.pool.acquire()
+                try:
+                    batch = self._fetch(conn, cur, obj_type)
+                finally:
+                    self.pool.release(conn)
+        finally:
+            cur.close()
+
+    def _fetch(self, conn, cur, obj_type):
+        # The next batch of rows from cur, with its children fetched on conn
+        # (not necessarily the connection cur was opened on)
+        rows = cur.fetchmany(self.batch_size)
+        if not rows:
+            return []
+        return self._build(conn, obj_type, rows)
+
+    def _build(self, conn, obj_type, rows):
+        objs = {}
+        batch = []
+        for row in rows:
+            obj = OsmObject(obj_type, row[0])
+            obj.iso_timestamp = row[1] or ''
+            if obj.iso_timestamp:
+                obj.timestamp = date(int(obj.iso_timestamp[0:4]),
+                                     int(obj.iso_timestamp[5:7]),
+                                     int(obj.iso_timestamp[8:10]))
+            obj.user = row[2] or ''
+            if obj_type == ObjTypes.node:
+                obj.lat = row[3]
+                obj.lon = row[4]
+            objs[obj.id] = obj
+            batch.append(obj)
+
+        ids = json.dumps(list(objs))
+
+        for (obj_id, key, value) in conn.execute(TAG_SQL[obj_type], (ids,)):
+            objs[obj_id].tags.append((key, value))
+
+        if obj_type == ObjTypes.way:
+            for (way_id, node_id) in conn.execute(SQL['way_nodes'], (ids,)):
+                objs[way_id].nodes.append(node_id)
+
+        elif obj_type == ObjTypes.relation:
+            for (rel_id, memtype, ref, role) in conn.execute(SQL['relation_members'], (ids,)):
+                objs[rel_id].members.append((MEMBER_TYPES[memtype], ref, role))
+
+        return batch
+
+    # -----------------------------------------------------------------------
+    # Id lookup - returns an OsmObject or None
+    # -----------------------------------------------------------------------
+    def get(self, obj_type, obj_id):
+        sql = {ObjTypes.node: SQL['node_by_id'],
+               ObjTypes.way: SQL['way_by_id'],
+               ObjTypes.relation: SQL['relation_by_id']}[obj_type]
+
+        for obj in self._stream(obj_type, sql, (obj_id,)):
+            return obj
+        return None
+
+    def node(self, node_id):
+        return self.get(ObjTypes.node, node_id)
+
+    def way(self, way_id):
+        return self.get(ObjTypes.way, way_id)
+
+    def relation(self, relation_id):
+        return self.get(ObjTypes.relation, relation_id)
+
+    # -----------------------------------------------------------------------
+    # Way geometry as WKB (see osm_geometry.parse_wkb), or None
+    # -----------------------------------------------------------------------
+    def way_geometry(self, way_id):
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute(SQL['way_geometry'], (way_id,)).fetchone()
+        finally:
+            self.pool.release(conn)
+
+        return row[0] if row else None
+
+    # -----------------------------------------------------------------------
+    # BBOX queries - bbox is (left, bottom, right, top)
+    # -----------------------------------------------------------------------
+    def nodes_in_bbox(self, bbox):
+        (left, bottom, right, top) = bbox
+        return self._stream(ObjTypes.node, SQL['nodes_in_bbox'], (bottom, top, left, right))
+
+    def ways_in_bbox(self, bbox):
+        # Ways whose bbox overlaps the query bbox
+        (left, bottom, right, top) = bbox
+        return self._stream(ObjTypes.way, SQL['ways_in_bbox'], (top, bottom, right, left))
+
+    # -----------------------------------------------------------------------
+    # Tag filter - objects having key, or key=value
+    # -----------------------------------------------------------------------
+    def by_tag(self, obj_type, key, value=None):
+        name = {ObjTypes.node: 'nodes', ObjTypes.way: 'ways',
+                ObjTypes.relation: 'relations'}[obj_type]
+
+        if value is None:
+            return self._stream(obj_type, SQL[name + '_by_key'], (key,))
+        return self._stream(obj_type, SQL[name + '_by_tag'], (key, value))
+
+    # -----------------------------------------------------------------------
+    # Time window - objects with start <= timestamp < end (dates or ISO strings)
+    # -----------------------------------------------------------------------
+    def in_time_window(self, obj_type, start, end):
+        name = {ObjTypes.node: 'nodes', ObjTypes.way: 'ways',
+                ObjTypes.relation: 'relations'}[obj_type]
+
+        return self._stream(obj_type, SQL[name + '_in_time'], (str(start), str(end)))
+
+
+# ---------------------------------------------------------------------------
+# ATTACH shard databases to conn as shard00, shard01, ... for ad-hoc SQL
+# across all of them, e.g.
+#
+#   " union all ".join("select count(*) from %s.nodes" % n for n in names)
+#
+# SQLite allows 10 attached databases unless built with a higher limit.
+# ---------------------------------------------------------------------------
+def attach_shards(conn, dbnames):
+    names = []
+    for (index, dbname) in enumerate(dbnames):
+        name = "shard%02d" % index
+        conn.execute("attach database ? as " + name, (dbname,))
+        names.append(name)
+    return names
+
+
+# ---------------------------------------------------------------------------
+# ShardedQuery
+# ---------------------------------------------------------------------------
+class ShardedQuery:
+    def __init__(self, dbnames, pool_size=4, batch_size=1000):
+        self.shards = [OsmQuery(dbname, pool_size, batch_size) for dbname in dbnames]
+
+        conn = sqlite3.connect('file:' + dbnames[0] + '?mode=ro', uri=True)
+        try:
+            (shards, self.partition, self.id_block) = conn.execute(
+                "select shards, partition, id_block from shard_info").fetchone()
+        finally:
+            conn.close()
+
+        if shards != len(dbnames):
+            raise ValueError("Expected %d shards, got %d" % (shards, len(dbnames)))
+
+    # All shards written for dbname by osm2sqlite.py -N, named the way it
+    # names them; the first one says how many there are
+    @classmethod
+    def open(cls, dbname, pool_size=4, batch_size=1000):
+        first = shard_name(dbname, 0)
+        if not os.path.exists(first):
+            raise ValueError("No shards found for " + dbname)
+
+        conn = sqlite3.connect('file:' + first + '?mode=ro', uri=True)
+        try:
+            (shards,) = conn.execute("select shards from shard_info").fetchone()
+        finally:
+            conn.close()
+
+        return cls([shard_name(dbname, i) for i in range(shards)], pool_size, batch_size)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def _owner(self, obj_type, obj_id):
+        # Relations are always split by id; nodes and ways only in id mode
+        if self.partition == 'id' or obj_type == ObjTypes.relation:
+            return self.shards[(obj_id // self.id_block) % len(self.shards)]
+        return None
+
+    def _merge(self, streams):
+        return heapq.merge(*streams, key=lambda obj: obj.id)
+
+    def get(self, obj_type, obj_id):
+        owner = self._owner(obj_type, obj_id)
+        if owner is not None:
+            return owner.get(obj_type, obj_id)
+
+        for shard in self.shards:
+            obj = shard.get(obj_type, obj_id)
+            if obj is not None:
+                return obj
+        return None
+
+    def node(self, node_id):
+        return self.get(ObjTypes.node, node_id)
+
+    def way(self, way_id):
+        return self.get(ObjTypes.way, way_id)
+
+    def relation(self, relation_id):
+        return self.get(ObjTypes.relation, relation_id)
+
+    def way_geometry(self, way_id):
+        owner = self._owner(ObjTypes.way, way_id)
+        if owner is not None:
+            return owner.way_geometry(way_id)
+
+        for shard in self.shards:
+            blob = shard.way_geometry(way_id)
+            if blob is not None:
+                return blob
+        return None
+
+    def nodes_in_bbox(self, bbox):
+        return self._merge([shard.nodes_in_bbox(bbox) for shard in self.shards])
+
+    def ways_in_bbox(self, bbox):
+        return self._merge([shard.ways_in_bbox(bbox) for shard in self.shards])
+
+    def by_tag(self, obj_type, key, value=None):
+        return self._merge([shard.by_tag(obj_type, key, value) for shard in self.shards])
+
+    def in_time_window(self, obj_type, start, end):
+        return self._merge([shard.in_time_window(obj_type, start, end)
+                            for shard in self.shards])
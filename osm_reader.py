@@ -18,20 +18,30 @@
 #  Program ran on: Ubuntu 22.04 LTS
 #
 import bz2
-import gzip
+import io
 import os
 import sys
 
 
 from datetime import date
+from html import unescape
+
+from osm_codecs import detect, read_size
+from osm_gzindex import GzipRangeFile
 
 
 class ObjTypes:
     (nul, node, way, relation, changeset, eof) = range(0, 6)
 
+
+# Element names, indexed by ObjTypes
+TYPE_NAMES = ('', 'node', 'way', 'relation', 'changeset', '')
+
 # OSMReader
 #
-# Automatically handles straight text osm, as well as bz2, gz compressed files
+# Automatically handles straight text osm, as well as bz2, gz, xz (zst, lz4)
+# compressed files (osm_codecs.py) and .osm.pbf (decoded by osm_pbf.py), all
+# recognized by their first bytes
 #
 # Does not decompress the file if its compressed
 # Does not care about end of line markers.
@@ -49,30 +59,115 @@ class ObjTypes:
 #
 
 
+# ---------------------------------------------------------------------------
+# Raw file limited to the bytes [start, end) of a file, so a reader can be
+# given one piece of a split index (splitter.py -V), or start at a bz2
+# stream from an osm_bzindex.py index
+# ---------------------------------------------------------------------------
+class ByteRangeFile(io.RawIOBase):
+    def __init__(self, filename, start, end):
+        super().__init__()
+        self.fptr = open(filename, 'rb')
+        self.fptr.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining)
+        if n <= 0:
+            return 0
+        data = self.fptr.read(n)
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.fptr.close()
+        super().close()
+
+
 class OsmReader:
-    def __init__(self, filename):
+    # byte_range is (start, end) in the file, end None for the end of the
+    # file. A plain file's range should start and end on object boundaries
+    # (splitter.py finds those). A .bz2 range has to start at a stream
+    # (osm_bzindex.py finds those); skip is how many decompressed bytes to
+    # drop from there to get to the first whole object. A .gz range is in
+    # uncompressed bytes, like a plain file's, and needs an osm_gzindex.py
+    # index.
+    #
+    # PBF files (found by their first bytes, whatever the name) are read
+    # object by object only, through osm_pbf.py; with workers > 1 their
+    # blobs are decoded in that many processes.
+    def __init__(self, filename, byte_range=None, skip=0, workers=0):
         self.name = filename
 
         self.root = ""
         self.ext = ""
         (self.root, self.ext) = os.path.splitext(filename.lower())
 
+        self.pbf = None
+        if byte_range is None and is_pbf(filename):
+            from osm_pbf import PbfReader
+            print("Opening PBF file " + filename)
+            self.pbf = PbfReader(filename, workers)
+            self.pbf_objects = self.pbf.objects()
+
+        # Compression by the first bytes (osm_codecs.py), not the name
+        self.codec = None
+        if self.pbf is None:
+            try:
+                self.codec = detect(filename)
+            except OSError:
+                pass
+        codec_name = self.codec.name if self.codec is not None else None
+
+        if byte_range is not None and codec_name == 'gz' \
+                and not os.path.exists(filename + '.idx'):
+            raise ValueError("No checkpoint index for %s - build one with osm_gzindex.py"
+                             % filename)
+        if byte_range is not None and codec_name not in (None, 'bz2', 'gz'):
+            raise ValueError("Byte ranges of %s files aren't supported" % codec_name)
+
         try:
-            # Automatically handle bz2/gz and plain osm/xml as input files
-            if self.ext == '.bz2':
-                print("Opening BZ2 file" + filename)
-                self.fptr = bz2.BZ2File(filename, 'r')
-            elif self.ext == '.gz':
-                print("Opening gz file" + filename)
-                self.fptr = gzip.open(filename, 'r')
+            # Automatically handle compressed and plain osm/xml as input files
+            # Compressed inputs are opened in text mode so the buffer is
+            # always a str, same as the plain text path below.
+            # (PBF has no text: an empty buffer, objects come from self.pbf)
+            if self.pbf is not None:
+                self.fptr = io.StringIO()
+            elif codec_name == 'bz2' and byte_range is not None:
+                print("Opening BZ2 file %s from byte %d" % (filename, byte_range[0]))
+                self.fptr = bz2.BZ2File(self.open_range(filename, byte_range))
+                # Binary until the first object, so the skip can't end
+                # in the middle of a UTF-8 character
+                self.fptr.read(skip)
+                self.fptr = io.TextIOWrapper(self.fptr, encoding="utf-8", newline='')
+            elif codec_name == 'gz' and byte_range is not None:
+                print("Opening gz file %s from byte %d" % (filename, byte_range[0]))
+                self.fptr = io.BufferedReader(GzipRangeFile(filename, byte_range[0],
+                                                            byte_range[1]), 1 << 20)
+                self.fptr.read(skip)
+                self.fptr = io.TextIOWrapper(self.fptr, encoding="utf-8", newline='')
+            elif self.codec is not None:
+                print("Opening %s file %s" % (codec_name, filename))
+                self.fptr = io.TextIOWrapper(self.codec.open(filename, 'rb'),
+                                             encoding="utf-8", newline='')
+            elif byte_range is not None:
+                print("Opening bytes %d-%s of %s" % (byte_range[0], byte_range[1], filename))
+                self.fptr = io.BufferedReader(self.open_range(filename, byte_range), 1 << 20)
+                self.fptr.read(skip)
+                self.fptr = io.TextIOWrapper(self.fptr, encoding="utf-8", newline='')
             else:  # self.ext == '.osm':
                 print("Opening other file" + filename)
-                self.fptr = open(filename, mode='rt', encoding="utf-8")
+                self.fptr = open(filename, mode='rt', encoding="utf-8", newline='')
         except:
             print("Error opening " + filename + ".")
             sys.exit(-1)
 
-        self.buffer_size = 16384 * 512  # How many bytes to keep around in the buffer
+        # How many characters to read at a time, tuned per codec
+        self.buffer_size = read_size(self.codec)
         self.buffer_pos = 0
         self.buffer = self.fptr.read(self.buffer_size)
         self.bytes_read = len(self.buffer)
@@ -82,6 +177,13 @@ class OsmReader:
 
         self.tag = ""
 
+        # Decompressed bytes read from where the reader started, up to the
+        # end of the last tag, and where that tag started (whitespace
+        # before it included). Text is read with newline='' so these match
+        # the bytes in the file.
+        self.offset = 0
+        self.tag_offset = 0
+
         # I should probably encapsulate the "OSM Object"
         # but I'm leaving it as part of OSMReader for now
         #
@@ -94,22 +196,60 @@ class OsmReader:
         self.obj_user_id = -1
         self.obj_version = -1
         self.obj_timestamp = ''
+        self.obj_iso_timestamp = ''
         self.obj_changeset = -1
+        self.obj_visible = True
+        self.obj_action = ''
+        self.obj_lat = -1
+        self.obj_long = -1
+
+        # Where the current object is: bytes [obj_offset, obj_offset + obj_length)
+        self.obj_offset = -1
+        self.obj_length = 0
+
+        self.obj_tags_k = []
+        self.obj_tags_v = []
+
+        # Way nodes and relation members keep document order - geometry
+        # building and relation_members.local_order depend on it.
+        self.obj_way_nodes = []
+
+        self.obj_rel_members = []
+        self.obj_rel_memtypes = []
+        self.obj_rel_roles = []
+
+    @staticmethod
+    def open_range(filename, byte_range):
+        (start, end) = byte_range
+        if end is None:
+            end = os.path.getsize(filename)
+        return ByteRangeFile(filename, start, end)
+
+    def reset_object(self):
+        # Clear the per-object lists before parsing the next object
+        self.obj_users = ''
+        self.obj_user_id = -1
+        self.obj_visible = True
+
+        # Only nodes (that aren't deleted) have a location, as with PBF
         self.obj_lat = -1
         self.obj_long = -1
 
         self.obj_tags_k = []
         self.obj_tags_v = []
 
-        self.obj_way_nodes = set()
+        self.obj_way_nodes = []
 
-        self.obj_rel_members = set()
+        self.obj_rel_members = []
         self.obj_rel_memtypes = []
+        self.obj_rel_roles = []
 
     def getTag(self):
         return self.tag
 
     def get_bytes_read(self):
+        if self.pbf is not None:
+            return self.pbf.bytes_read
         return self.bytes_read
 
     def find_tag_punc(self, punc):
@@ -137,6 +277,9 @@ class OsmReader:
         return -1
 
     def get_next_tag(self):
+        if self.pbf is not None:
+            raise ValueError(self.name + " is PBF: read it object by object")
+
         # find the close bracket
         cb = self.find_tag_punc('>')
 
@@ -170,6 +313,11 @@ class OsmReader:
 
         # Pick out the tag and clean it up
         self.tag = self.buffer[self.buffer_pos:cb + 1]
+        self.tag_offset = self.offset
+        if self.tag.isascii():
+            self.offset += len(self.tag)
+        else:
+            self.offset += len(self.tag.encode('utf-8'))
         self.tag = self.tag.strip()
         # Not needed in Python3 - all strings are now unicode!
         # if not isinstance(self.tag, unicode):
@@ -308,6 +456,10 @@ class OsmReader:
     # Parses the entire next object for high-level work
     # ---------------------------------------------------------------------------
     def get_next_object(self):
+        if self.pbf is not None:
+            self.load_object(next(self.pbf_objects, None))
+            return
+
         while True:
             line = self.get_next_tag()
 
@@ -320,9 +472,21 @@ class OsmReader:
             else:
                 element = line[1:line.find(' ', 1)]
 
-            if element in ['bound', '?xml', 'osm']:
+            if element in ['bound', '?xml', 'osm', 'osmChange']:
+                continue
+
+            # osmChange files wrap objects in <create>, <modify> and <delete>
+            if element in ['create', 'modify', 'delete']:
+                self.obj_action = element
+                continue
+
+            if element in ['/create', '/modify', '/delete']:
+                self.obj_action = ''
                 continue
 
+            if element in ('node', 'way', 'relation', 'changeset'):
+                self.obj_offset = self.tag_offset
+
             if element == 'node':
                 self.obj_type = ObjTypes.node
             elif element == 'way':
@@ -333,25 +497,55 @@ class OsmReader:
                 self.obj_type = ObjTypes.relation
 
             if element in ['node', 'way', 'relation']:
+                self.reset_object()
+
                 s = line.find('id="', 4) + 4
                 e = line.find('"', s)
 
                 self.obj_id = int(line[s:e])
 
                 s = line.find('timestamp="', 4) + 11
-                e = line.find('T', s)
-                (year, month, day) = line[s:e].split('-')
+                e = line.find('"', s)
+                self.obj_iso_timestamp = line[s:e]
+                (year, month, day) = line[s:s + 10].split('-')
                 self.obj_timestamp = date(int(year), int(month), int(day))
 
-                s = line.find('changeset="', 4) + 11
-                e = line.find('"', s)
-                self.obj_changeset = int(line[s:e])
+                # Extracts (e.g. from osm_export.py) may not carry these
+                s = line.find(' changeset="', 4)
+                if s > 0:
+                    s += 12
+                    e = line.find('"', s)
+                    self.obj_changeset = int(line[s:e])
+                else:
+                    self.obj_changeset = -1
 
-                s = line.find('version="', 4) + 9
-                e = line.find('"', s)
-                self.obj_version = int(line[s:e])
+                s = line.find(' version="', 4)
+                if s > 0:
+                    s += 10
+                    e = line.find('"', s)
+                    self.obj_version = int(line[s:e])
+                else:
+                    self.obj_version = -1
+
+                # Anonymous edits in old history have no uid/user
+                s = line.find(' uid="', 4)
+                if s > 0:
+                    s += 6
+                    e = line.find('"', s)
+                    self.obj_user_id = int(line[s:e])
+
+                s = line.find(' user="', 4)
+                if s > 0:
+                    s += 7
+                    e = line.find('"', s)
+                    self.obj_users = unescape(line[s:e])
+
+                # History files mark deleted versions with visible="false"
+                self.obj_visible = line.find('visible="false"', 4) < 0
 
             elif element == 'changeset':
+                self.reset_object()
+
                 s = line.find('id="', 4) + 4
                 e = line.find('"', s)
 
@@ -359,8 +553,9 @@ class OsmReader:
 
                 # For Changeset, use "Created At" for Timestamp
                 s = line.find('created_at="', 4) + 12
-                e = line.find('T', s)
-                (year, month, day) = line[s:e].split('-')
+                e = line.find('"', s)
+                self.obj_iso_timestamp = line[s:e]
+                (year, month, day) = line[s:s + 10].split('-')
                 self.obj_timestamp = date(int(year), int(month), int(day))
 
                 #
@@ -371,22 +566,25 @@ class OsmReader:
             # Node
             #
             if element == 'node':
-                s = line.find('lat="', 4) + 5
-                e = line.find('"', s)
-                self.obj_lat = float(line[s:e])
+                # Deleted node versions carry no location
+                s = line.find('lat="', 4)
+                if s > 0:
+                    s += 5
+                    e = line.find('"', s)
+                    self.obj_lat = float(line[s:e])
 
-                s = line.find('lon="', 4) + 5
-                e = line.find('"', s)
-                self.obj_long = float(line[s:e])
+                    s = line.find('lon="', 4) + 5
+                    e = line.find('"', s)
+                    self.obj_long = float(line[s:e])
 
             elif element == 'tag':
                 s = line.find('k="', 4) + 3
                 e = line.find('"', s)
-                key = line[s:e]
+                key = unescape(line[s:e])
 
                 s = line.find('v="', 4) + 3
                 e = line.find('"', s)
-                value = line[s:e]
+                value = unescape(line[s:e])
 
                 self.obj_tags_k.append(key)
                 self.obj_tags_v.append(value)
@@ -397,15 +595,13 @@ class OsmReader:
                 e = line.find('"', s)
                 node_id = int(line[s:e])
 
-                self.obj_way_nodes.add(node_id)
+                self.obj_way_nodes.append(node_id)
 
             elif element == 'member':
                 s = line.find('ref="', 6) + 5
                 e = line.find('"', s)
                 member = int(line[s:e])
 
-                self.obj_rel_members.add(member)
-
                 s = line.find('type="', 6) + 6
                 e = line.find('"', s)
                 memtype = line[s:e]
@@ -416,14 +612,139 @@ class OsmReader:
                     self.obj_rel_memtypes.append(ObjTypes.way)
                 elif memtype == 'relation':
                     self.obj_rel_memtypes.append(ObjTypes.relation)
+                else:
+                    continue
+
+                self.obj_rel_members.append(member)
+
+                s = line.find('role="', 6) + 6
+                e = line.find('"', s)
+                self.obj_rel_roles.append(unescape(line[s:e]))
 
             # if element==...
 
             # End of object - break out of loop
-            if element in {'/node', '/way', '/relation'}:
+            if element in {'/node', '/way', '/relation', '/changeset'}:
+                self.obj_length = self.offset - self.obj_offset
                 break
 
-            if element in {'node', 'way', 'relation'} and line[-2] == '/':
+            if element in {'node', 'way', 'relation', 'changeset'} and line[-2] == '/':
+                self.obj_length = self.offset - self.obj_offset
                 break
 
+    # ---------------------------------------------------------------------------
+    # Copy the current object out of the reader into an OsmObject
+    # ---------------------------------------------------------------------------
+    def snapshot(self):
+        obj = OsmObject()
+        obj.type = self.obj_type
+        obj.id = self.obj_id
+        obj.version = self.obj_version
+        obj.timestamp = self.obj_timestamp
+        obj.iso_timestamp = self.obj_iso_timestamp
+        obj.changeset = self.obj_changeset
+        obj.uid = self.obj_user_id
+        obj.user = self.obj_users
+        obj.visible = self.obj_visible
+        obj.action = self.obj_action
+        obj.lat = self.obj_lat
+        obj.lon = self.obj_long
+        obj.tags = list(zip(self.obj_tags_k, self.obj_tags_v))
+        obj.nodes = self.obj_way_nodes
+        obj.members = list(zip(self.obj_rel_memtypes,
+                               self.obj_rel_members,
+                               self.obj_rel_roles))
+        return obj
+
+    # ---------------------------------------------------------------------------
+    # The other way round, for objects decoded elsewhere (PBF)
+    # ---------------------------------------------------------------------------
+    def load_object(self, obj):
+        if obj is None:
+            self.obj_type = ObjTypes.eof
+            return
+        self.obj_type = obj.type
+        self.obj_id = obj.id
+        self.obj_version = obj.version
+        self.obj_timestamp = obj.timestamp
+        self.obj_iso_timestamp = obj.iso_timestamp
+        self.obj_changeset = obj.changeset
+        self.obj_user_id = obj.uid
+        self.obj_users = obj.user
+        self.obj_visible = obj.visible
+        self.obj_action = obj.action
+        self.obj_lat = obj.lat
+        self.obj_long = obj.lon
+        self.obj_tags_k = [k for (k, _) in obj.tags]
+        self.obj_tags_v = [v for (_, v) in obj.tags]
+        self.obj_way_nodes = obj.nodes
+        self.obj_rel_memtypes = [t for (t, _, _) in obj.members]
+        self.obj_rel_members = [ref for (_, ref, _) in obj.members]
+        self.obj_rel_roles = [role for (_, _, role) in obj.members]
+
+    # ---------------------------------------------------------------------------
+    # Generator over every object in the file
+    # ---------------------------------------------------------------------------
+    def objects(self):
+        if self.pbf is not None:
+            yield from self.pbf_objects
+            return
+
+        while True:
+            self.get_next_object()
+
+            if self.obj_type == ObjTypes.eof:
+                return
+
+            yield self.snapshot()
+
 # class OsmReader
+
+
+# PBF files start with the length of their first BlobHeader, which is an
+# OSMHeader: field 1, 9 bytes, "OSMHeader"
+PBF_MAGIC = b'\x0a\x09OSMHeader'
+
+
+def is_pbf(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(15)[4:] == PBF_MAGIC
+    except OSError:
+        return False
+
+
+# OsmObject
+#
+# A parsed node, way, relation or changeset, detached from the reader so
+# it can be kept around, queued or handed to another process.
+#
+#   tags    - list of (key, value)
+#   nodes   - list of node ids, in way order
+#   members - list of (ObjTypes.x, ref, role), in relation order
+#   action  - 'create', 'modify' or 'delete' when read from an osmChange file
+#
+class OsmObject:
+    __slots__ = ('type', 'id', 'version', 'timestamp', 'iso_timestamp',
+                 'changeset', 'uid', 'user', 'visible', 'action', 'lat', 'lon',
+                 'tags', 'nodes', 'members')
+
+    def __init__(self, obj_type=ObjTypes.nul, obj_id=-1):
+        self.type = obj_type
+        self.id = obj_id
+        self.version = -1
+        self.timestamp = None
+        self.iso_timestamp = ''
+        self.changeset = -1
+        self.uid = -1
+        self.user = ''
+        self.visible = True
+        self.action = ''
+        self.lat = -1
+        self.lon = -1
+        self.tags = []
+        self.nodes = []
+        self.members = []
+
+    def __repr__(self):
+        return "OsmObject(%s, %d, v%d)" % (TYPE_NAMES[self.type], self.id, self.version)
@@ -0,0 +1,677 @@
+# ---------------------------------------------------------------------------
+# osm_tiles.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0913 # Too many arguments
+# pylint: disable=R0914 # Too many locals
+# pylint: disable=W0603 # Using the global statement
+#
+# Builds a vector tile pyramid (Mapbox Vector Tiles in an MBTiles file) from
+# the features of an osm2fgdb.py GeoPackage or an osm2sqlite.py database.
+#
+#   osm_tiles.py -i hawaii.gpkg -o hawaii.mbtiles -z 0 -Z 14 -j 4
+#
+# Three tile layers:
+#   areas - area_ways + multipolygons (GeoPackage), closed way polygons (SQLite)
+#   ways  - ways as lines
+#   nodes - tagged nodes
+# Feature ids are the OSM ids, properties the mapped columns (GeoPackage) or
+# the tags (SQLite).
+#
+# 1. Features are projected to Web Mercator world coordinates (0..1, y down)
+#    and loaded into a temp SQLite feature store with an rtree over their
+#    bboxes - one streaming pass, flat memory.
+# 2. Tiles are built a zoom level at a time by a process pool; every worker
+#    reads the store on its own. A tile's features are clipped to the tile
+#    (plus a buffer), simplified with Douglas-Peucker to SIMPLIFY tile
+#    pixels - so the tolerance halves on the ground every zoom - rounded
+#    to the tile grid and MVT encoded. Features smaller than a pixel are
+#    dropped, and layers start at LAYER_MINZOOM.
+# 3. Only the children of tiles that have any features are built at the
+#    next zoom, so empty ocean costs nothing.
+# Tiles are gzipped, as MBTiles readers expect, and written in batches.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_tiles.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser
+from array import array
+from itertools import groupby
+import gzip
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from osm_geometry import point_wkb, linestring_wkb, polygon_wkb, multipolygon_wkb, \
+    parse_wkb, WkbTypes
+from osm_multipolygon import ring_area
+from osm_mvt import MvtLayer, encode_tile, EXTENT, GEOM_POINT, GEOM_LINESTRING, GEOM_POLYGON
+
+LAYERS = ('areas', 'ways', 'nodes')
+LAYER_MINZOOM = {'areas': 0, 'ways': 6, 'nodes': 12}
+
+# Tile buffer and simplification tolerance, in tile pixels (256 to a tile)
+BUFFER = 4
+SIMPLIFY = 0.5
+
+MAX_LAT = 85.0511287798
+
+STORE_SCHEMA = [
+    "create table features (id INTEGER PRIMARY KEY, layer INTEGER, osm_id INTEGER, "
+    "minzoom INTEGER, geom BLOB, props TEXT)",
+    "create virtual table features_rtree using rtree(id, minx, maxx, miny, maxy)",
+]
+
+TILE_QUERY = ("select f.layer, f.osm_id, f.geom, f.props, r.maxx - r.minx, r.maxy - r.miny "
+              "from features_rtree r join features f on f.id = r.id "
+              "where r.minx <= ? and r.maxx >= ? and r.miny <= ? and r.maxy >= ? "
+              "and f.minzoom <= ? order by f.id")
+
+ANY_QUERY = ("select 1 from features_rtree "
+             "where minx <= ? and maxx >= ? and miny <= ? and maxy >= ? limit 1")
+
+MBTILES_SCHEMA = [
+    "create table metadata (name TEXT, value TEXT)",
+    "create table tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+    "tile_data BLOB)",
+    "create unique index tile_index on tiles (zoom_level, tile_column, tile_row)",
+]
+
+
+# ---------------------------------------------------------------------------
+# Projection
+# ---------------------------------------------------------------------------
+def world_xy(lon, lat):
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    s = math.sin(math.radians(lat))
+    return ((lon + 180.0) / 360.0, 0.5 - math.log((1.0 + s) / (1.0 - s)) / (4.0 * math.pi))
+
+
+def world_lonlat(x, y):
+    return (x * 360.0 - 180.0,
+            math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y)))))
+
+
+def project(coords):
+    out = array('d')
+    for i in range(0, len(coords), 2):
+        out.extend(world_xy(coords[i], coords[i + 1]))
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Clipping to a box (minx, miny, maxx, maxy)
+# ---------------------------------------------------------------------------
+def clip_line(coords, box):
+    # Liang-Barsky per segment; returns the pieces inside the box
+    (minx, miny, maxx, maxy) = box
+    parts = []
+    part = []
+
+    for i in range(0, len(coords) - 2, 2):
+        (x0, y0, x1, y1) = (coords[i], coords[i + 1], coords[i + 2], coords[i + 3])
+        (dx, dy) = (x1 - x0, y1 - y0)
+        (t0, t1) = (0.0, 1.0)
+        visible = True
+        for (p, q) in ((-dx, x0 - minx), (dx, maxx - x0), (-dy, y0 - miny), (dy, maxy - y0)):
+            if p == 0:
+                if q < 0:
+                    visible = False
+                    break
+            else:
+                t = q / p
+                if p < 0:
+                    t0 = max(t0, t)
+                else:
+                    t1 = min(t1, t)
+                if t0 > t1:
+                    visible = False
+                    break
+
+        if not visible:
+            if part:
+                parts.append(part)
+                part = []
+            continue
+
+        start = (x0 + t0 * dx, y0 + t0 * dy)
+        if not part:
+            part.extend(start)
+        part.extend((x0 + t1 * dx, y0 + t1 * dy))
+        # Left the box - this piece is done
+        if t1 < 1.0:
+            parts.append(part)
+            part = []
+
+    if part:
+        parts.append(part)
+    return parts
+
+
+def clip_ring(ring, box):
+    # Sutherland-Hodgman against each edge in turn; returns a closed ring
+    (minx, miny, maxx, maxy) = box
+    points = [(ring[i], ring[i + 1]) for i in range(0, len(ring) - 2, 2)]
+
+    edges = ((0, minx, False), (0, maxx, True), (1, miny, False), (1, maxy, True))
+    for (axis, limit, upper) in edges:
+        if not points:
+            break
+        clipped = []
+        prev = points[-1]
+        prev_in = (prev[axis] <= limit) if upper else (prev[axis] >= limit)
+        for cur in points:
+            cur_in = (cur[axis] <= limit) if upper else (cur[axis] >= limit)
+            if cur_in != prev_in:
+                t = (limit - prev[axis]) / (cur[axis] - prev[axis])
+                clipped.append((prev[0] + t * (cur[0] - prev[0]),
+                                prev[1] + t * (cur[1] - prev[1])))
+            if cur_in:
+                clipped.append(cur)
+            (prev, prev_in) = (cur, cur_in)
+        points = clipped
+
+    if len(points) < 3:
+        return []
+    points.append(points[0])
+    return [c for p in points for c in p]
+
+
+# ---------------------------------------------------------------------------
+# Douglas-Peucker, without recursion. Keeps the end points.
+# ---------------------------------------------------------------------------
+def simplify(coords, tolerance):
+    npoints = len(coords) // 2
+    if npoints < 3 or tolerance <= 0:
+        return coords
+
+    keep = bytearray(npoints)
+    keep[0] = keep[-1] = 1
+    tol2 = tolerance * tolerance
+
+    stack = [(0, npoints - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        (ax, ay) = (coords[2 * first], coords[2 * first + 1])
+        (bx, by) = (coords[2 * last], coords[2 * last + 1])
+        (dx, dy) = (bx - ax, by - ay)
+        length2 = dx * dx + dy * dy
+
+        worst = -1.0
+        index = -1
+        for i in range(first + 1, last):
+            (px, py) = (coords[2 * i] - ax, coords[2 * i + 1] - ay)
+            if length2 == 0:
+                d2 = px * px + py * py
+            else:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / length2))
+                (ex, ey) = (px - t * dx, py - t * dy)
+                d2 = ex * ex + ey * ey
+            if d2 > worst:
+                (worst, index) = (d2, i)
+
+        if worst > tol2:
+            keep[index] = 1
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [c for i in range(npoints) if keep[i] for c in (coords[2 * i], coords[2 * i + 1])]
+
+
+# ---------------------------------------------------------------------------
+# World coordinates -> integer tile coordinates, without repeated points
+# ---------------------------------------------------------------------------
+def to_tile(coords, scale, ox, oy):
+    out = []
+    (lx, ly) = (None, None)
+    for i in range(0, len(coords), 2):
+        x = int(round(coords[i] * scale - ox))
+        y = int(round(coords[i + 1] * scale - oy))
+        if x != lx or y != ly:
+            out.append(x)
+            out.append(y)
+            (lx, ly) = (x, y)
+    return out
+
+
+def tile_rings(rings, box, tolerance, scale, ox, oy):
+    parts = []
+    for (n, ring) in enumerate(rings):
+        ring = clip_ring(ring, box)
+        if not ring:
+            if n == 0:
+                return []
+            continue
+        ring = to_tile(simplify(ring, tolerance), scale, ox, oy)
+        if len(ring) < 8:
+            if n == 0:
+                return []
+            continue
+
+        # Screen coordinates (y down): exterior rings positive, holes negative
+        area = ring_area(ring)
+        if area == 0:
+            if n == 0:
+                return []
+            continue
+        if (area > 0) != (n == 0):
+            ring = [c for i in range(len(ring) - 2, -1, -2) for c in (ring[i], ring[i + 1])]
+        # MVT rings aren't closed
+        parts.append(ring[:-2])
+    return parts
+
+
+# ---------------------------------------------------------------------------
+# Tile building - runs in the pool. Every worker opens the store read-only.
+# ---------------------------------------------------------------------------
+_store = None
+
+
+def open_store(path):
+    global _store
+    _store = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+
+
+def build_tile(tile):
+    (z, x, y) = tile
+    n = 1 << z
+    scale = float(EXTENT) * n
+    (ox, oy) = (x * EXTENT, y * EXTENT)
+
+    # Tile box in world coordinates, plus the buffer
+    pad = BUFFER / 256.0
+    box = ((x - pad) / n, (y - pad) / n, (x + 1 + pad) / n, (y + 1 + pad) / n)
+    pixel = 1.0 / (256.0 * n)
+    tolerance = SIMPLIFY * pixel
+
+    has_any = _store.execute(ANY_QUERY, (box[2], box[0], box[3], box[1])).fetchone() is not None
+    if not has_any:
+        return (tile, None, 0, False)
+
+    layers = [MvtLayer(name) for name in LAYERS]
+    points = [[] for _ in LAYERS]
+
+    for (layer, osm_id, blob, props, width, height) in _store.execute(
+            TILE_QUERY, (box[2], box[0], box[3], box[1], z)):
+        (wkb_type, geometry) = parse_wkb(blob)
+        properties = json.loads(props)
+
+        if wkb_type == WkbTypes.point:
+            (px, py) = to_tile(geometry, scale, ox, oy)
+            points[layer].append((osm_id, [px, py], properties))
+            continue
+
+        # Smaller than a pixel at this zoom
+        if width < pixel and height < pixel:
+            continue
+
+        if wkb_type == WkbTypes.linestring:
+            parts = []
+            for piece in clip_line(geometry, box):
+                piece = to_tile(simplify(piece, tolerance), scale, ox, oy)
+                if len(piece) >= 4:
+                    parts.append(piece)
+            if parts:
+                layers[layer].add_feature(osm_id, GEOM_LINESTRING, parts, properties)
+            continue
+
+        polygons = [geometry] if wkb_type == WkbTypes.polygon else geometry
+        parts = []
+        for rings in polygons:
+            parts.extend(tile_rings(rings, box, tolerance, scale, ox, oy))
+        if parts:
+            layers[layer].add_feature(osm_id, GEOM_POLYGON, parts, properties)
+
+    for (layer, items) in enumerate(points):
+        for (osm_id, part, properties) in items:
+            layers[layer].add_feature(osm_id, GEOM_POINT, [part], properties)
+
+    count = sum(len(layer) for layer in layers)
+    if count == 0:
+        return (tile, None, 0, True)
+    return (tile, gzip.compress(encode_tile(layers), 6), count, True)
+
+
+# ---------------------------------------------------------------------------
+# Feature store loading
+# ---------------------------------------------------------------------------
+class FeatureStore:
+    def __init__(self, path, batch_size=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        for sql in STORE_SCHEMA:
+            self.conn.execute(sql)
+        self.rows = []
+        self.boxes = []
+        self.count = 0
+        self.extent = None
+
+    def add(self, layer, osm_id, geometry_type, geometry, properties):
+        # geometry in lon/lat: point (x, y), line flat, polygon [rings],
+        # multipolygon [[rings], ...]
+        if geometry_type == 'point':
+            (x, y) = world_xy(geometry[0], geometry[1])
+            blob = point_wkb(x, y)
+            box = (x, y, x, y)
+        elif geometry_type == 'polyline':
+            coords = project(geometry)
+            blob = linestring_wkb(coords)
+            box = (min(coords[0::2]), min(coords[1::2]), max(coords[0::2]), max(coords[1::2]))
+        else:
+            polygons = [geometry] if geometry_type == 'polygon' else geometry
+            polygons = [[project(ring) for ring in rings] for rings in polygons]
+            outers = [rings[0] for rings in polygons]
+            box = (min(min(r[0::2]) for r in outers), min(min(r[1::2]) for r in outers),
+                   max(max(r[0::2]) for r in outers), max(max(r[1::2]) for r in outers))
+            if geometry_type == 'polygon':
+                blob = polygon_wkb(polygons[0])
+            else:
+                blob = multipolygon_wkb(polygons)
+
+        self.count += 1
+        props = {k: v for (k, v) in properties.items() if v is not None and v != ''}
+        self.rows.append((self.count, LAYERS.index(layer), osm_id, LAYER_MINZOOM[layer],
+                          blob, json.dumps(props, ensure_ascii=False)))
+        self.boxes.append((self.count, box[0], box[2], box[1], box[3]))
+
+        if self.extent is None:
+            self.extent = box
+        else:
+            self.extent = (min(self.extent[0], box[0]), min(self.extent[1], box[1]),
+                           max(self.extent[2], box[2]), max(self.extent[3], box[3]))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany("insert into features values (?, ?, ?, ?, ?, ?)", self.rows)
+        self.conn.executemany("insert into features_rtree values (?, ?, ?, ?, ?)", self.boxes)
+        self.conn.commit()
+        self.rows = []
+        self.boxes = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# GeoPackage binary header: magic, version, flags, srs id, then an envelope
+# whose size depends on flags bits 1-3
+GPKG_ENVELOPE_SIZE = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+# osm2fgdb.py layers -> (tile layer, id column)
+GPKG_LAYERS = [
+    ('nodes', 'nodes', 'Node_ID'),
+    ('ways', 'ways', 'Way_ID'),
+    ('area_ways', 'areas', 'Way_ID'),
+    ('multipolygons', 'areas', 'Relation_ID'),
+]
+
+
+def gpkg_geometry(blob):
+    flags = blob[3]
+    (wkb_type, geometry) = parse_wkb(blob[8 + GPKG_ENVELOPE_SIZE[(flags >> 1) & 7]:])
+    if wkb_type == WkbTypes.point:
+        return ('point', geometry)
+    if wkb_type == WkbTypes.linestring:
+        return ('polyline', geometry)
+    if wkb_type == WkbTypes.polygon:
+        return ('polygon', geometry)
+    return ('multipolygon', geometry)
+
+
+def load_gpkg(conn, store):
+    tables = {r[0] for r in conn.execute("select table_name from gpkg_contents")}
+
+    for (table, layer, id_column) in GPKG_LAYERS:
+        if table not in tables:
+            continue
+        cursor = conn.execute('select * from "%s"' % table)
+        names = [d[0] for d in cursor.description]
+        geom = names.index('geom')
+        for row in cursor:
+            if row[geom] is None:
+                continue
+            values = dict(zip(names, row))
+            osm_id = values.pop(id_column, None)
+            del values['fid']
+            del values['geom']
+            (geometry_type, geometry) = gpkg_geometry(row[geom])
+            store.add(layer, osm_id, geometry_type, geometry, values)
+
+
+def load_sqlite(conn, store):
+    # Tagged nodes, tags read in node id order alongside
+    rows = conn.execute("select t.node_id, n.lon, n.lat, t.key, t.value from node_tags t "
+                        "join nodes n on n.id = t.node_id order by t.node_id")
+    for (node_id, group) in groupby(rows, key=lambda r: r[0]):
+        group = list(group)
+        store.add('nodes', node_id, 'point', (group[0][1], group[0][2]),
+                  {r[3]: r[4] for r in group})
+
+    # Way geometries merged with the tags, both in way id order
+    tags = groupby(conn.execute("select way_id, key, value from way_tags order by way_id"),
+                   key=lambda r: r[0])
+    (tag_id, tag_group) = next(tags, (None, None))
+    for (way_id, blob) in conn.execute("select way_id, geom from way_geometry "
+                                       "where geom is not null order by way_id"):
+        while tag_id is not None and tag_id < way_id:
+            (tag_id, tag_group) = next(tags, (None, None))
+        properties = {}
+        if tag_id == way_id:
+            properties = {r[1]: r[2] for r in tag_group}
+
+        (wkb_type, geometry) = parse_wkb(blob)
+        if wkb_type == WkbTypes.polygon:
+            store.add('areas', way_id, 'polygon', geometry, properties)
+        elif wkb_type == WkbTypes.linestring and len(geometry) >= 4:
+            store.add('ways', way_id, 'polyline', geometry, properties)
+
+
+def load_features(source, store):
+    conn = sqlite3.connect(source)
+    tables = {r[0] for r in conn.execute("select name from sqlite_master where type = 'table'")}
+    if 'gpkg_contents' in tables:
+        load_gpkg(conn, store)
+    elif 'way_geometry' in tables:
+        load_sqlite(conn, store)
+    else:
+        conn.close()
+        raise ValueError(source + " is neither an osm2fgdb.py GeoPackage nor an "
+                         "osm2sqlite.py database")
+    conn.close()
+
+
+# ---------------------------------------------------------------------------
+# MBTiles
+# ---------------------------------------------------------------------------
+def open_mbtiles(path):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    for sql in MBTILES_SCHEMA:
+        conn.execute(sql)
+    return conn
+
+
+def write_metadata(conn, name, extent, minzoom, maxzoom):
+    (west, north) = world_lonlat(extent[0], extent[1])
+    (east, south) = world_lonlat(extent[2], extent[3])
+    vector_layers = [{'id': layer, 'fields': {}, 'minzoom': max(minzoom, LAYER_MINZOOM[layer]),
+                      'maxzoom': maxzoom} for layer in LAYERS]
+    metadata = {
+        'name': name,
+        'format': 'pbf',
+        'type': 'overlay',
+        'version': '1',
+        'minzoom': str(minzoom),
+        'maxzoom': str(maxzoom),
+        'bounds': '%.7f,%.7f,%.7f,%.7f' % (west, south, east, north),
+        'center': '%.7f,%.7f,%d' % ((west + east) / 2.0, (south + north) / 2.0, minzoom),
+        'json': json.dumps({'vector_layers': vector_layers}),
+    }
+    conn.executemany("insert into metadata values (?, ?)", sorted(metadata.items()))
+
+
+def start_tiles(extent, zoom):
+    # The tiles at zoom that the data extent touches
+    n = 1 << zoom
+    (x0, y0) = (int(extent[0] * n), int(extent[1] * n))
+    (x1, y1) = (min(n - 1, int(extent[2] * n)), min(n - 1, int(extent[3] * n)))
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+# ---------------------------------------------------------------------------
+# Build the pyramid. Returns {zoom: (tiles written, seconds)}.
+# ---------------------------------------------------------------------------
+def build_pyramid(store_path, extent, mbtiles, minzoom, maxzoom, workers=0, batch_size=1000,
+                  progress=None):
+    if workers > 0:
+        pool = multiprocessing.Pool(workers, initializer=open_store, initargs=(store_path,))
+        run = pool.imap_unordered
+    else:
+        pool = None
+        open_store(store_path)
+        run = map
+
+    stats = {}
+    tiles = start_tiles(extent, minzoom)
+    try:
+        for zoom in range(minzoom, maxzoom + 1):
+            t = time.perf_counter()
+            written = 0
+            batch = []
+            children = []
+
+            chunk = max(1, min(64, len(tiles) // (4 * max(1, workers))))
+            args = (tiles, chunk) if pool is not None else (tiles,)
+            for ((z, x, y), data, _, has_any) in run(build_tile, *args):
+                if has_any and z < maxzoom:
+                    children.extend((z + 1, cx, cy) for cx in (2 * x, 2 * x + 1)
+                                    for cy in (2 * y, 2 * y + 1))
+                if data is None:
+                    continue
+
+                # MBTiles rows are TMS - y from the bottom
+                batch.append((z, x, (1 << z) - 1 - y, data))
+                written += 1
+                if len(batch) >= batch_size:
+                    mbtiles.executemany("insert into tiles values (?, ?, ?, ?)", batch)
+                    mbtiles.commit()
+                    batch = []
+
+            if batch:
+                mbtiles.executemany("insert into tiles values (?, ?, ?, ?)", batch)
+                mbtiles.commit()
+
+            stats[zoom] = (written, time.perf_counter() - t)
+            if progress is not None:
+                progress(zoom, len(tiles), written, stats[zoom][1])
+
+            # imap_unordered - keep the next level in a stable order
+            tiles = sorted(children)
+            if not tiles:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return stats
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-i', '--input', dest='source',
+                      help="osm2fgdb.py GeoPackage or osm2sqlite.py database", metavar="FILE")
+
+    parser.add_option('-o', '--output', dest='output',
+                      help="MBTiles file to write", metavar="FILE")
+
+    parser.add_option('-z', '--minzoom', dest='minzoom', type='int', default=0,
+                      help="Lowest zoom level (default 0).")
+
+    parser.add_option('-Z', '--maxzoom', dest='maxzoom', type='int', default=14,
+                      help="Highest zoom level (default 14).")
+
+    parser.add_option('-j', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count() - 1,
+                      help="Worker processes building tiles (0 = none).")
+
+    parser.add_option('-w', '--workdir', dest='workdir', default=None,
+                      help="Directory for the temp feature store (default: system temp).")
+
+    parser.add_option('-n', '--batch', dest='batch', type='int', default=10000,
+                      help="Features/tiles per write batch.")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    if options.source is None or options.output is None:
+        parser.print_help()
+        sys.exit(-1)
+
+    if not 0 <= options.minzoom <= options.maxzoom <= 24:
+        print("Zoom levels must be 0 <= minzoom <= maxzoom <= 24")
+        sys.exit(-1)
+
+    start = time.perf_counter()
+
+    (fd, store_path) = tempfile.mkstemp(suffix='.features.sqlite', dir=options.workdir)
+    os.close(fd)
+    os.remove(store_path)
+
+    try:
+        print("Loading features from " + options.source)
+        store = FeatureStore(store_path, options.batch)
+        load_features(options.source, store)
+        store.close()
+        print("%d features in %.1fs" % (store.count, time.perf_counter() - start))
+
+        if store.extent is None:
+            print("No features to tile")
+            sys.exit(-1)
+
+        mbtiles = open_mbtiles(options.output)
+        write_metadata(mbtiles, os.path.splitext(os.path.basename(options.output))[0],
+                       store.extent, options.minzoom, options.maxzoom)
+
+        def progress(zoom, tried, written, seconds):
+            print("zoom %2d: %8d tiles (%8d tried) %8.2fs %10.1f tiles/sec"
+                  % (zoom, written, tried, seconds, written / max(seconds, 1e-9)))
+
+        t = time.perf_counter()
+        stats = build_pyramid(store_path, store.extent, mbtiles, options.minzoom,
+                              options.maxzoom, options.workers, options.batch, progress)
+        seconds = time.perf_counter() - t
+        mbtiles.close()
+
+        total = sum(s[0] for s in stats.values())
+        print("%d tiles in %.1fs, %.1f tiles/sec" % (total, seconds, total / max(seconds, 1e-9)))
+    except (sqlite3.Error, OSError, ValueError) as Err:
+        print("Failed: " + str(Err))
+        sys.exit(-1)
+    finally:
+        if os.path.exists(store_path):
+            os.remove(store_path)
+
+    print("Finished in %.1fs" % (time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+# ---------------------------------------------------------------------------
+# osm_update.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0912 # Too many branches
+# pylint: disable=R0914 # Too many locals
+# pylint: disable=R0915 # Too many statements
+#
+# Applies osmChange diffs (.osc, .osc.gz, .osc.bz2) to a database written by
+# osm2sqlite.py, so it can be kept current without reloading a planet.
+#
+#   osm_update.py -d planet.sqlite 004/123/456.osc.gz 004/123/457.osc.gz ...
+#
+# The diffs are read with OsmReader, so anything it can open works here.
+# Each diff is applied in one transaction:
+#   create/modify - upsert the object row, then replace its tags, way nodes
+#                   or relation members (delete by id + insert, both through
+#                   the *_id indexes)
+#   delete        - remove the object and everything hanging off of it
+# Ways that were modified, or that use a node that moved or was deleted
+# (found through way_nodes_node_id), get their way_geometry rebuilt at the
+# end of the diff.
+#
+# The sequence number of the last applied diff is kept in replication_state.
+# Diffs at or below it are skipped, so the same list of files can be passed
+# again safely. The sequence number comes from the replication path
+# (AAA/BBB/CCC.osc.gz -> AAABBBCCC) unless given with -q.
+#
+# Note that diffs are applied whole - a database loaded with a bbox will
+# pick up objects from outside the bbox.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_update.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser
+from array import array
+import os
+import sqlite3
+import sys
+import time
+
+from osm_reader import OsmReader, ObjTypes
+from osm_geometry import build_way_geometry, is_area
+from osm2sqlite import open_database, delete_object, MEMBER_TYPES
+
+SQL = {
+    'upsert_node': "insert into nodes (id, timestamp, user, lat, lon) values (?, ?, ?, ?, ?) "
+                   "on conflict (id) do update set timestamp = excluded.timestamp, "
+                   "user = excluded.user, lat = excluded.lat, lon = excluded.lon",
+    'upsert_way': "insert into ways (id, timestamp, user) values (?, ?, ?) "
+                  "on conflict (id) do update set timestamp = excluded.timestamp, "
+                  "user = excluded.user",
+    'upsert_relation': "insert into relations (id, timestamp, user) values (?, ?, ?) "
+                       "on conflict (id) do update set timestamp = excluded.timestamp, "
+                       "user = excluded.user",
+
+    'delete_node_tags': "delete from node_tags where node_id = ?",
+    'delete_way_tags': "delete from way_tags where way_id = ?",
+    'delete_way_nodes': "delete from way_nodes where way_id = ?",
+    'delete_relation_tags': "delete from relation_tags where relation_id = ?",
+    'delete_relation_members': "delete from relation_members where relation_id = ?",
+
+    'insert_node_tag': "insert or ignore into node_tags (node_id, key, value) values (?, ?, ?)",
+    'insert_way_tag': "insert or ignore into way_tags (way_id, key, value) values (?, ?, ?)",
+    'insert_way_node': "insert or ignore into way_nodes (way_id, local_order, node_id) "
+                       "values (?, ?, ?)",
+    'insert_relation_tag': "insert or ignore into relation_tags (relation_id, key, value) "
+                           "values (?, ?, ?)",
+    'insert_relation_member': "insert into relation_members "
+                              "(relation_id, type, ref, role, local_order) "
+                              "values (?, ?, ?, ?, ?)",
+
+    'ways_using_node': "select way_id from way_nodes where node_id = ?",
+    'way_coords': "select way_nodes.node_id, nodes.lon, nodes.lat from way_nodes "
+                  "left join nodes on nodes.id = way_nodes.node_id "
+                  "where way_nodes.way_id = ? order by way_nodes.local_order",
+    'way_tags': "select key, value from way_tags where way_id = ?",
+    'upsert_geometry': "insert or replace into way_geometry "
+                       "(way_id, min_lon, min_lat, max_lon, max_lat, geom) "
+                       "values (?, ?, ?, ?, ?, ?)",
+    'delete_geometry': "delete from way_geometry where way_id = ?",
+
+    'create_state': "create table if not exists replication_state ("
+                    "id INTEGER PRIMARY KEY CHECK ( id = 1 ), "
+                    "sequence INTEGER, timestamp TEXT)",
+    'get_state': "select sequence, timestamp from replication_state where id = 1",
+    'set_state': "insert or replace into replication_state (id, sequence, timestamp) "
+                 "values (1, ?, ?)",
+}
+
+
+# ---------------------------------------------------------------------------
+# Sequence number from a replication path: .../004/123/456.osc.gz -> 4123456
+# Returns None if the path doesn't look like one.
+# ---------------------------------------------------------------------------
+def sequence_from_path(filename):
+    parts = os.path.abspath(filename).split(os.sep)[-3:]
+    parts[-1] = parts[-1].split('.')[0]
+
+    if len(parts) == 3 and all(len(p) == 3 and p.isdigit() for p in parts):
+        return int(''.join(parts))
+
+    if parts[-1].isdigit():
+        return int(parts[-1])
+
+    return None
+
+
+def get_state(conn):
+    conn.execute(SQL['create_state'])
+    row = conn.execute(SQL['get_state']).fetchone()
+    return row if row else (None, None)
+
+
+# ---------------------------------------------------------------------------
+# Rebuild way_geometry for a set of ways from what's in the database now
+# ---------------------------------------------------------------------------
+def rebuild_geometry(conn, way_ids):
+    for way_id in way_ids:
+        node_ids = []
+        coords = array('d')
+        for (node_id, lon, lat) in conn.execute(SQL['way_coords'], (way_id,)):
+            node_ids.append(node_id)
+            if lon is not None:
+                coords.append(lon)
+                coords.append(lat)
+
+        row = None
+        if node_ids:
+            tags = conn.execute(SQL['way_tags'], (way_id,)).fetchall()
+            area = len(coords) == 2 * len(node_ids) and is_area(node_ids, tags)
+            row = build_way_geometry((way_id, coords, area))
+
+        if row is None:
+            conn.execute(SQL['delete_geometry'], (way_id,))
+        else:
+            conn.execute(SQL['upsert_geometry'], row)
+
+
+# ---------------------------------------------------------------------------
+# Apply one osmChange file in a single transaction. Returns a dict of counts.
+# ---------------------------------------------------------------------------
+def apply_change(conn, filename, sequence=None):
+    counts = {'create': 0, 'modify': 0, 'delete': 0, 'objects': 0, 'geometries': 0}
+
+    dirty_ways = set()
+    last_timestamp = ''
+
+    start = time.perf_counter()
+
+    inputfile = OsmReader(filename)
+
+    with conn:
+        for obj in inputfile.objects():
+            if obj.type == ObjTypes.changeset or obj.action == '':
+                continue
+
+            counts['objects'] += 1
+            counts[obj.action] += 1
+
+            if obj.iso_timestamp > last_timestamp:
+                last_timestamp = obj.iso_timestamp
+
+            if obj.action == 'delete' or not obj.visible:
+                if obj.type == ObjTypes.node:
+                    dirty_ways.update(r[0] for r in conn.execute(SQL['ways_using_node'], (obj.id,)))
+                elif obj.type == ObjTypes.way:
+                    dirty_ways.discard(obj.id)
+                delete_object(conn, obj.type, obj.id)
+                continue
+
+            #
+            # Node
+            #
+            if obj.type == ObjTypes.node:
+                conn.execute(SQL['upsert_node'],
+                             (obj.id, obj.iso_timestamp, obj.user, obj.lat, obj.lon))
+                conn.execute(SQL['delete_node_tags'], (obj.id,))
+                conn.executemany(SQL['insert_node_tag'],
+                                 [(obj.id, k, v) for (k, v) in obj.tags])
+
+                if obj.action == 'modify':
+                    dirty_ways.update(r[0] for r in conn.execute(SQL['ways_using_node'], (obj.id,)))
+
+            #
+            # Way
+            #
+            elif obj.type == ObjTypes.way:
+                conn.execute(SQL['upsert_way'], (obj.id, obj.iso_timestamp, obj.user))
+                conn.execute(SQL['delete_way_tags'], (obj.id,))
+                conn.executemany(SQL['insert_way_tag'],
+                                 [(obj.id, k, v) for (k, v) in obj.tags])
+                conn.execute(SQL['delete_way_nodes'], (obj.id,))
+                conn.executemany(SQL['insert_way_node'],
+                                 [(obj.id, n, node_id) for (n, node_id) in enumerate(obj.nodes)])
+                dirty_ways.add(obj.id)
+
+            #
+            # Relation
+            #
+            elif obj.type == ObjTypes.relation:
+                conn.execute(SQL['upsert_relation'], (obj.id, obj.iso_timestamp, obj.user))
+                conn.execute(SQL['delete_relation_tags'], (obj.id,))
+                conn.executemany(SQL['insert_relation_tag'],
+                                 [(obj.id, k, v) for (k, v) in obj.tags])
+                conn.execute(SQL['delete_relation_members'], (obj.id,))
+                conn.executemany(SQL['insert_relation_member'],
+                                 [(obj.id, MEMBER_TYPES[t], ref, role, n)
+                                  for (n, (t, ref, role)) in enumerate(obj.members)])
+
+        rebuild_geometry(conn, sorted(dirty_ways))
+        counts['geometries'] = len(dirty_ways)
+
+        if sequence is not None:
+            conn.execute(SQL['set_state'], (sequence, last_timestamp))
+
+    counts['seconds'] = time.perf_counter() - start
+    return counts
+
+
+def main():
+    parser = OptionParser(usage="%prog -d database [options] change.osc[.gz] ...")
+
+    parser.add_option('-d', '--database', dest='dbname',
+                      help="SQLite3 DB written by osm2sqlite.py", metavar="FILE")
+
+    parser.add_option('-q', '--sequence', dest='sequence', type='int', default=None,
+                      help="Sequence number of the (single) diff given.")
+
+    parser.add_option('-f', '--force', dest='force', action="store_true", default=False,
+                      help="Apply diffs even if they are at or below the last applied sequence.")
+
+    parser.add_option('-x', '--stats', dest='showstats', action="store_true", default=False,
+                      help="Show processing/debugging statistics.")
+
+    (options, args) = parser.parse_args(args=None, values=None)
+
+    if options.dbname is None or not args:
+        parser.print_help()
+        sys.exit(-1)
+
+    if options.sequence is not None and len(args) != 1:
+        print("-q can only be used with a single diff")
+        sys.exit(-1)
+
+    try:
+        conn = open_database(options.dbname)
+    except sqlite3.Error as Err:
+        print("Failed to open " + options.dbname + ": " + str(Err))
+        sys.exit(-1)
+
+    (last_sequence, last_timestamp) = get_state(conn)
+
+    if options.showstats:
+        print("Last applied sequence: " + str(last_sequence) + " (" + str(last_timestamp) + ")")
+
+    diffs = []
+    for filename in args:
+        sequence = options.sequence if options.sequence is not None \
+            else sequence_from_path(filename)
+        diffs.append((sequence if sequence is not None else -1, filename))
+    diffs.sort()
+
+    total_objects = 0
+    total_seconds = 0.0
+
+    for (sequence, filename) in diffs:
+        if sequence < 0:
+            sequence = None
+
+        if (not options.force and sequence is not None and last_sequence is not None
+                and sequence <= last_sequence):
+            if options.showstats:
+                print("Skipping " + filename + " (already applied)")
+            continue
+
+        try:
+            counts = apply_change(conn, filename, sequence)
+        except (sqlite3.Error, ValueError) as Err:
+            print("Applying " + filename + " failed: " + str(Err))
+            conn.close()
+            sys.exit(-2)
+
+        # The same sequence again (under another path) is already applied
+        if sequence is not None:
+            last_sequence = sequence
+
+        total_objects += counts['objects']
+        total_seconds += counts['seconds']
+
+        print("%s: %d created, %d modified, %d deleted, %d geometries, %.0f objects/sec"
+              % (filename, counts['create'], counts['modify'], counts['delete'],
+                 counts['geometries'], counts['objects'] / max(counts['seconds'], 1e-9)))
+
+    conn.close()
+
+    if options.showstats and total_seconds > 0:
+        print("Applied " + str(total_objects) + " objects in " + str(total_seconds)
+              + " seconds (" + str(int(total_objects / total_seconds)) + " objects/sec).")
+
+
+if __name__ == '__main__':
+    main()
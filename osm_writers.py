@@ -0,0 +1,824 @@
+# ---------------------------------------------------------------------------
+# osm_writers.py
+#
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
+# pylint: disable=R0902
+# pylint: disable=R0913 # Too many arguments
+# pylint: disable=R1732 # Consider using with
+#
+# Feature writers (output backends) for osm2fgdb.py. Every writer has the
+# same interface, so the node/way/area pipeline doesn't care where the
+# features go:
+#
+#   writer = open_writer('hawaii.gpkg')       # format from the extension
+#   writer.create_layer('nodes', 'point', [('Node_ID', 'LONG', 0), ...])
+#   writer.create_layer('other_node_tags', None, [...])   # no geometry
+#   writer.write('nodes', (lon, lat), (node_id, ...))
+#   writer.write_rows('other_node_tags', [(node_id, key, value), ...])
+#   writer.close()
+#
+# Fields are (name, type, width) with type LONG, DOUBLE, DATE (ISO 8601
+# string) or TEXT. Geometries use the flat coordinate convention of osm_geometry.py:
+#   point    - (x, y)
+#   polyline - x0, y0, x1, y1, ...
+#   polygon  - a list of rings, each flat
+#   multipolygon - a list of polygons
+# Values are a tuple in field order.
+#
+# Writers buffer batch_size features per layer and write them in one go
+# (one executemany + commit, one writelines, ...), never row by row.
+#
+# Geometry encoding is split from writing: Writer.encode(type, geometry) is
+# a staticmethod returning (bbox, payload) in the backend's own format, and
+# writer.write_encoded(layer, encoded, values) only buffers it. WayBuilder
+# uses that to encode ways in a process pool while one process writes.
+#
+#   GpkgWriter     - GeoPackage 1.2 written with sqlite3, geometries as
+#                    GeoPackage binary (header + envelope + WKB)
+#   GeoJsonWriter  - a directory of newline-delimited GeoJSON files, one
+#                    per layer (<layer>.geojsonl)
+#   ShapefileWriter- a directory of shapefiles, one per layer
+#                    (.shp/.shx/.dbf/.prj/.cpg; tables are just .dbf)
+#   FgdbWriter     - ESRI file geodatabase through arcgisscripting 9.3,
+#                    where that exists (Windows + ArcGIS)
+#
+# SpatialSortWriter wraps any of them and writes every geometry layer in
+# Hilbert order of the feature's bbox centre instead of input order, so
+# features that are near each other on the ground end up near each other
+# in the file (the same pages of a GeoPackage table, nearby lines of a
+# GeoJSON file) and a bbox query reads fewer pages. The encoded features
+# go through an ExternalSorter, so it works for planets in bounded memory.
+#
+# ---------------------------------------------------------------------------
+#   Name:       osm_writers.py
+#   Version:    1.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+import functools
+import json
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import struct
+import time
+
+from osm_extsort import ExternalSorter
+from osm_geometry import point_wkb, linestring_wkb, polygon_wkb, multipolygon_wkb, hilbert_key
+from osm_multipolygon import ring_area, reverse_ring
+
+WRITE_BUFFER = 1 << 20
+
+WGS84_WKT = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+             'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]')
+
+
+def geometry_bbox(geometry_type, geometry):
+    if geometry_type == 'point':
+        return (geometry[0], geometry[1], geometry[0], geometry[1])
+    if geometry_type == 'multipolygon':
+        boxes = [geometry_bbox('polygon', polygon) for polygon in geometry]
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+    if geometry_type == 'polygon':
+        geometry = geometry[0]
+    xs = geometry[0::2]
+    ys = geometry[1::2]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def grow_extent(extent, box):
+    if box is None:
+        return extent
+    if extent is None:
+        return box
+    return (min(extent[0], box[0]), min(extent[1], box[1]),
+            max(extent[2], box[2]), max(extent[3], box[3]))
+
+
+def pairs(coords):
+    return [[coords[i], coords[i + 1]] for i in range(0, len(coords), 2)]
+
+
+# ---------------------------------------------------------------------------
+# GeoPackage
+# ---------------------------------------------------------------------------
+GPKG_TYPES = {'LONG': 'INTEGER', 'DOUBLE': 'REAL', 'DATE': 'DATETIME', 'TEXT': 'TEXT'}
+GPKG_GEOMETRY = {'point': 'POINT', 'polyline': 'LINESTRING', 'polygon': 'POLYGON',
+                 'multipolygon': 'MULTIPOLYGON'}
+
+# GeoPackage binary header: magic, version 0, flags (little-endian, xy
+# envelope or none), srs id, then the envelope (minx, maxx, miny, maxy)
+_gpkg_header = struct.Struct('<2sBBi')
+_gpkg_envelope = struct.Struct('<dddd')
+
+GPKG_SCHEMA = [
+    "PRAGMA application_id = 1196444487",       # 'GPKG'
+    "PRAGMA user_version = 10200",
+    "create table if not exists gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+    "srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL, "
+    "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)",
+    "create table if not exists gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+    "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+    "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+    "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, "
+    "srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id))",
+    "create table if not exists gpkg_geometry_columns (table_name TEXT NOT NULL, "
+    "column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, "
+    "z TINYINT NOT NULL, m TINYINT NOT NULL, "
+    "CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))",
+]
+
+GPKG_SRS = [
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+    ('WGS 84 geodetic', 4326, 'EPSG', 4326, WGS84_WKT, None),
+]
+
+
+class GpkgWriter:
+    def __init__(self, path, batch_size=10000):
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA synchronous = OFF")
+        for sql in GPKG_SCHEMA:
+            self.conn.execute(sql)
+        self.conn.executemany("insert into gpkg_spatial_ref_sys values (?, ?, ?, ?, ?, ?)",
+                              GPKG_SRS)
+        self.conn.commit()
+
+        self.layers = {}
+
+    def create_layer(self, name, geometry_type, fields):
+        columns = ['fid INTEGER PRIMARY KEY AUTOINCREMENT']
+        if geometry_type is not None:
+            columns.append('geom ' + GPKG_GEOMETRY[geometry_type])
+        columns.extend('"%s" %s' % (f[0], GPKG_TYPES[f[1]]) for f in fields)
+        self.conn.execute('create table "%s" (%s)' % (name, ', '.join(columns)))
+
+        self.conn.execute("insert into gpkg_contents (table_name, data_type, identifier, srs_id) "
+                          "values (?, ?, ?, ?)",
+                          (name, 'attributes' if geometry_type is None else 'features',
+                           name, 4326 if geometry_type is not None else None))
+        if geometry_type is not None:
+            self.conn.execute("insert into gpkg_geometry_columns values (?, 'geom', ?, 4326, 0, 0)",
+                              (name, GPKG_GEOMETRY[geometry_type]))
+
+        names = ([] if geometry_type is None else ['geom']) + ['"%s"' % f[0] for f in fields]
+        sql = 'insert into "%s" (%s) values (%s)' % (name, ', '.join(names),
+                                                     ', '.join('?' * len(names)))
+        self.layers[name] = {'type': geometry_type, 'sql': sql, 'rows': [], 'extent': None}
+        self.conn.commit()
+
+    @staticmethod
+    def encode(geometry_type, geometry):
+        if geometry_type is None:
+            return (None, None)
+
+        box = geometry_bbox(geometry_type, geometry)
+        if geometry_type == 'point':
+            return (box, _gpkg_header.pack(b'GP', 0, 1, 4326) + point_wkb(geometry[0], geometry[1]))
+
+        (minx, miny, maxx, maxy) = box
+        header = _gpkg_header.pack(b'GP', 0, 3, 4326) + _gpkg_envelope.pack(minx, maxx, miny, maxy)
+        if geometry_type == 'polyline':
+            return (box, header + linestring_wkb(geometry))
+        if geometry_type == 'multipolygon':
+            return (box, header + multipolygon_wkb(geometry))
+        return (box, header + polygon_wkb(geometry))
+
+    def write(self, name, geometry, values):
+        self.write_encoded(name, self.encode(self.layers[name]['type'], geometry), values)
+
+    def write_encoded(self, name, encoded, values):
+        layer = self.layers[name]
+        if layer['type'] is None:
+            layer['rows'].append(values)
+        else:
+            layer['extent'] = grow_extent(layer['extent'], encoded[0])
+            layer['rows'].append((encoded[1],) + tuple(values))
+
+        if len(layer['rows']) >= self.batch_size:
+            self.flush(name)
+
+    def write_rows(self, name, rows):
+        # Tables (no geometry) only
+        layer = self.layers[name]
+        layer['rows'].extend(rows)
+
+        if len(layer['rows']) >= self.batch_size:
+            self.flush(name)
+
+    def flush(self, name):
+        layer = self.layers[name]
+        if layer['rows']:
+            self.conn.executemany(layer['sql'], layer['rows'])
+            self.conn.commit()
+            layer['rows'] = []
+
+    def create_index(self, name, field):
+        self.flush(name)
+        self.conn.execute('create index if not exists "%s_%s" on "%s" ("%s")'
+                          % (name, field, name, field))
+
+    def close(self):
+        for (name, layer) in self.layers.items():
+            self.flush(name)
+            if layer['extent'] is not None:
+                self.conn.execute("update gpkg_contents set min_x = ?, min_y = ?, max_x = ?, "
+                                  "max_y = ? where table_name = ?", layer['extent'] + (name,))
+        self.conn.commit()
+        self.conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Newline-delimited GeoJSON
+# ---------------------------------------------------------------------------
+class GeoJsonWriter:
+    def __init__(self, path, batch_size=10000):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.batch_size = batch_size
+        self.layers = {}
+
+    def create_layer(self, name, geometry_type, fields):
+        fptr = open(os.path.join(self.path, name + '.geojsonl'), 'w', encoding='utf-8',
+                    buffering=WRITE_BUFFER)
+        self.layers[name] = {'type': geometry_type, 'names': [f[0] for f in fields],
+                             'fptr': fptr, 'lines': []}
+
+    @staticmethod
+    def encode(geometry_type, geometry):
+        if geometry_type == 'point':
+            geom = {'type': 'Point', 'coordinates': [geometry[0], geometry[1]]}
+        elif geometry_type == 'polyline':
+            geom = {'type': 'LineString', 'coordinates': pairs(geometry)}
+        elif geometry_type == 'polygon':
+            geom = {'type': 'Polygon', 'coordinates': [pairs(ring) for ring in geometry]}
+        elif geometry_type == 'multipolygon':
+            geom = {'type': 'MultiPolygon',
+                    'coordinates': [[pairs(ring) for ring in polygon] for polygon in geometry]}
+        else:
+            return (None, 'null')
+        return (geometry_bbox(geometry_type, geometry), json.dumps(geom))
+
+    def write(self, name, geometry, values):
+        self.write_encoded(name, self.encode(self.layers[name]['type'], geometry), values)
+
+    def write_encoded(self, name, encoded, values):
+        layer = self.layers[name]
+
+        properties = json.dumps(dict(zip(layer['names'], values)), ensure_ascii=False)
+        layer['lines'].append('{"type": "Feature", "geometry": ' + encoded[1]
+                              + ', "properties": ' + properties + '}\n')
+
+        if len(layer['lines']) >= self.batch_size:
+            self.flush(name)
+
+    def write_rows(self, name, rows):
+        for values in rows:
+            self.write_encoded(name, (None, 'null'), values)
+
+    def flush(self, name):
+        layer = self.layers[name]
+        layer['fptr'].writelines(layer['lines'])
+        layer['lines'] = []
+
+    def create_index(self, name, field):
+        pass
+
+    def close(self):
+        for (name, layer) in self.layers.items():
+            self.flush(name)
+            layer['fptr'].close()
+
+
+# ---------------------------------------------------------------------------
+# Shapefiles
+#
+# LONG is N(19), DOUBLE N(24,10), DATE C(20) (dBASE dates have no time), TEXT C(width)
+# truncated to 254 bytes of utf-8. Field names are cut to 10 characters,
+# and names that come out the same are numbered (gnis_featu, gnis_fea_1);
+# <layer>.fields.txt then lists each DBF name with its full name.
+# Polygon rings are written outer clockwise, as shapefiles expect.
+# ---------------------------------------------------------------------------
+SHP_TYPES = {'point': 1, 'polyline': 3, 'polygon': 5, 'multipolygon': 5}
+
+_shp_file_header = struct.Struct('>i20xi')
+_shp_file_header2 = struct.Struct('<ii4d32x')
+_shp_record_header = struct.Struct('>ii')
+_shp_point = struct.Struct('<idd')
+_shp_poly = struct.Struct('<i4dii')
+_dbf_header = struct.Struct('<B3BIHH20x')
+_dbf_field = struct.Struct('<11sc4xBB14x')
+
+
+def dbf_field_names(names):
+    # Unique DBF field names - at most 10 ascii characters, compared
+    # without case
+    taken = set()
+    out = []
+    for name in names:
+        name = name.encode('ascii', 'replace').decode('ascii')
+        short = name[:10]
+        n = 0
+        while short.upper() in taken:
+            n += 1
+            suffix = '_%d' % n
+            short = name[:10 - len(suffix)] + suffix
+        taken.add(short.upper())
+        out.append(short)
+    return out
+
+
+class ShapefileWriter:
+    def __init__(self, path, batch_size=10000):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.batch_size = batch_size
+        self.layers = {}
+
+    def create_layer(self, name, geometry_type, fields):
+        base = os.path.join(self.path, name)
+
+        names = dbf_field_names([f[0] for f in fields])
+        dbf_fields = []
+        for (dbf_name, (_, ftype, width)) in zip(names, fields):
+            if ftype == 'LONG':
+                dbf_fields.append((dbf_name, b'N', 19, 0))
+            elif ftype == 'DOUBLE':
+                dbf_fields.append((dbf_name, b'N', 24, 10))
+            elif ftype == 'DATE':
+                dbf_fields.append((dbf_name, b'C', 20, 0))
+            else:
+                dbf_fields.append((dbf_name, b'C', min(254, width or 254), 0))
+
+        # Which column is which, when any name had to be cut
+        if any(dbf_name != f[0] for (dbf_name, f) in zip(names, fields)):
+            with open(base + '.fields.txt', 'w', encoding='utf-8') as txt:
+                for (dbf_name, f) in zip(names, fields):
+                    txt.write('%s\t%s\n' % (dbf_name, f[0]))
+
+        layer = {'type': geometry_type, 'fields': dbf_fields, 'records': [], 'count': 0,
+                 'offset': 50, 'extent': None,
+                 'dbf': open(base + '.dbf', 'wb', buffering=WRITE_BUFFER)}
+        self.write_dbf_header(layer)
+
+        if geometry_type is not None:
+            layer['shp'] = open(base + '.shp', 'wb', buffering=WRITE_BUFFER)
+            layer['shx'] = open(base + '.shx', 'wb', buffering=WRITE_BUFFER)
+            layer['shp'].write(b'\0' * 100)
+            layer['shx'].write(b'\0' * 100)
+            with open(base + '.prj', 'w', encoding='ascii') as prj:
+                prj.write(WGS84_WKT)
+
+        with open(base + '.cpg', 'w', encoding='ascii') as cpg:
+            cpg.write('UTF-8')
+
+        self.layers[name] = layer
+
+    def write_dbf_header(self, layer):
+        fields = layer['fields']
+        now = time.gmtime()
+        header_length = 32 + 32 * len(fields) + 1
+        record_length = 1 + sum(f[2] for f in fields)
+
+        dbf = layer['dbf']
+        dbf.seek(0)
+        dbf.write(_dbf_header.pack(3, now.tm_year - 1900, now.tm_mon, now.tm_mday,
+                                   layer['count'], header_length, record_length))
+        for (fname, ftype, width, decimals) in fields:
+            dbf.write(_dbf_field.pack(fname.encode('ascii'), ftype, width, decimals))
+        dbf.write(b'\r')
+
+    @staticmethod
+    def encode(geometry_type, geometry):
+        if geometry_type is None:
+            return (None, None)
+
+        box = geometry_bbox(geometry_type, geometry)
+        if geometry_type == 'point':
+            return (box, _shp_point.pack(1, geometry[0], geometry[1]))
+
+        if geometry_type == 'polyline':
+            rings = [geometry]
+        else:
+            polygons = [geometry] if geometry_type == 'polygon' else geometry
+            rings = []
+            for polygon in polygons:
+                for (n, ring) in enumerate(polygon):
+                    # Outer ring clockwise (negative area), holes counterclockwise
+                    if (ring_area(ring) > 0) == (n == 0):
+                        ring = reverse_ring(ring)
+                    rings.append(ring)
+
+        npoints = sum(len(r) // 2 for r in rings)
+        (minx, miny, maxx, maxy) = box
+        parts = []
+        start = 0
+        for ring in rings:
+            parts.append(start)
+            start += len(ring) // 2
+        coords = [c for ring in rings for c in ring]
+
+        return (box, _shp_poly.pack(SHP_TYPES[geometry_type], minx, miny, maxx, maxy,
+                                    len(rings), npoints)
+                + struct.pack('<%di' % len(parts), *parts)
+                + struct.pack('<%dd' % len(coords), *coords))
+
+    @staticmethod
+    def dbf_record(fields, values):
+        out = [b' ']
+        for ((_, ftype, width, decimals), value) in zip(fields, values):
+            if value is None:
+                value = ''
+            elif decimals:
+                value = '%.*f' % (decimals, value)
+            data = str(value).encode('utf-8')[:width]
+            if ftype == b'N':
+                out.append(data.rjust(width))
+            else:
+                out.append(data.decode('utf-8', 'ignore').encode('utf-8').ljust(width))
+        return b''.join(out)
+
+    def write(self, name, geometry, values):
+        self.write_encoded(name, self.encode(self.layers[name]['type'], geometry), values)
+
+    def write_encoded(self, name, encoded, values):
+        layer = self.layers[name]
+        layer['extent'] = grow_extent(layer['extent'], encoded[0])
+        layer['records'].append((encoded[1], self.dbf_record(layer['fields'], values)))
+
+        if len(layer['records']) >= self.batch_size:
+            self.flush(name)
+
+    def write_rows(self, name, rows):
+        for values in rows:
+            self.write_encoded(name, (None, None), values)
+
+    def flush(self, name):
+        layer = self.layers[name]
+        if not layer['records']:
+            return
+
+        shp = []
+        shx = []
+        for (shape, _) in layer['records']:
+            layer['count'] += 1
+            if shape is not None:
+                words = len(shape) // 2
+                shx.append(_shp_record_header.pack(layer['offset'], words))
+                shp.append(_shp_record_header.pack(layer['count'], words))
+                shp.append(shape)
+                layer['offset'] += 4 + words
+
+        layer['dbf'].write(b''.join(r[1] for r in layer['records']))
+        if layer['type'] is not None:
+            layer['shp'].write(b''.join(shp))
+            layer['shx'].write(b''.join(shx))
+
+        layer['records'] = []
+
+    def create_index(self, name, field):
+        pass
+
+    def close(self):
+        for (name, layer) in self.layers.items():
+            self.flush(name)
+
+            layer['dbf'].write(b'\x1a')
+            self.write_dbf_header(layer)
+            layer['dbf'].close()
+
+            if layer['type'] is None:
+                continue
+
+            extent = layer['extent'] or (0.0, 0.0, 0.0, 0.0)
+            shape_type = SHP_TYPES[layer['type']]
+            for (fptr, words) in ((layer['shp'], layer['offset']),
+                                  (layer['shx'], 50 + 4 * layer['count'])):
+                fptr.seek(0)
+                fptr.write(_shp_file_header.pack(9994, words))
+                fptr.write(_shp_file_header2.pack(1000, shape_type, *extent))
+                fptr.close()
+
+
+# ---------------------------------------------------------------------------
+# ESRI file geodatabase (arcgisscripting 9.3). Inserts go through gp
+# cursors, which only take one row at a time.
+# ---------------------------------------------------------------------------
+FGDB_GEOMETRY = {'point': 'point', 'polyline': 'polyline', 'polygon': 'polygon',
+                 'multipolygon': 'polygon'}
+FGDB_COORDSYS = 'Coordinate Systems\\Geographic Coordinate Systems\\World\\WGS 1984.prj'
+
+
+def arc_date(iso_timestamp):
+    #                               01234567890123456789
+    # Timestamp comes in like this: 2011-01-25T19:13:46Z
+    # Needs to go out like this: 01/25/2011 07:13:46 PM
+    if len(iso_timestamp) < 19:
+        return ''
+
+    am_pm = ' AM'
+    hournum = int(iso_timestamp[11:13])
+    if hournum > 12:
+        am_pm = ' PM'
+        hournum = hournum - 12
+
+    return "%02s/%02s/%02s %02d%04s %02s" % \
+        (iso_timestamp[5:7], iso_timestamp[8:10], iso_timestamp[0:4],
+         hournum, iso_timestamp[13:19], am_pm)
+
+
+class FgdbWriter:
+    def __init__(self, path, batch_size=10000):
+        # Import the arc module as late as possible
+        import arcgisscripting
+
+        # Create the geoprocessor object - use 9.3 version
+        self.gp = arcgisscripting.create(9.3)
+        self.gp.toolbox = "management"
+
+        self.path = path
+        self.batch_size = batch_size
+        if not self.gp.Exists(path):
+            self.gp.CreateFileGDB(os.path.split(path)[0], os.path.split(path)[1])
+
+        self.layers = {}
+
+    def create_layer(self, name, geometry_type, fields):
+        table = os.path.join(self.path, name)
+
+        if not self.gp.Exists(table):
+            if geometry_type is None:
+                self.gp.CreateTable(self.path, name)
+            else:
+                self.gp.CreateFeatureclass(self.path, name, FGDB_GEOMETRY[geometry_type], "#",
+                                           "DISABLED", "DISABLED", FGDB_COORDSYS)
+            for (fname, ftype, width) in fields:
+                if ftype == 'TEXT':
+                    self.gp.addfield(table, fname, "TEXT", "#", "#", str(width))
+                else:
+                    self.gp.addfield(table, fname, ftype)
+
+        self.layers[name] = {'type': geometry_type, 'fields': fields, 'table': table,
+                             'cursor': self.gp.insertcursor(table)}
+
+    def geometry_object(self, geometry_type, geometry):
+        gp = self.gp
+
+        if geometry_type == 'point':
+            pnt = gp.createobject("point")
+            pnt.x = geometry[0]
+            pnt.y = geometry[1]
+            return pnt
+
+        if geometry_type == 'polyline':
+            rings = [geometry]
+        elif geometry_type == 'multipolygon':
+            rings = [ring for polygon in geometry for ring in polygon]
+        else:
+            rings = geometry
+        shape = gp.createobject("Array")
+        for ring in rings:
+            part = gp.createobject("Array")
+            for i in range(0, len(ring), 2):
+                pnt = gp.createobject("point")
+                pnt.x = ring[i]
+                pnt.y = ring[i + 1]
+                part.add(pnt)
+            shape.add(part)
+        return shape
+
+    @staticmethod
+    def encode(geometry_type, geometry):
+        # gp geometry objects only exist in the writing process
+        if geometry_type is None:
+            return (None, None)
+        return (geometry_bbox(geometry_type, geometry), geometry)
+
+    def write(self, name, geometry, values):
+        self.write_encoded(name, self.encode(self.layers[name]['type'], geometry), values)
+
+    def write_rows(self, name, rows):
+        for values in rows:
+            self.write_encoded(name, (None, None), values)
+
+    def write_encoded(self, name, encoded, values):
+        layer = self.layers[name]
+        cursor = layer['cursor']
+        geometry = encoded[1]
+
+        row = cursor.newrow()
+        for ((fname, ftype, _), value) in zip(layer['fields'], values):
+            if ftype == 'DATE':
+                value = arc_date(value)
+            row.setValue(fname, value)
+        if layer['type'] is not None:
+            row.setValue("shape", self.geometry_object(layer['type'], geometry))
+        cursor.insertrow(row)
+
+    def create_index(self, name, field):
+        layer = self.layers[name]
+        layer['cursor'] = None
+        if layer['type'] is not None:
+            self.gp.addspatialindex(layer['table'], 0.5)
+        else:
+            self.gp.AddIndex(layer['table'], field, field + "_Idx", "NON_UNIQUE", "#")
+        layer['cursor'] = self.gp.insertcursor(layer['table'])
+
+    def close(self):
+        for layer in self.layers.values():
+            layer['cursor'] = None
+        self.gp = None
+
+
+# ---------------------------------------------------------------------------
+# Spatially sorted output. Geometry layer features are encoded as they come
+# in, sorted by (layer, Hilbert key, arrival) on disk and written to the
+# wrapped writer at close(). Tables without geometry go straight through.
+# Attribute indexes on sorted layers are built after the sorted write.
+# ---------------------------------------------------------------------------
+class SpatialSortWriter:
+    def __init__(self, writer, workdir, run_size=1000000, compress=False, order=16):
+        self.writer = writer
+        self.writer_class = type(writer)
+        self.order = order
+        self.sorter = ExternalSorter(workdir, 'spatial', (int, int, int, bytes), run_size,
+                                     compress)
+        self.types = {}
+        self.names = []
+        self.indexes = []
+        self.seq = 0
+
+    def create_layer(self, name, geometry_type, fields):
+        self.writer.create_layer(name, geometry_type, fields)
+        if geometry_type is not None:
+            self.types[name] = (len(self.names), geometry_type)
+            self.names.append(name)
+
+    def write(self, name, geometry, values):
+        if name not in self.types:
+            self.writer.write(name, geometry, values)
+            return
+        self.write_encoded(name, self.writer_class.encode(self.types[name][1], geometry), values)
+
+    def write_encoded(self, name, encoded, values):
+        if name not in self.types:
+            self.writer.write_encoded(name, encoded, values)
+            return
+
+        box = encoded[0]
+        key = hilbert_key((box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0, self.order)
+        self.sorter.add((self.types[name][0], key, self.seq,
+                         pickle.dumps((encoded, tuple(values)), pickle.HIGHEST_PROTOCOL)))
+        self.seq += 1
+
+    def write_rows(self, name, rows):
+        self.writer.write_rows(name, rows)
+
+    def flush(self, name):
+        if name not in self.types:
+            self.writer.flush(name)
+
+    def create_index(self, name, field):
+        if name in self.types:
+            self.indexes.append((name, field))
+        else:
+            self.writer.create_index(name, field)
+
+    def close(self):
+        names = self.names
+        write_encoded = self.writer.write_encoded
+        for (layer, _, _, data) in self.sorter.sorted():
+            (encoded, values) = pickle.loads(data)
+            write_encoded(names[layer], encoded, values)
+        self.sorter.cleanup()
+
+        for (name, field) in self.indexes:
+            self.writer.create_index(name, field)
+        self.writer.close()
+
+
+# ---------------------------------------------------------------------------
+# Encode a way (and its area, if closed) for writer_class. Runs in the pool.
+# ---------------------------------------------------------------------------
+def encode_way(writer_class, item):
+    (values, coords) = item
+
+    area = None
+    if len(coords) >= 8 and coords[0] == coords[-2] and coords[1] == coords[-1]:
+        area = writer_class.encode('polygon', [coords])
+
+    return (values, writer_class.encode('polyline', coords), area)
+
+
+# ---------------------------------------------------------------------------
+# Builds way (and area) geometries in batches, over a process pool if
+# workers > 0, and writes them through the writer in input order.
+# ---------------------------------------------------------------------------
+class WayBuilder:
+    def __init__(self, writer, way_layer, area_layer, workers=0, batch_size=10000):
+        self.writer = writer
+        self.way_layer = way_layer
+        self.area_layer = area_layer
+        self.encode = functools.partial(encode_way, getattr(writer, 'writer_class', type(writer)))
+        self.batch_size = batch_size
+        self.batch = []
+        self.job = None
+        self.ways = 0
+        self.areas = 0
+        self.workers = workers
+
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers)
+        else:
+            self.pool = None
+
+    def add(self, values, coords):
+        self.batch.append((values, coords))
+
+        if len(self.batch) >= self.batch_size:
+            self.submit()
+
+    def submit(self):
+        batch = self.batch
+        self.batch = []
+
+        if self.pool is None:
+            self.write(map(self.encode, batch))
+            return
+
+        chunk = max(1, len(batch) // (4 * self.workers))
+        job = self.pool.map_async(self.encode, batch, chunk)
+
+        # Keep one batch in flight: write the previous one while this one builds
+        self.wait()
+        self.job = job
+
+    def wait(self):
+        if self.job is not None:
+            self.write(self.job.get())
+            self.job = None
+
+    def write(self, results):
+        for (values, line, area) in results:
+            self.writer.write_encoded(self.way_layer, line, values)
+            self.ways += 1
+            if area is not None:
+                self.writer.write_encoded(self.area_layer, area, values)
+                self.areas += 1
+
+    def flush(self):
+        if self.batch:
+            self.submit()
+        self.wait()
+
+    def close(self):
+        self.flush()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+WRITERS = {
+    'gpkg': GpkgWriter,
+    'geojson': GeoJsonWriter,
+    'shp': ShapefileWriter,
+    'fgdb': FgdbWriter,
+}
+
+EXTENSIONS = {
+    '.gpkg': 'gpkg',
+    '.geojsonl': 'geojson',
+    '.ndjson': 'geojson',
+    '.shp': 'shp',
+    '.gdb': 'fgdb',
+}
+
+
+# ---------------------------------------------------------------------------
+# Open a writer by format name, or by the output's extension if format is
+# None (GeoPackage if the extension says nothing).
+# ---------------------------------------------------------------------------
+def open_writer(path, output_format=None, batch_size=10000):
+    if output_format is None:
+        output_format = EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'gpkg')
+
+    if output_format not in WRITERS:
+        raise ValueError("Unknown output format " + str(output_format))
+
+    return WRITERS[output_format](path, batch_size)
@@ -1,57 +1,277 @@
+# ---------------------------------------------------------------------------
+# splitter.py
 #
-# Splitter - takes a node file from osm_chunker and splits it into lots of little files
-#            probably should build this into osm_chunker
+# Disable some Pylint warnings
+# pylint: disable=C0103, C0114, C0115, C0116 # Missing docstrings
+# pylint: disable=C0209 # Consider using F-string
 #
+# Splits an OSM file (a planet, an extract, or a chunk from osm_chunker.py)
+# into pieces of at most -n objects:
+#
+#   splitter.py -i full-planet-nodes.00000.osm [-n 1000000] [-z gz] [-o pieces]
+#
+#       full-planet-nodes.00000.00000.osm, full-planet-nodes.00000.00001.osm, ...
+#
+# Pieces are cut on object boundaries (read through OsmReader, so line
+# breaks don't matter) and each one is a complete OSM XML file - prolog,
+# <osm> root, objects in input order, </osm> - that OsmReader or a worker
+# can take on its own.
+#
+# Uncompressed files can be split by size instead (-b MB), without parsing
+# them or passing the data through Python:
+#
+#   splitter.py -i full-planet.osm -b 1024 [-V]
+#
+# 1. Boundaries: seek to every -b MB and scan forward (1MB reads, bytes
+#    find) to the next <node/<way/<relation/<changeset start tag. A '<' can't
+#    appear inside an attribute value, so that is always an object start.
+#    The header (prolog, <osm>, <bounds>) ends at the first object and the
+#    footer starts at the last </osm>. Only a few MB get read however big
+#    the file is.
+# 2. The split index goes to <root>.split.json:
+#      {"source": "/data/full-planet.osm", "size": ..., "header": [0, 212],
+#       "footer": [size - 7, size],
+#       "pieces": [{"start": 212, "end": 1073741950, "type": "node"}, ...]}
+# 3. Pieces are header + byte range + </osm>, copied file to file in the
+#    kernel with os.copy_file_range (os.sendfile, then plain reads, where
+#    that isn't there), so splitting runs at disk speed.
+#
+# With -V (virtual split) only the index is written; parallel readers open
+# their piece in place with OsmReader(source, byte_range=(start, end)).
+#
+# ---------------------------------------------------------------------------
+#   Name:       splitter.py
+#   Version:    2.0
+#   Authored    By: Erica Wolf
+#   Copyright:  Public Domain.
+# ---------------------------------------------------------------------------
+
+from optparse import OptionParser
+import json
+import os
+import sys
+import time
+
+from osm_codecs import CODECS, detect
+from osm_chunker import COMPRESSION, OSM_HEADER, OSM_FOOTER, chunk_root, open_chunk_file, \
+    read_objects
+from osm_reader import OsmReader
+
+# Object start tags, as they can appear at a piece boundary
+OBJECT_STARTS = {b'<node ': 'node', b'<way ': 'way', b'<relation ': 'relation',
+                 b'<changeset ': 'changeset'}
+
+SCAN_BLOCK = 1 << 20
+
+# Enough of a block again to catch a start tag across two blocks
+SCAN_OVERLAP = 16
+
+COPY_BLOCK = 1 << 24
+
+
+def split_file(filename, outdir, piece_size=1000000, compression=None):
+    (opener, ext) = COMPRESSION[compression]
+    root = chunk_root(filename)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    pieces = []
+    fptr = None
+    count = 0
+
+    for (_, lines) in read_objects(OsmReader(filename)):
+        if fptr is None:
+            path = os.path.join(outdir, '%s.%05d.osm%s' % (root, len(pieces), ext))
+            fptr = open_chunk_file(opener, path, 'wb')
+            fptr.write(OSM_HEADER)
+            pieces.append(path)
+            count = 0
+
+        fptr.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        count += 1
+
+        if count >= piece_size:
+            fptr.write(OSM_FOOTER)
+            fptr.close()
+            fptr = None
+
+    if fptr is not None:
+        fptr.write(OSM_FOOTER)
+        fptr.close()
+
+    return pieces
+
+
+# ---------------------------------------------------------------------------
+# Byte splitting (uncompressed files)
+# ---------------------------------------------------------------------------
+def next_object(fptr, pos, size):
+    # (offset, type) of the first object start tag at or after pos, or
+    # (size, None) if there isn't one
+    while pos < size:
+        fptr.seek(pos)
+        block = fptr.read(SCAN_BLOCK + SCAN_OVERLAP)
+        best = (-1, None)
+        for (pattern, obj_type) in OBJECT_STARTS.items():
+            i = block.find(pattern)
+            if i >= 0 and (best[0] < 0 or i < best[0]):
+                best = (i, obj_type)
+        if best[0] >= 0:
+            return (pos + best[0], best[1])
+        pos += SCAN_BLOCK
+    return (size, None)
+
+
+def footer_start(fptr, size):
+    # Where the closing </osm> is (or the end, if there isn't one)
+    tail = min(size, SCAN_BLOCK)
+    fptr.seek(size - tail)
+    i = fptr.read(tail).rfind(b'</osm>')
+    return size if i < 0 else size - tail + i
+
+
+def build_split_index(filename, piece_bytes):
+    size = os.path.getsize(filename)
+
+    with open(filename, 'rb') as fptr:
+        (header_end, first_type) = next_object(fptr, 0, size)
+        footer = max(header_end, footer_start(fptr, size))
+
+        cuts = [(header_end, first_type)]
+        target = header_end + piece_bytes
+        while target < footer:
+            cut = next_object(fptr, target, footer)
+            if cut[0] >= footer:
+                break
+            if cut[0] > cuts[-1][0]:
+                cuts.append(cut)
+            target = max(target, cut[0]) + piece_bytes
+
+    pieces = []
+    for (n, (start, obj_type)) in enumerate(cuts):
+        end = cuts[n + 1][0] if n + 1 < len(cuts) else footer
+        if end > start:
+            pieces.append({'start': start, 'end': end, 'type': obj_type})
+
+    return {'source': os.path.abspath(filename), 'size': size, 'header': [0, header_end],
+            'footer': [footer, size], 'pieces': pieces}
+
+
+def copy_range(src, dst, offset, count):
+    # src bytes [offset, offset + count) to dst's current position,
+    # in the kernel where it can be
+    end = offset + count
+    while offset < end:
+        n = min(COPY_BLOCK, end - offset)
+        try:
+            n = os.copy_file_range(src, dst, n, offset)
+        except (AttributeError, OSError):
+            try:
+                n = os.sendfile(dst, src, offset, n)
+            except (AttributeError, OSError):
+                n = os.write(dst, os.pread(src, n, offset))
+        if n == 0:
+            raise OSError("Unexpected end of file copying a piece")
+        offset += n
+
+
+def materialize(index, outdir, root):
+    header = index['header']
+    paths = []
+
+    src = os.open(index['source'], os.O_RDONLY)
+    try:
+        for (n, piece) in enumerate(index['pieces']):
+            path = os.path.join(outdir, '%s.%05d.osm' % (root, n))
+            dst = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                copy_range(src, dst, header[0], header[1] - header[0])
+                copy_range(src, dst, piece['start'], piece['end'] - piece['start'])
+                os.write(dst, OSM_FOOTER)
+            finally:
+                os.close(dst)
+            paths.append(path)
+    finally:
+        os.close(src)
+
+    return paths
+
+
+def split_bytes(filename, outdir, piece_mb, virtual=False):
+    root = chunk_root(filename)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    index = build_split_index(filename, piece_mb << 20)
+    with open(os.path.join(outdir, root + '.split.json'), 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1)
+
+    if virtual:
+        return (index, [])
+    return (index, materialize(index, outdir, root))
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option('-i', '--input', dest='filename',
+                      help="OSM file to split (.osm or compressed)", metavar="FILE")
+
+    parser.add_option('-o', '--outdir', dest='outdir', default=None,
+                      help="Directory for the pieces (default: next to the input).")
 
-import sys, time
+    parser.add_option('-n', '--objects', dest='piece_size', type='int', default=1000000,
+                      help="Objects per piece (default 1000000).")
 
-start = time.clock()
+    parser.add_option('-z', '--compress', dest='compression', default=None,
+                      choices=list(CODECS),
+                      help="Compress the pieces: " + ", ".join(CODECS) + ".")
 
-try:
-    infile = open(sys.argv[1], "r")
-    
-except:
-    print("Unable to open " + sys.argv[1])
-    sys.exit(-1)
-    
-fcount = 0
-lcount = 1
-ofname = sys.argv[1] + '.{:04d}'.format(fcount)
-outfile = open(ofname, "w")
+    parser.add_option('-b', '--bytes', dest='piece_mb', type='int', default=None,
+                      help="Split an uncompressed file into pieces of about this many MB, "
+                           "by byte offset (see above), instead of by object count.")
 
-line = ''
+    parser.add_option('-V', '--virtual', dest='virtual', action="store_true", default=False,
+                      help="With -b, only write the split index (<root>.split.json).")
 
-for line in infile:
-    outfile.write(line)
+    (options, args) = parser.parse_args(args=None, values=None)
 
-    if (line[2] == 'n'):
-        lcount += 1
+    filename = options.filename
+    if filename is None and args:
+        filename = args[0]
+    if filename is None or options.piece_size < 1:
+        parser.print_help()
+        sys.exit(-1)
 
-    if (line[1] == 'n' and line[-3] == '/'):
-        lcount += 1
-     
-    #
-    # 500,000 Nodes should be < 100MB (typically)
-    #
-    if (lcount % 1000000) == 0:
-        lcount += 1
-        fcount += 1
-        outfile.close()
+    outdir = options.outdir
+    if outdir is None:
+        outdir = os.path.dirname(filename) or '.'
 
-        print("Files: {:05d}   Nodes: {:d}".format(fcount, lcount))
-        
-        ofname = sys.argv[1] + '.{:05d}'.format(fcount)
-        outfile = open(ofname, "w")
-        
+    if options.piece_mb is not None and (options.piece_mb < 1 or options.compression
+                                         or detect(filename) is not None):
+        print("-b splits uncompressed files into uncompressed pieces; use -n otherwise")
+        sys.exit(-1)
 
-        
-outfile.close()
+    start = time.perf_counter()
 
-infile.close()
+    try:
+        if options.piece_mb is not None:
+            (index, pieces) = split_bytes(filename, outdir, options.piece_mb, options.virtual)
+        else:
+            pieces = split_file(filename, outdir, options.piece_size, options.compression)
+    except OSError as Err:
+        print("Unable to split " + filename + ": " + str(Err))
+        sys.exit(-1)
 
-print("Split " + str(lcount) + " lines from " + sys.argv[1] + " into " + str(fcount+1) + " files.")
+    seconds = time.perf_counter() - start
+    if options.piece_mb is not None and options.virtual:
+        print("Indexed " + filename + " into " + str(len(index['pieces'])) + " pieces.")
+    else:
+        print("Split " + filename + " into " + str(len(pieces)) + " files.")
+    if options.piece_mb is not None and not options.virtual:
+        print("%.1f MB/s" % (index['size'] / 1048576.0 / max(seconds, 1e-9)))
+    print("Took %.1f seconds." % seconds)
 
-finish = time.clock()
-print("Took " + str(finish - start) + " seconds.")
 
-    
\ No newline at end of file
+if __name__ == '__main__':
+    main()